@@ -10,7 +10,7 @@ from logging.config import dictConfig
 from celery import Celery
 
 from django.conf import settings
-from django.core.mail import send_mail, mail_admins
+from django.core.mail import send_mail, mail_admins, EmailMultiAlternatives, get_connection
 from django.utils.timezone import now, localtime
 from django.core.management import call_command
 from django.core.cache import cache
@@ -52,12 +52,59 @@ def send_daily_reports_emails():
             return
 
         filtered_users = User.objects.filter(cinemas__isnull=False, is_active=True).distinct()
-        filtered_users.send_daily_reports_emails(is_email_async=False)
+        result = filtered_users.send_daily_reports_emails(is_email_async=False)
+        logger.info('send_daily_reports_emails: %s emails, %s', result['emails_count'], ', '.join(
+            '{} {:.2f}s'.format(phase, seconds) for phase, seconds in result['timings'].items()))
 
     except Exception:
         logger.error(msg='send_daily_reports_emails error', exc_info=sys.exc_info())
 
 
+@app.task
+def extend_cinema_day_statuses():
+    try:
+        from common.models import AgreementDay, CinemaDayStatus
+
+        AgreementDay.objects.refresh(now().date() - timedelta(days=1))
+        CinemaDayStatus.objects.refresh(now().date() - timedelta(days=1))
+
+    except Exception:
+        logger.error(msg='extend_cinema_day_statuses error', exc_info=sys.exc_info())
+
+
+@app.task
+def parse_xls_report(report_id):
+    try:
+        from common.models import XlsSessionsReport
+
+        XlsSessionsReport.objects.select_related('report_upload__city').get(pk=report_id).parse()
+
+    except Exception:
+        logger.error(msg='parse_xls_report error', exc_info=sys.exc_info())
+
+
+@app.task
+def send_agreement_alerts_digest():
+    try:
+        from common.models import SessionAgreementAlert
+
+        SessionAgreementAlert.objects.send_digest()
+
+    except Exception:
+        logger.error(msg='send_agreement_alerts_digest error', exc_info=sys.exc_info())
+
+
+@app.task
+def relink_agreement_sessions(job_id):
+    try:
+        from common.models import AgreementRelinkJob
+
+        AgreementRelinkJob.objects.select_related('agreement').get(pk=job_id).run()
+
+    except Exception:
+        logger.error(msg='relink_agreement_sessions error', exc_info=sys.exc_info())
+
+
 @app.task
 def async_send_email(subject, message, recipient_list, from_email=settings.DEFAULT_FROM_EMAIL,
                      html_message=None):
@@ -72,6 +119,26 @@ def async_send_email(subject, message, recipient_list, from_email=settings.DEFAU
         logger.error(msg='async_send_email error', exc_info=sys.exc_info())
 
 
+def send_html_emails(subject, html_message, recipient_list, from_email=settings.DEFAULT_FROM_EMAIL,
+                     connection=None):
+    """Sends a separate message to every recipient through a single connection"""
+    messages = []
+    for recipient in recipient_list:
+        message = EmailMultiAlternatives(subject, '', from_email, [recipient])
+        message.attach_alternative(html_message, 'text/html')
+        messages.append(message)
+    return (connection or get_connection()).send_messages(messages)
+
+
+@app.task
+def async_send_html_emails(subject, html_message, recipient_list,
+                           from_email=settings.DEFAULT_FROM_EMAIL):
+    try:
+        send_html_emails(subject, html_message, recipient_list, from_email=from_email)
+    except Exception:
+        logger.error(msg='async_send_html_emails error', exc_info=sys.exc_info())
+
+
 @app.task
 def async_mail_admins(subject, message, fail_silently=False, html_message=None):
     try:
@@ -4,13 +4,18 @@ from io import BytesIO
 
 from django.http import HttpResponse
 from django.contrib import admin
+from django.contrib.admin.views.main import ORDER_VAR
+from django.db import IntegrityError
 from django.db.models import Count
 from django.templatetags.static import static
+from django.urls import reverse
+from django.utils.html import format_html
 
 from common import models
 from common.admin_forms import CinemaAdminForm, CinemaHallInlineForm, CinemaHallInlineFormSet, \
     AdditionalAgreementAdminForm, SessionAdminForm, GeneralContractAdminForm
 from kinomania.admin_utils import ChangeLinkMixin
+from kinomania.paginators import KeysetPaginator
 
 
 @admin.register(models.City)
@@ -146,6 +151,7 @@ class CinemaHallAdmin(admin.ModelAdmin):
 class SessionAdmin(ChangeLinkMixin, admin.ModelAdmin):
     form = SessionAdminForm
     list_per_page = 30
+    show_full_result_count = False
     list_display = (
         'film_name',
         'chain_name',
@@ -197,6 +203,13 @@ class SessionAdmin(ChangeLinkMixin, admin.ModelAdmin):
         qs = super().get_queryset(request)
         return qs.select_related('cinema_hall__cinema__chain', 'film', 'dimension')
 
+    def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        """Default (date, id) ordering is paginated by keyset, column sorting uses OFFSET"""
+        if ORDER_VAR in request.GET:
+            return super().get_paginator(request, queryset, per_page, orphans,
+                                         allow_empty_first_page)
+        return KeysetPaginator(queryset, per_page, orphans, allow_empty_first_page)
+
 
 @admin.register(models.AdditionalAgreement)
 class AdditionalAgreementAdmin(admin.ModelAdmin):
@@ -217,6 +230,63 @@ class AdditionalAgreementAdmin(admin.ModelAdmin):
     active_date_range_from.short_description = 'Активно с'
     active_date_range_to.short_description = 'Активно по'
 
+    def changeform_view(self, request, object_id=None, form_url='', extra_context=None):
+        try:
+            return super().changeform_view(request, object_id, form_url, extra_context)
+        except IntegrityError as e:
+            if models.AdditionalAgreement.OVERLAP_CONSTRAINT not in str(e):
+                raise
+            # an overlapping agreement was saved concurrently and is committed by now,
+            # so the form validated again shows the usual overlap error
+            return super().changeform_view(request, object_id, form_url, extra_context)
+
+
+@admin.register(models.AgreementRelinkJob)
+class AgreementRelinkJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'agreement', 'relink', 'status', 'progress', 'created', 'started',
+                    'finished')
+    list_filter = ('status', 'relink')
+    list_select_related = ('agreement__cinema', 'agreement__film')
+    raw_id_fields = ('agreement', )
+    readonly_fields = ('agreement', 'relink', 'status', 'sessions_count', 'processed_count',
+                       'last_session_id', 'started', 'finished', 'error')
+    actions = ['restart']
+
+    def has_add_permission(self, request):
+        return False
+
+    def progress(self, obj):
+        return '{} / {}'.format(obj.processed_count, obj.sessions_count)
+    progress.short_description = 'Прогресс'
+
+    def restart(self, request, queryset):
+        jobs = queryset.exclude(status=models.AgreementRelinkJob.FINISHED)
+        for job in jobs:
+            job.enqueue()
+        self.message_user(request, 'Перезапущено задач: {}'.format(len(jobs)))
+    restart.short_description = 'Перезапустить незавершённые'
+
+
+@admin.register(models.SessionAgreementAlert)
+class SessionAgreementAlertAdmin(admin.ModelAdmin):
+    list_display = ('session_link', 'date', 'cinema', 'film', 'dimension', 'is_original_language',
+                    'reason', 'is_notified', 'created')
+    list_filter = ('reason', 'is_notified', 'dimension')
+    list_select_related = ('cinema', 'film', 'dimension')
+    date_hierarchy = 'date'
+    search_fields = ('cinema__name', 'film__name')
+    raw_id_fields = ('session', 'cinema', 'film', 'dimension')
+    readonly_fields = ('session', 'reason', 'date', 'cinema', 'film', 'dimension',
+                       'is_original_language', 'is_notified')
+
+    def has_add_permission(self, request):
+        return False
+
+    def session_link(self, obj):
+        return format_html('<a href="{}">{}</a>', reverse(
+            'admin:common_session_change', args=(obj.session_id, )), obj.session_id)
+    session_link.short_description = 'Сеанс'
+
 
 @admin.register(models.ContactInformation)
 class ContactInformationAdmin(admin.ModelAdmin):
@@ -227,13 +297,14 @@ class ContactInformationAdmin(admin.ModelAdmin):
 
 @admin.register(models.XlsSessionsReport)
 class XlsSessionsReportAdmin(admin.ModelAdmin):
-    list_display = ('id', 'created', 'xls_filename')
+    list_display = ('id', 'created', 'xls_filename', 'status')
+    search_fields = ('xls_filename', 'content_hash')
 
 
 @admin.register(models.XlsReportsUpload)
 class XlsReportsUploadAdmin(admin.ModelAdmin):
     change_link_description = 'Просмотреть'
-    list_display = ('id', 'created', 'is_successful', 'city')
+    list_display = ('id', 'created', 'is_processing', 'is_successful', 'city')
 
     def has_add_permission(self, request):
         return False
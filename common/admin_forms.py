@@ -22,6 +22,7 @@ from users.models import User
 class UploadXLSReportsForm(forms.Form):
     xls_folder_path = MultipleFileField(label='Загрузить файлы')
     city = forms.ModelChoiceField(queryset=City.objects.all(), required=False, label='Город')
+    dry_run = forms.BooleanField(label='Только проверить файлы, без загрузки', required=False)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -115,7 +116,7 @@ class SessionAdminForm(forms.ModelForm):
             self.fields['cinema_hall'].queryset = CinemaHall.objects.filter(cinema=cinema)
 
             self.fields['film'].queryset = Film.objects.filter(
-                    agreements__in=cinema.get_agreements().filter_by_date(
+                    agreements__in=cinema.get_agreements().filter_by_day(
                         self.instance.date)).distinct()
 
         else:
@@ -2,7 +2,8 @@ from django.conf.urls import url, include
 
 from common.admin_views import CityAutocompleteView, ChainAutocompleteView, UploadXLSReportsView, \
     CinemaAutocompleteView, AllCinemasAutocompleteView, GeneralContractAutocompleteView, FilmAutocompleteView, \
-    UserAutocompleteView, BackupSystemView, TimeView, UnplanedBackupLoadView, BackupFileView, load_backup
+    UserAutocompleteView, BackupSystemView, TimeView, UnplanedBackupLoadView, BackupFileView, load_backup, \
+    ReportCacheStatsView
 from users.admin_views import ImportUsersView
 
 urlpatterns = [
@@ -50,6 +51,11 @@ urlpatterns = [
         UploadXLSReportsView.as_view(),
         name='upload_xls_reports',
     ),
+    url(
+        r'^report-cache-stats/$',
+        ReportCacheStatsView.as_view(),
+        name='report_cache_stats',
+    ),
     url(
         r'^import-users/$',
         ImportUsersView.as_view(),
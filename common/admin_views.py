@@ -4,8 +4,9 @@ import tempfile
 import datetime
 from braces.views import SuperuserRequiredMixin
 from dal import autocomplete
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, JsonResponse
 from django.urls import reverse
+from django.views import View
 from django.views.generic import FormView, ListView
 from django.db.models import Q
 from django.core.cache import cache
@@ -23,6 +24,8 @@ from smuggler.utils import save_uploaded_file_on_disk
 from django_celery_beat.models import PeriodicTask, CrontabSchedule
 
 from common.admin_forms import UploadXLSReportsForm, TimeForm
+from common.report_cache import ReportCache
+from common.xls_report_parsers import XlsDryRun
 from common.models import City, Chain, XlsSessionsReport, XlsReportsUpload, Cinema, Film, GeneralContract, TimeBackup, BackupFile
 from users.models import User
 from celery_tasks import app as celery_app, make_dump, async_mail_admins, load_dump
@@ -100,6 +103,12 @@ class UploadXLSReportsView(SuperuserRequiredMixin, FormView):
     template_name = 'admin/upload_xls_reports.html'
 
     def form_valid(self, form):
+        if form.cleaned_data['dry_run']:
+            dry_run = XlsDryRun(form.cleaned_data['xls_folder_path'],
+                                city=form.cleaned_data.get('city'))
+            return self.render_to_response(self.get_context_data(
+                    form=form, dry_run_report=dry_run.run()))
+
         report_upload = XlsReportsUpload.objects.create(city=form.cleaned_data.get('city'))
 
         for _file in form.cleaned_data['xls_folder_path']:
@@ -110,6 +119,13 @@ class UploadXLSReportsView(SuperuserRequiredMixin, FormView):
                 reverse('admin:common_xlsreportsupload_change', args=(report_upload.id, )))
 
 
+class ReportCacheStatsView(SuperuserRequiredMixin, View):
+    report_cache_names = ('main_report', 'monthly_report')
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(ReportCache.get_stats(self.report_cache_names))
+
+
 class BackupSystemView(SuperuserRequiredMixin, ListView):
     template_name = 'admin/common/backup/backup_page.html'
 
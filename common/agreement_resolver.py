@@ -0,0 +1,76 @@
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import date as date_type, timedelta
+
+from django.core.exceptions import MultipleObjectsReturned
+
+from common.models import AdditionalAgreement
+
+
+class AgreementResolver:
+    """In-memory index of a cinema's agreements for resolving agreements of sessions.
+
+    Agreements are loaded with one query and kept as intervals sorted by their lower
+    bounds per (film, dimension, is_original_language). Lookups follow
+    `AdditionalAgreementQuerySet.filter_by_date`: an agreement matches a date when its
+    range overlaps `[date - 1, date + 1)`.
+    """
+
+    def __init__(self, cinema, date_from=None, date_to=None):
+        self.cinema = cinema
+
+        agreements = AdditionalAgreement.objects.filter(cinema=cinema)
+        if date_from and date_to:
+            agreements = agreements.filter(active_date_range__overlap=[
+                date_from - timedelta(days=1), date_to + timedelta(days=1)])
+
+        intervals = defaultdict(list)
+        for agreement in agreements.select_related('film', 'dimension'):
+            key = (agreement.film_id, agreement.dimension_id, agreement.is_original_language)
+            date_range = agreement.active_date_range
+            if date_range.isempty:
+                continue
+            intervals[key].append((date_range.lower or date_type.min,
+                                   date_range.upper or date_type.max, agreement))
+
+        self.index = {}
+        for key, key_intervals in intervals.items():
+            key_intervals.sort(key=lambda interval: interval[:2])
+            max_uppers = []
+            for lower, upper, agreement in key_intervals:
+                max_uppers.append(max(upper, max_uppers[-1]) if max_uppers else upper)
+            self.index[key] = ([interval[0] for interval in key_intervals], max_uppers,
+                               key_intervals)
+
+    def filter(self, film, dimension, is_original_language, date):
+        """Agreements active on the date, the same as `filter_by_date(date).filter(...)`"""
+        key = (getattr(film, 'pk', film), getattr(dimension, 'pk', dimension),
+               is_original_language)
+        if key not in self.index:
+            return []
+
+        lowers, max_uppers, intervals = self.index[key]
+        matches = []
+        # lower < date + 1 and upper > date - 1, bounds are canonical [)
+        i = bisect_right(lowers, date) - 1
+        while i >= 0 and max_uppers[i] >= date:
+            lower, upper, agreement = intervals[i]
+            if upper >= date:
+                matches.append(agreement)
+            i -= 1
+        matches.reverse()
+        return matches
+
+    def exists(self, film, dimension, date, is_original_language=None):
+        if is_original_language is None:
+            return any(self.filter(film, dimension, language, date) for language in (True, False))
+        return bool(self.filter(film, dimension, is_original_language, date))
+
+    def get(self, film, dimension, is_original_language, date):
+        """Raises the same exceptions as `QuerySet.get`"""
+        matches = self.filter(film, dimension, is_original_language, date)
+        if not matches:
+            raise AdditionalAgreement.DoesNotExist
+        if len(matches) > 1:
+            raise MultipleObjectsReturned
+        return matches[0]
@@ -35,6 +35,26 @@ class CommonConfig(AppConfig):
                                 tzinfo=timezone.get_current_timezone())
             time_back.start = default_time
             time_back.save()
+
+        # moves the horizon of materialized daily report statuses
+        if not PeriodicTask.objects.filter(name='extend_cinema_day_statuses').exists():
+            CrontabSchedule = apps.get_model(app_label='django_celery_beat',
+                                             model_name='CrontabSchedule')
+            schedule, _ = CrontabSchedule.objects.get_or_create(
+                minute='5', hour='0', day_of_week='*', day_of_month='*', month_of_year='*')
+            PeriodicTask.objects.create(name='extend_cinema_day_statuses',
+                                        task='celery_tasks.extend_cinema_day_statuses',
+                                        crontab=schedule)
+
+        # mails sessions without agreements collected since the previous digest
+        if not PeriodicTask.objects.filter(name='send_agreement_alerts_digest').exists():
+            CrontabSchedule = apps.get_model(app_label='django_celery_beat',
+                                             model_name='CrontabSchedule')
+            schedule, _ = CrontabSchedule.objects.get_or_create(
+                minute='0', hour='*', day_of_week='*', day_of_month='*', month_of_year='*')
+            PeriodicTask.objects.create(name='send_agreement_alerts_digest',
+                                        task='celery_tasks.send_agreement_alerts_digest',
+                                        crontab=schedule)
             
 
 
@@ -147,6 +147,18 @@ class SessionFactory(StubbornFactory):
     def cinema_hall(self):
         return random.choice(ALL_CINEMA_HALLS)
 
+    @factory.lazy_attribute
+    def cinema(self):
+        return self.cinema_hall.cinema
+
+    @factory.lazy_attribute
+    def chain(self):
+        return self.cinema.chain
+
+    @factory.lazy_attribute
+    def city(self):
+        return self.cinema.city
+
     @factory.lazy_attribute
     def film(self):
         return random.choice(ALL_FILMS)
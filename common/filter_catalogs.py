@@ -0,0 +1,139 @@
+from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.timezone import now
+
+from common.models import AdditionalAgreement
+from common.report_cache import get_months, new_version
+
+VERSION_KEY = 'filter_catalog_version'
+
+
+def bump_catalog_version():
+    """Invalidates every month catalog, called on changes of agreements and their relations"""
+    transaction.on_commit(lambda: cache.set(VERSION_KEY, new_version(), None))
+
+
+def get_catalog_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        version = new_version()
+        cache.add(VERSION_KEY, version, None)
+    return version
+
+
+def overlaps(lower, upper, date_from, date_to):
+    """Same as `active_date_range__overlap=[date_from, date_to]` for canonical `[)` ranges"""
+    return (lower is None or lower < date_to) and (upper is None or date_from < upper)
+
+
+class FilterCatalog:
+    """Films, dimensions, cinemas and cities with active agreements, the options of report
+    filter forms.
+
+    Agreements are cached month by month together with the names of their relations, so
+    a form for any date range and any user is built from cache without database queries.
+    The user's scope is applied on top of the cached months using `User.cinema_access`.
+    """
+
+    AGREEMENT_FIELDS = ('cinema', 'film', 'dimension', 'active_date_range')
+    NAME_FIELDS = dict(
+        films=('film', 'film__name', 'film__created'),
+        dimensions=('dimension', 'dimension__name'),
+        cinemas=('cinema', 'cinema__name', 'cinema__city', 'cinema__chain'),
+        cities=('cinema__city', 'cinema__city__name'),
+        chains=('cinema__chain', 'cinema__chain__name'),
+    )
+
+    def __init__(self, user, date_from=None, date_to=None):
+        self.user = user
+        self.date_from = date_from
+        self.date_to = date_to
+        self._version = None
+        self._options = None
+
+    def get_key(self, name):
+        if self._version is None:
+            self._version = get_catalog_version()
+        return 'filter_catalog:{}:{}'.format(self._version, name)
+
+    def build_month(self, month):
+        agreements = AdditionalAgreement.objects.filter(
+            active_date_range__overlap=[month, month + relativedelta(months=1)])
+        catalog = dict(agreements=list(agreements.values_list(*self.AGREEMENT_FIELDS).distinct()))
+        for name, fields in self.NAME_FIELDS.items():
+            catalog[name] = {row[0]: row[1:] for row in
+                             agreements.values_list(*fields).distinct() if row[0] is not None}
+        return catalog
+
+    def get_first_date(self):
+        key = self.get_key('first_date')
+        first_date = cache.get(key)
+        if first_date is None:
+            first_agreement = AdditionalAgreement.objects.order_by('created').first()
+            first_date = first_agreement.created.date() if first_agreement else False
+            cache.set(key, first_date, settings.FILTER_CATALOG_CACHE_TIMEOUT)
+        return first_date
+
+    def get_months(self, date_from, date_to):
+        keys = {self.get_key(month.strftime('%Y-%m')): month
+                for month in get_months(date_from, date_to)}
+        catalogs = cache.get_many(keys.keys())
+        missing = {key: self.build_month(month) for key, month in keys.items()
+                   if key not in catalogs}
+        if missing:
+            cache.set_many(missing, settings.FILTER_CATALOG_CACHE_TIMEOUT)
+            catalogs.update(missing)
+        return catalogs.values()
+
+    def get_options(self):
+        if self._options is not None:
+            return self._options
+
+        self._options = options = {name: {} for name in self.NAME_FIELDS}
+        date_from = self.date_from or self.get_first_date()
+        if not date_from:
+            return options
+        date_to = self.date_to or now().date()
+
+        access = self.user.cinema_access
+        agreement_cinemas = access.report_cinema_ids
+        option_cinemas = access.access_to_reports_ids
+
+        for catalog in self.get_months(date_from, date_to):
+            for cinema_id, film_id, dimension_id, date_range in catalog['agreements']:
+                if agreement_cinemas is not None and cinema_id not in agreement_cinemas:
+                    continue
+                if not overlaps(date_range.lower, date_range.upper, date_from, date_to):
+                    continue
+
+                options['films'][film_id] = catalog['films'][film_id]
+                options['dimensions'][dimension_id] = catalog['dimensions'][dimension_id]
+                if option_cinemas is not None and cinema_id not in option_cinemas:
+                    continue
+
+                options['cinemas'][cinema_id] = catalog['cinemas'][cinema_id]
+                name, city_id, chain_id = catalog['cinemas'][cinema_id]
+                options['cities'][city_id] = catalog['cities'][city_id]
+                if chain_id is not None:
+                    options['chains'][chain_id] = catalog['chains'][chain_id]
+        return options
+
+    def get_choices(self, name):
+        """Choices ordered the same way as the option models"""
+        options = self.get_options()[name]
+        if name == 'films':
+            ordered = sorted(options.items(), key=lambda item: (item[1][1], item[0]))
+        else:
+            ordered = sorted(options.items(), key=lambda item: (item[1][0], item[0]))
+        return [(pk, values[0]) for pk, values in ordered]
+
+    def get_ids(self, name):
+        return list(self.get_options()[name])
+
+    def get_cinema_choices(self):
+        """Cinema names with the city, as shown in the monthly report"""
+        options = self.get_options()
+        return [(pk, '{} ({})'.format(name, options['cities'][options['cinemas'][pk][1]][0]))
+                for pk, name in self.get_choices('cinemas')]
@@ -6,10 +6,12 @@ from crispy_forms.layout import Layout, Submit
 from django import forms
 from django.conf import settings
 from django.contrib.postgres.forms.ranges import DateRangeField
-from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import Prefetch
+from django.db.models import Prefetch, prefetch_related_objects
+from django.utils.functional import cached_property
 from django.utils.timezone import now
 
+from common.agreement_resolver import AgreementResolver
+from common.filter_catalogs import FilterCatalog
 from common.models import Session, Film, CinemaHall, Dimension, Chain, City, Cinema, Feedback, \
     AdditionalAgreement, FinishedCinemaReportDate
 from kinomania.utils import MONTHS
@@ -97,36 +99,21 @@ class BaseFilterReportForm(forms.Form):
             if field_name not in not_filterable_fields:
                 self.fields[field_name].widget.attrs['filterable'] = 'filterable'
 
-        filtered_agreements = self.get_filtered_agreements()
-
-        filtered_films = Film.objects.filter(agreements__in=filtered_agreements)
-        self.fields['films'].queryset = filtered_films.distinct()
-
-        self.fields['dimensions'].queryset = Dimension.objects.filter(
-                agreements__in=filtered_agreements).distinct()
-
-        filtered_cinemas = self.user.all_report_cinemas.filter(
-                agreements__in=filtered_agreements)
-        self.fields['cinemas'].queryset = filtered_cinemas.select_related('city').distinct()
-
-        if self.fields.get('cities'):
-            self.fields['cities'].queryset = City.objects.filter(
-                cinemas__in=filtered_cinemas).distinct()
-
-    def get_filtered_agreements(self):
-
         date_range_from, date_range_to = self.get_date_range()
-
-        first_agreement = AdditionalAgreement.objects.order_by('created').first()
-
-        if not first_agreement:
-            return AdditionalAgreement.objects.none()
-
-        date_range_from = date_range_from or first_agreement.created.date()
-
-        date_range_to = date_range_to or now().date()
-        return self.user.all_agreements.filter(
-                active_date_range__overlap=[date_range_from, date_range_to])
+        self.catalog = FilterCatalog(self.user, date_range_from, date_range_to)
+
+        for field_name in ('films', 'dimensions', 'cinemas', 'cities', 'chains'):
+            if field_name in self.fields:
+                self.set_catalog_choices(field_name)
+
+    def set_catalog_choices(self, field_name):
+        """Options come from the cached catalog, the queryset is only used to clean values"""
+        field = self.fields[field_name]
+        field.queryset = field.queryset.model.objects.filter(pk__in=self.catalog.get_ids(field_name))
+        if field_name == 'cinemas':
+            field.choices = self.catalog.get_cinema_choices()
+        else:
+            field.choices = self.catalog.get_choices(field_name)
 
 
 class FilterByMonthForm(forms.Form):
@@ -188,23 +175,15 @@ class FilterMonthlyReportForm(FilterByMonthForm, BaseFilterReportForm):
                                      queryset=Cinema.objects.all(),
                                      widget=forms.RadioSelect(), required=False)
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.fields['films'].choices = [
-            (film.id, film.name) for film in self.fields['films'].queryset]
-        self.fields['cinemas'].choices = [
-            (c.id, '{} ({})'.format(c.name, c.city.name)) for c in self.fields['cinemas'].queryset]
-        self.fields['dimensions'].choices = [
-                (c.id, c.name) for c in self.fields['dimensions'].queryset]
-
     def get_values(self):
+        options = self.catalog.get_options()
         try:
             return dict(
                     month=MONTHS[int(self.data['month']) - 1],
-                    film=Film.objects.get(id=self.data['films']).name,
-                    cinema=Cinema.objects.get(id=self.data['cinemas']).name,
-                    dimension=Dimension.objects.get(id=self.data['dimensions']).name)
-        except (ValueError, TypeError, ObjectDoesNotExist, KeyError):
+                    film=options['films'][int(self.data['films'])][0],
+                    cinema=options['cinemas'][int(self.data['cinemas'])][0],
+                    dimension=options['dimensions'][int(self.data['dimensions'])][0])
+        except (ValueError, TypeError, KeyError):
             return {}
 
 
@@ -233,9 +212,6 @@ class FilterReportForm(BaseFilterReportForm):
 
         if not self.user.is_superuser or not self.user.view_all_reports:
             self.fields.pop('chains')
-        else:
-            self.fields['chains'].queryset = Chain.objects.filter(
-                  cinemas__in=self.fields['cinemas'].queryset).distinct()
 
     def get_date_range(self):
         date_from = self.data.get('date_range_0')
@@ -258,6 +234,70 @@ class FilterReportForm(BaseFilterReportForm):
         return date_from, date_to
 
 
+class PreloadedModelChoiceField(forms.ModelChoiceField):
+    """Takes the selected object from `get_objects()`, a dict by pk, instead of a query"""
+
+    get_objects = None
+
+    def to_python(self, value):
+        if self.get_objects is None or value in self.empty_values:
+            return super().to_python(value)
+        try:
+            return self.get_objects()[int(value)]
+        except (KeyError, ValueError, TypeError):
+            raise forms.ValidationError(self.error_messages['invalid_choice'],
+                                        code='invalid_choice')
+
+
+class SessionValidationContext:
+    """Everything a submitted session of the cinema and date is validated against.
+
+    Loaded with a fixed number of queries on the first access, so every rule of
+    `SessionForm` and `Session.clean` is checked in memory.
+    """
+
+    def __init__(self, cinema, date, session=None):
+        self.cinema = cinema
+        self.date = date
+        self.session = session
+
+    @cached_property
+    def options(self):
+        """Films and dimensions selectable on the date, the same as the options of the form"""
+        films = {}
+        dimensions = {}
+        for agreement in self.cinema.get_agreements().filter_by_day(self.date).select_related(
+                'film', 'dimension'):
+            films.setdefault(agreement.film_id, agreement.film)
+            dimensions.setdefault(agreement.dimension_id, agreement.dimension)
+        # `Session.clean` checks the dimension against all dimensions of the film
+        prefetch_related_objects(list(films.values()), 'dimensions')
+        return dict(films=films, dimensions=dimensions)
+
+    @property
+    def films(self):
+        return self.options['films']
+
+    @property
+    def dimensions(self):
+        return self.options['dimensions']
+
+    @cached_property
+    def halls(self):
+        return CinemaHall.objects.filter(cinema=self.cinema).in_bulk()
+
+    @cached_property
+    def agreements(self):
+        return AgreementResolver(self.cinema, self.date, self.date)
+
+    @cached_property
+    def session_times(self):
+        sessions = Session.objects.filter(cinema=self.cinema, date=self.date)
+        if self.session and self.session.pk:
+            sessions = sessions.exclude(pk=self.session.pk)
+        return set(sessions.values_list('cinema_hall', 'time'))
+
+
 class SessionForm(forms.ModelForm):
 
     time = forms.TimeField(required=False)
@@ -285,6 +325,11 @@ class SessionForm(forms.ModelForm):
             'gross_yield',
             'is_original_language',
         )
+        field_classes = {
+            'film': PreloadedModelChoiceField,
+            'dimension': PreloadedModelChoiceField,
+            'cinema_hall': PreloadedModelChoiceField,
+        }
         widgets = {
             'dimension': forms.RadioSelect(),
             'time': forms.HiddenInput(),
@@ -298,6 +343,7 @@ class SessionForm(forms.ModelForm):
         self.form_action = kwargs.pop('form_action')
         self.view_name = kwargs.pop('view_name')
         self.create_session_url = kwargs.pop('create_session_url')
+        agreement_options = kwargs.pop('agreement_options', None)
 
         super().__init__(*args, **kwargs)
 
@@ -308,11 +354,22 @@ class SessionForm(forms.ModelForm):
             if field_name not in ('dimension', 'is_original_language'):
                 field.widget.attrs['class'] = 'form-control'
 
-        current_cinemas_agreements = self.cinema.get_agreements().filter_by_date(self.date)
-        self.fields['film'].queryset = self.get_initial_films(current_cinemas_agreements)
-        self.fields['cinema_hall'].queryset = CinemaHall.objects.filter(cinema=self.cinema)
-        self.fields['dimension'].queryset = Dimension.objects.filter(
-                agreements__in=current_cinemas_agreements).distinct()
+        # options are rendered from lists which can be shared by all forms of the page,
+        # submitted objects are taken from the validation context below
+        if agreement_options is None:
+            agreement_options = self.get_agreement_options(self.cinema, self.date)
+        self.films = agreement_options['films']
+        for field_name, objects in (('film', self.films),
+                                    ('cinema_hall', agreement_options['cinema_hall']),
+                                    ('dimension', agreement_options['dimension'])):
+            field = self.fields[field_name]
+            field.choices = ([] if field.empty_label is None else [('', field.empty_label)]) + [
+                (obj.pk, field.label_from_instance(obj)) for obj in objects]
+
+        self.validation_context = SessionValidationContext(self.cinema, self.date, self.instance)
+        self.fields['film'].get_objects = lambda: self.validation_context.films
+        self.fields['dimension'].get_objects = lambda: self.validation_context.dimensions
+        self.fields['cinema_hall'].get_objects = lambda: self.validation_context.halls
 
         if self.instance.pk:
             session_time = self.instance.time
@@ -323,8 +380,17 @@ class SessionForm(forms.ModelForm):
         if self.view_name != 'send_update_session_request':
             del self.fields['update_request_comment']
 
-    def get_initial_films(self, agreements):
+    @classmethod
+    def get_agreement_options(cls, cinema, date):
+        agreements = cinema.get_agreements().filter_by_day(date)
+        return dict(
+            films=list(cls.get_initial_films(agreements)),
+            dimension=list(Dimension.objects.filter(agreements__in=agreements).distinct()),
+            cinema_hall=list(CinemaHall.objects.filter(cinema=cinema)),
+        )
 
+    @staticmethod
+    def get_initial_films(agreements):
         return Film.objects.filter(agreements__in=agreements).prefetch_related(
                 Prefetch(
                     'dimensions',
@@ -394,22 +460,20 @@ class SessionForm(forms.ModelForm):
         is_original_language = self.cleaned_data.get('is_original_language')
 
         if film and dimension and cinema_hall:
-            filtered_agreements = film.agreements.filter_by_date(self.date).filter(
-                    dimension=dimension, cinema=cinema_hall.cinema)
+            agreements = self.validation_context.agreements
 
-            if not filtered_agreements.exists():
+            if not agreements.exists(film, dimension, self.date):
                 raise forms.ValidationError(
                     'На формат "{}" нет дополнительного соглашения для фильма "{}".'.format(
                             dimension.name, film.name))
 
             if is_original_language is not None:
-                if not filtered_agreements.filter(
-                        is_original_language=is_original_language).exists():
+                if not agreements.exists(film, dimension, self.date, is_original_language):
                     raise forms.ValidationError('У фильма нет активного дополнительного соглашения '
                                                 'на выбранный формат c этим языком')
 
-        if cinema_hall and time and Session.objects.filter(
-                cinema_hall=cinema_hall, time=time, date=self.date).exclude(id=self.instance.pk):
+        if cinema_hall and time and \
+                (cinema_hall.pk, time) in self.validation_context.session_times:
             raise forms.ValidationError('Сеанс с такой датой, временем и кинозалом уже существует.')
 
         if cinema_hall:
@@ -440,6 +504,22 @@ class SessionForm(forms.ModelForm):
 
         return cleaned_data
 
+    def _get_validation_exclusions(self):
+        # related objects were taken from the validation context, so they exist
+        return super()._get_validation_exclusions() + ['film', 'dimension', 'cinema_hall']
+
+    def get_agreement_resolver(self):
+        """The resolver loaded for validation if it covers the session's date"""
+        if self.instance.date == self.date:
+            return self.validation_context.agreements
+
+    def save(self, commit=True):
+        session = super().save(commit=False)
+        if commit:
+            session.save(agreement_resolver=self.get_agreement_resolver())
+            self._save_m2m()
+        return session
+
 
 class CreateFeedbackForm(forms.ModelForm):
     class Meta:
@@ -483,24 +563,62 @@ class ChangeSessionsDateForm(forms.Form):
                 cinema=self.cinema, date=change_date_to).exists():
             raise forms.ValidationError('За выбранную дату уже сдан отчёт для этого кинотеатра.')
 
-        for session in Session.objects.filter(cinema_hall__cinema=self.cinema, date=change_date_to):
-            if Session.objects.filter(
-                    cinema_hall=session.cinema_hall,
-                    time=session.time,
-                    date=self.change_date_from,
-                    dimension=session.dimension).exists():
-                raise forms.ValidationError(
-                    'Сеанс "{film_name} {dimension}" ({time}) в зале "{cinema_hall}" '
-                    'уже существует для {date}'.format(
-                        film_name=session.film.name,
-                        cinema_hall=session.cinema_hall,
-                        dimension=session.dimension,
-                        time=session.time,
-                        date=change_date_to))
+        sessions = Session.objects.filter(
+                cinema=self.cinema, date__in=[self.change_date_from, change_date_to]).values_list(
+                'date', 'cinema_hall', 'time', 'dimension', 'film__name', 'cinema_hall__name',
+                'dimension__name')
+        moved_sessions = {session[1:4] for session in sessions
+                          if session[0] == self.change_date_from}
+        conflicts = [session for session in sessions
+                     if session[0] == change_date_to and session[1:4] in moved_sessions]
+        if conflicts:
+            raise forms.ValidationError([forms.ValidationError(
+                'Сеанс "{film_name} {dimension}" ({time}) в зале "{cinema_hall}" '
+                'уже существует для {date}'.format(
+                    film_name=film_name,
+                    cinema_hall=cinema_hall_name,
+                    dimension=dimension_name,
+                    time=time,
+                    date=change_date_to))
+                for date, cinema_hall, time, dimension, film_name, cinema_hall_name, dimension_name
+                in conflicts])
 
         return change_date_to
 
 
+class CopySessionsForm(forms.Form):
+    MAX_DAYS = 31
+
+    source_date_from = forms.DateField(label='Скопировать с', required=False)
+    source_date_to = forms.DateField(label='по', required=False)
+
+    def __init__(self, *args, **kwargs):
+        self.date = kwargs.pop('date')
+        super().__init__(*args, **kwargs)
+        for field in self.fields.values():
+            field.widget.attrs['class'] = 'form-control'
+
+    def clean(self):
+        cleaned_data = super().clean()
+        yesterday = self.date - timedelta(days=1)
+        source_date_from = cleaned_data.get('source_date_from') or yesterday
+        source_date_to = cleaned_data.get('source_date_to') or source_date_from
+
+        if source_date_from > source_date_to:
+            raise forms.ValidationError('Начальная дата периода больше конечной.')
+
+        if source_date_to >= self.date:
+            raise forms.ValidationError('Можно скопировать только сеансы за прошедшие дни.')
+
+        if (source_date_to - source_date_from).days >= self.MAX_DAYS:
+            raise forms.ValidationError(
+                    'Можно скопировать не больше {} дней.'.format(self.MAX_DAYS))
+
+        cleaned_data['source_date_from'] = source_date_from
+        cleaned_data['source_date_to'] = source_date_to
+        return cleaned_data
+
+
 class SendMonthlyReportEmailForm(FilterByMonthForm):
     cinema = forms.ModelChoiceField(queryset=Cinema.objects.all())
 
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from common.models import Cinema, Session, SessionDailyRollup
+
+
+class Command(BaseCommand):
+    help = 'Fills denormalized cinema, chain and city of sessions and their rollups cinema by cinema'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--only-missing', action='store_true',
+                            help='Skip sessions which already have a cinema')
+
+    def handle(self, *args, **options):
+        for cinema in Cinema.objects.order_by('pk'):
+            location = dict(cinema=cinema, chain=cinema.chain, city=cinema.city)
+            for model in (Session, SessionDailyRollup):
+                qs = model.objects.filter(cinema_hall__cinema=cinema)
+                if options['only_missing']:
+                    qs = qs.filter(cinema__isnull=True)
+                updated = qs.update(**location)
+                self.stdout.write('{}: {} {} rows'.format(cinema, updated, model.__name__))
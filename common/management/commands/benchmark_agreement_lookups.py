@@ -0,0 +1,70 @@
+import random
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils.timezone import now
+
+from common.models import AdditionalAgreement, Session
+
+
+class Command(BaseCommand):
+    help = 'Times date-filtered agreement lookups with and without the GiST indexes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--days', type=int, default=365,
+                            help='Lookups use random dates of that many last days')
+
+    def get_lookups(self, count, days):
+        today = now().date()
+        sessions = list(Session.objects.filter(
+            date__gte=today - timedelta(days=days)).order_by('?').values_list(
+            'cinema', 'film', 'dimension', 'is_original_language', 'date')[:count])
+        if not sessions:
+            dates = [today - timedelta(days=random.randrange(days)) for i in range(count)]
+            sessions = [(None, None, None, None, date) for date in dates]
+        return sessions
+
+    def run_lookups(self, lookups):
+        started = time.perf_counter()
+        for cinema, film, dimension, is_original_language, date in lookups:
+            list(AdditionalAgreement.objects.filter_by_date(date).values_list('pk'))
+            if cinema:
+                list(AdditionalAgreement.objects.filter_by_date(date).filter(
+                    cinema=cinema, film=film, dimension=dimension,
+                    is_original_language=is_original_language).values_list('pk'))
+        return time.perf_counter() - started
+
+    def explain(self, lookup):
+        cinema, film, dimension, is_original_language, date = lookup
+        queryset = AdditionalAgreement.objects.filter_by_date(date)
+        if cinema:
+            queryset = queryset.filter(cinema=cinema, film=film, dimension=dimension,
+                                       is_original_language=is_original_language)
+        sql, params = queryset.values('pk').query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN ANALYZE ' + sql, params)
+            return '\n'.join(row[0] for row in cursor.fetchall())
+
+    def handle(self, *args, **options):
+        lookups = self.get_lookups(options['queries'], options['days'])
+        self.stdout.write('{} agreements, {} lookups'.format(
+            AdditionalAgreement.objects.count(), len(lookups)))
+
+        results = {}
+        for name, use_indexes in (('GiST indexes', True), ('sequential scans', False)):
+            with transaction.atomic():
+                if not use_indexes:
+                    with connection.cursor() as cursor:
+                        cursor.execute('SET LOCAL enable_indexscan = off')
+                        cursor.execute('SET LOCAL enable_bitmapscan = off')
+                self.run_lookups(lookups[:10])  # warm up
+                results[name] = self.run_lookups(lookups)
+                self.stdout.write('{}: {:.3f}s\n{}'.format(
+                    name, results[name], self.explain(lookups[0])))
+
+        if results['GiST indexes']:
+            self.stdout.write('Speedup: {:.1f}x'.format(
+                results['sequential scans'] / results['GiST indexes']))
@@ -0,0 +1,55 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from common.models import City
+from common.xls_readers import READERS
+from common.xls_report_parsers import XlsDryRun
+
+
+class Command(BaseCommand):
+    help = 'Checks XLS reports against the database without importing them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='Report files or folders with them')
+        parser.add_argument('--city', type=int, help='Id of the city of the cinemas')
+
+    def get_files(self, paths):
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                files.extend(sorted(
+                    os.path.join(path, name) for name in os.listdir(path)
+                    if os.path.splitext(name)[1].lower() in READERS))
+            elif os.path.isfile(path):
+                files.append(path)
+            else:
+                raise CommandError('{} does not exist'.format(path))
+        return files
+
+    def handle(self, *args, **options):
+        city = None
+        if options['city']:
+            try:
+                city = City.objects.get(pk=options['city'])
+            except City.DoesNotExist:
+                raise CommandError('City {} does not exist'.format(options['city']))
+
+        started = time.perf_counter()
+        report = XlsDryRun(self.get_files(options['paths']), city=city).run()
+
+        for xls_file in report['files']:
+            if xls_file['skipped']:
+                self.stdout.write('{}: {}'.format(xls_file['name'], xls_file['skipped']))
+            else:
+                self.stdout.write('{}: {} sessions, {} errors'.format(
+                    xls_file['name'], xls_file['sessions_count'], xls_file['errors_count']))
+
+        for error, file_names in report['errors']:
+            self.stdout.write('')
+            self.stdout.write(self.style.ERROR(error))
+            self.stdout.write('  {} files: {}'.format(len(file_names), ', '.join(file_names)))
+
+        self.stdout.write('\n{} files checked in {:.1f}s'.format(
+            len(report['files']), time.perf_counter() - started))
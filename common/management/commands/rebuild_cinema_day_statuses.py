@@ -0,0 +1,41 @@
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Min
+
+from common.models import AdditionalAgreement, AgreementDay, CinemaDayStatus, \
+    FinishedCinemaReportDate
+
+
+class Command(BaseCommand):
+    help = 'Recomputes AgreementDay and CinemaDayStatus from agreements and finished report dates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date-from', help='Format: {}'.format(settings.DATE_URL_INPUT_FORMAT))
+        parser.add_argument('--date-to', help='Format: {}'.format(settings.DATE_URL_INPUT_FORMAT))
+
+    def parse_date(self, value):
+        return datetime.strptime(value, settings.DATE_URL_INPUT_FORMAT).date() if value else None
+
+    def handle(self, *args, **options):
+        date_from = self.parse_date(options['date_from'])
+        if not date_from:
+            # ranges are ordered by their lower bounds
+            first_range = AdditionalAgreement.objects.order_by('active_date_range').values_list(
+                    'active_date_range', flat=True).first()
+            first_dates = [
+                first_range and first_range.lower,
+                FinishedCinemaReportDate.objects.aggregate(date=Min('date'))['date'],
+            ]
+            first_dates = [d for d in first_dates if d]
+            if not first_dates:
+                self.stdout.write('No agreements found')
+                return
+            date_from = min(first_dates)
+
+        date_to = self.parse_date(options['date_to'])
+        AgreementDay.objects.refresh(date_from, date_to)
+        CinemaDayStatus.objects.refresh(date_from, date_to)
+        self.stdout.write('{} agreement days, {} statuses'.format(
+            AgreementDay.objects.count(), CinemaDayStatus.objects.count()))
@@ -0,0 +1,37 @@
+from datetime import datetime
+
+from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Min
+
+from common.models import Session, SessionDailyRollup
+
+
+class Command(BaseCommand):
+    help = 'Re-aggregates SessionDailyRollup from the Session table month by month'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date-from', help='Format: {}'.format(settings.DATE_URL_INPUT_FORMAT))
+        parser.add_argument('--date-to', help='Format: {}'.format(settings.DATE_URL_INPUT_FORMAT))
+
+    def parse_date(self, value):
+        return datetime.strptime(value, settings.DATE_URL_INPUT_FORMAT).date() if value else None
+
+    def handle(self, *args, **options):
+        dates = Session.objects.aggregate(date_from=Min('date'), date_to=Max('date'))
+        date_from = self.parse_date(options['date_from']) or dates['date_from']
+        date_to = self.parse_date(options['date_to']) or dates['date_to']
+
+        if not date_from or not date_to:
+            self.stdout.write('No sessions found')
+            return
+
+        month_from = date_from.replace(day=1)
+        while month_from <= date_to:
+            month_to = min(month_from + relativedelta(months=1, days=-1), date_to)
+            rollups = SessionDailyRollup.objects.refresh(
+                    date__range=[max(month_from, date_from), month_to])
+            self.stdout.write('{}: {} rollup rows'.format(month_from.strftime('%m.%Y'),
+                                                          len(rollups)))
+            month_from += relativedelta(months=1)
@@ -1,28 +1,32 @@
 from datetime import timedelta
 
+from django.conf import settings
+from django.core.mail import mail_admins
+from django.db import connection
 from django.db import models
+from django.db import transaction
 from django.db.models import Case, NullBooleanField
+from django.db.models import Count, Max, Min
 from django.db.models import Q
-from django.db.models import Value
+from django.db.models import Sum
 from django.db.models import When
+from django.urls import reverse
+from django.utils.timezone import now
 
 
 class CinemaQuerySet(models.QuerySet):
     def annotate_finished_by_date(self, date):
-        from common.models import AdditionalAgreement
-        from common.models import FinishedCinemaReportDate
+        from common.models import CinemaDayStatus
 
-        finished_cinemas_ids = FinishedCinemaReportDate.objects.filter(
-                date=date).values_list('cinema_id', flat=True)
-
-        active_agreements_ids = AdditionalAgreement.objects.filter_by_date(
-                date).values_list('cinema', flat=True)
+        day_statuses = CinemaDayStatus.objects.filter(date=date)
 
         return self.annotate(
             is_daily_report_finished=Case(
-                When(id__in=finished_cinemas_ids, then=True),
-                When(~Q(id__in=active_agreements_ids), then=None),
-                default=Value(False),
+                When(id__in=day_statuses.filter(is_daily_report_finished=True).values('cinema'),
+                     then=True),
+                When(id__in=day_statuses.filter(is_daily_report_finished=False).values('cinema'),
+                     then=False),
+                default=None,
                 output_field=NullBooleanField()))
 
 
@@ -39,6 +43,16 @@ class AdditionalAgreementQuerySet(models.QuerySet):
     def filter_by_date(self, date):
         return self.filter(active_date_range__overlap=[date - timedelta(1), date + timedelta(1)])
 
+    def filter_by_day(self, date):
+        """Same as `filter_by_date` with an equality join on `AgreementDay`.
+        Open ranges are materialized up to CINEMA_DAY_STATUS_DAYS_AHEAD days from today only,
+        later dates are looked up with `filter_by_date`.
+        """
+        # the horizon day itself is added by a daily task, which may not have run yet
+        if date >= get_materialized_horizon():
+            return self.filter_by_date(date)
+        return self.filter(days__date=date)
+
 
 class AdditionalAgreementManager(models.Manager):
 
@@ -47,3 +61,248 @@ class AdditionalAgreementManager(models.Manager):
 
     def filter_by_date(self, date):
         return self.get_queryset().filter_by_date(date)
+
+    def filter_by_day(self, date):
+        return self.get_queryset().filter_by_day(date)
+
+
+class SessionDailyRollupManager(models.Manager):
+    """Keeps `SessionDailyRollup` in sync with the `Session` table.
+
+    Rollup rows are grouped by KEY_FIELDS, so any lookups that only touch key fields
+    (or relations of them, e.g. `cinema__chain`) select the same partition on both
+    tables and the partition can be re-aggregated independently of the rest of the table.
+    """
+
+    KEY_FIELDS = ('date', 'week', 'month', 'cinema_hall', 'cinema', 'chain', 'city', 'film',
+                  'dimension', 'vat', 'is_original_language', 'is_daily_report_finished')
+
+    def aggregate_sessions(self, **lookups):
+        from common.models import Session
+
+        rows = Session.objects.filter(**lookups).values(*self.KEY_FIELDS).annotate(
+            rollup_sessions_count=Count('id'),
+            rollup_viewers_count=Sum('viewers_count'),
+            rollup_invitations_count=Sum('invitations_count'),
+            rollup_seats_count=Sum('cinema_hall__seats_count'),
+            rollup_gross_yield=Sum('gross_yield'),
+            rollup_gross_yield_without_vat=Sum('gross_yield_without_vat'),
+        ).order_by()
+
+        for row in rows:
+            yield self.model(
+                cinema_hall_id=row.pop('cinema_hall'),
+                cinema_id=row.pop('cinema'),
+                chain_id=row.pop('chain'),
+                city_id=row.pop('city'),
+                film_id=row.pop('film'),
+                dimension_id=row.pop('dimension'),
+                **{k.replace('rollup_', ''): v for k, v in row.items()})
+
+    def invalidate(self, **lookups):
+        """Invalidates cached reports built from rollup rows matching `lookups`"""
+        from common.report_cache import bump_report_versions
+
+        cinema_months = set(self.filter(**lookups).values_list('cinema', 'month').distinct())
+        if cinema_months:
+            transaction.on_commit(lambda: bump_report_versions(cinema_months))
+
+    def lock_partitions(self, **lookups):
+        """Locks halls of the partitions matching `lookups` till the end of the transaction.
+
+        Otherwise two transactions refreshing the same partition could both delete its rows
+        and then both insert them, the second insert failing on the unique key.
+        """
+        from common.models import CinemaHall, Session
+
+        list(CinemaHall.objects.filter(
+            Q(pk__in=Session.objects.filter(**lookups).values('cinema_hall')) |
+            Q(pk__in=self.filter(**lookups).values('cinema_hall'))).order_by(
+            'pk').select_for_update().values_list('pk', flat=True))
+
+    @transaction.atomic
+    def refresh(self, **lookups):
+        """Re-aggregates rollup rows of sessions matching `lookups`"""
+        self.lock_partitions(**lookups)
+        self.invalidate(**lookups)
+        self.filter(**lookups).delete()
+        rollups = self.bulk_create(self.aggregate_sessions(**lookups), batch_size=1000)
+        self.invalidate(**lookups)
+        return rollups
+
+    def refresh_for_session(self, session):
+        return self.refresh(cinema_hall_id=session.cinema_hall_id, date=session.date,
+                            film_id=session.film_id)
+
+
+def get_materialized_horizon():
+    """Last date open agreement ranges and daily report statuses are materialized for"""
+    return now().date() + timedelta(days=settings.CINEMA_DAY_STATUS_DAYS_AHEAD)
+
+
+class AgreementDayManager(models.Manager):
+    """Keeps `AgreementDay` in sync with agreement ranges"""
+
+    INSERT_SQL = """
+        INSERT INTO common_agreementday
+            (agreement_id, date, cinema_id, film_id, dimension_id, is_original_language)
+        SELECT a.id, day::date, a.cinema_id, a.film_id, a.dimension_id, a.is_original_language
+        FROM common_additionalagreement a,
+            generate_series(GREATEST(lower(a.active_date_range), %(date_from)s::date),
+                            LEAST(upper(a.active_date_range), %(date_to)s::date),
+                            '1 day') AS day
+        WHERE NOT isempty(a.active_date_range)
+            AND a.active_date_range && daterange(%(date_from)s::date - 1, %(date_to)s::date + 1)
+            AND (%(all_agreements)s OR a.id = ANY(%(agreement_ids)s))
+        ON CONFLICT (agreement_id, date) DO NOTHING
+    """
+
+    def insert_days(self, date_from, date_to, agreement_ids=None):
+        params = dict(date_from=date_from, date_to=date_to, all_agreements=agreement_ids is None,
+                      agreement_ids=list(agreement_ids or []))
+        with connection.cursor() as cursor:
+            cursor.execute(self.INSERT_SQL, params)
+
+    @transaction.atomic
+    def refresh(self, date_from, date_to=None, agreement_ids=None):
+        """Recomputes days of the given agreements in the date range, `None` means all"""
+        date_to = date_to or get_materialized_horizon()
+        days = self.filter(date__range=[date_from, date_to])
+        if agreement_ids is not None:
+            days = days.filter(agreement_id__in=agreement_ids)
+        days.delete()
+        self.insert_days(date_from, date_to, agreement_ids)
+
+    @transaction.atomic
+    def refresh_for_agreement(self, agreement):
+        """Drops days the agreement is no longer active on and adds the new ones"""
+        date_range = agreement.active_date_range
+        if not date_range or date_range.isempty:
+            self.filter(agreement=agreement).delete()
+            return
+
+        # agreements can't be active before the release of the film
+        date_from = date_range.lower or agreement.film.release_date
+        date_to = date_range.upper or get_materialized_horizon()
+        self.filter(agreement=agreement).exclude(
+            date__range=[date_from, date_to], cinema_id=agreement.cinema_id,
+            film_id=agreement.film_id, dimension_id=agreement.dimension_id,
+            is_original_language=agreement.is_original_language).delete()
+        self.insert_days(date_from, date_to, [agreement.pk])
+
+
+class CinemaDayStatusManager(models.Manager):
+    """Keeps `CinemaDayStatus` in sync with agreements and finished report dates"""
+
+    REFRESH_SQL = """
+        WITH active AS (
+            SELECT DISTINCT d.cinema_id, d.date AS day
+            FROM common_agreementday d
+            WHERE d.date BETWEEN %(date_from)s AND %(date_to)s
+                AND d.cinema_id IS NOT NULL
+                AND (%(all_cinemas)s OR d.cinema_id = ANY(%(cinema_ids)s))
+        ), finished AS (
+            SELECT f.cinema_id, f.date AS day
+            FROM common_finishedcinemareportdate f
+            WHERE f.date BETWEEN %(date_from)s AND %(date_to)s
+                AND (%(all_cinemas)s OR f.cinema_id = ANY(%(cinema_ids)s))
+        )
+        INSERT INTO common_cinemadaystatus (cinema_id, date, is_daily_report_finished)
+        SELECT cinema_id, day, finished.cinema_id IS NOT NULL
+        FROM active
+        FULL JOIN finished USING (cinema_id, day)
+    """
+
+    @transaction.atomic
+    def refresh(self, date_from, date_to=None, cinema_ids=None):
+        """Recomputes statuses of the dates for the given cinemas, `None` means all cinemas.
+
+        Open ranges are materialized up to CINEMA_DAY_STATUS_DAYS_AHEAD days from today,
+        the `extend_cinema_day_statuses` task moves that horizon every day.
+        Active agreements are taken from `AgreementDay`, which has to be refreshed first.
+        """
+        if date_to is None:
+            date_to = get_materialized_horizon()
+
+        statuses = self.filter(date__range=[date_from, date_to])
+        if cinema_ids is not None:
+            cinema_ids = list(cinema_ids)
+            statuses = statuses.filter(cinema_id__in=cinema_ids)
+        statuses.delete()
+
+        params = dict(date_from=date_from, date_to=date_to, all_cinemas=cinema_ids is None,
+                      cinema_ids=cinema_ids or [])
+        with connection.cursor() as cursor:
+            cursor.execute(self.REFRESH_SQL, params)
+
+    def refresh_for_agreement(self, agreement, date_range=None):
+        date_range = date_range or agreement.active_date_range
+        if date_range and not date_range.isempty:
+            # a status of the date depends on agreements active on it or a day before,
+            # agreements can't be active before the release of the film
+            self.refresh(date_range.lower or agreement.film.release_date, date_range.upper,
+                         cinema_ids=[agreement.cinema_id])
+
+    def get_calendar(self, cinema_ids, date_from, date_to):
+        """Number of missing reports by date. Dates without any required report are omitted"""
+        qs = self.filter(date__range=[date_from, date_to])
+        if cinema_ids is not None:
+            qs = qs.filter(cinema_id__in=cinema_ids)
+
+        return dict(qs.values_list('date').annotate(unfinished_count=Count(Case(
+            When(is_daily_report_finished=False, then=1)))).order_by())
+
+
+class SessionAgreementAlertManager(models.Manager):
+    """Collects sessions without an agreement and mails them to admins in digests"""
+
+    DIGEST_FIELDS = ('reason', 'cinema__name', 'film__name', 'dimension__name',
+                     'is_original_language')
+
+    @transaction.atomic
+    def record(self, alerts):
+        """Replaces alerts of the sessions, `alerts` are (session, reason) pairs"""
+        self.resolve([session.pk for session, reason in alerts])
+        return self.bulk_create([self.model(
+            session=session, reason=reason, date=session.date, cinema_id=session.cinema_id,
+            film_id=session.film_id, dimension_id=session.dimension_id,
+            is_original_language=session.is_original_language) for session, reason in alerts])
+
+    def resolve(self, session_ids):
+        """Removes alerts of sessions which have an agreement now"""
+        self.filter(session_id__in=session_ids).delete()
+
+    def get_digest_rows(self, alerts):
+        return alerts.values(*self.DIGEST_FIELDS).annotate(
+            sessions_count=Count('id'), date_from=Min('date'),
+            date_to=Max('date')).order_by(*self.DIGEST_FIELDS)
+
+    @transaction.atomic
+    def send_digest(self):
+        """Mails alerts recorded since the previous digest, returns their number"""
+        from kinomania.utils import build_full_url
+
+        alerts = self.filter(pk__in=list(self.select_for_update().filter(
+            is_notified=False).values_list('pk', flat=True)))
+        rows = list(self.get_digest_rows(alerts))
+        if not rows:
+            return 0
+
+        reasons = dict(self.model.REASON_CHOICES)
+        lines = ['{reason}: {cinema} / {film} / {dimension}{language}, сеансов: {count} '
+                 '({date_from:%d.%m.%Y} - {date_to:%d.%m.%Y})'.format(
+                     reason=reasons[row['reason']], cinema=row['cinema__name'],
+                     film=row['film__name'], dimension=row['dimension__name'],
+                     language=' (ориг. язык)' if row['is_original_language'] else '',
+                     count=row['sessions_count'], date_from=row['date_from'],
+                     date_to=row['date_to'])
+                 for row in rows]
+        sessions_count = sum(row['sessions_count'] for row in rows)
+
+        mail_admins(
+            subject='Для {} сеансов невозможно выбрать доп. соглашение'.format(sessions_count),
+            message='Невозможно автоматически выбрать доп. соглашение для сеансов:\n{}\n\n'
+                    'Список сеансов: {}'.format('\n'.join(lines), build_full_url(reverse(
+                        'admin:common_sessionagreementalert_changelist'))))
+        alerts.update(is_notified=True)
+        return sessions_count
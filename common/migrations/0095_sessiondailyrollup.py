@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+FILL_ROLLUP_SQL = """
+INSERT INTO common_sessiondailyrollup (
+    date, week, month, cinema_hall_id, film_id, dimension_id, vat, is_original_language,
+    is_daily_report_finished, sessions_count, viewers_count, invitations_count, seats_count,
+    gross_yield, gross_yield_without_vat)
+SELECT
+    s.date, s.week, s.month, s.cinema_hall_id, s.film_id, s.dimension_id, s.vat,
+    s.is_original_language, s.is_daily_report_finished, COUNT(s.id), SUM(s.viewers_count),
+    SUM(s.invitations_count), SUM(h.seats_count), SUM(s.gross_yield),
+    SUM(s.gross_yield_without_vat)
+FROM common_session s
+JOIN common_cinemahall h ON h.id = s.cinema_hall_id
+GROUP BY s.date, s.week, s.month, s.cinema_hall_id, s.film_id, s.dimension_id, s.vat,
+         s.is_original_language, s.is_daily_report_finished;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common', '0094_auto_20180726_0623'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SessionDailyRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(db_index=True, verbose_name='Дата')),
+                ('week', models.DateField(blank=True, null=True)),
+                ('month', models.DateField(blank=True, null=True)),
+                ('vat', models.BooleanField(default=False, verbose_name='НДС')),
+                ('is_original_language', models.BooleanField(default=False, verbose_name='Ориг. язык')),
+                ('is_daily_report_finished', models.BooleanField(default=False, verbose_name='Отчёт сдан')),
+                ('sessions_count', models.PositiveIntegerField(default=0, verbose_name='Сеансов')),
+                ('viewers_count', models.PositiveIntegerField(default=0, verbose_name='Зрители')),
+                ('invitations_count', models.PositiveIntegerField(default=0, verbose_name='Пригл.')),
+                ('seats_count', models.PositiveIntegerField(default=0, verbose_name='Мест в зале')),
+                ('gross_yield', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='Доход')),
+                ('gross_yield_without_vat', models.DecimalField(blank=True, decimal_places=2, max_digits=14, null=True, verbose_name='Доход с вычетом НДС')),
+                ('cinema_hall', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_rollups', to='common.CinemaHall', verbose_name='Зал')),
+                ('dimension', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_rollups', to='common.Dimension', verbose_name='Формат')),
+                ('film', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_rollups', to='common.Film', verbose_name='фильм')),
+            ],
+            options={
+                'verbose_name': 'Сеансы за день',
+                'verbose_name_plural': 'Сеансы по дням',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='sessiondailyrollup',
+            unique_together=set([('date', 'cinema_hall', 'film', 'dimension', 'vat', 'is_original_language', 'is_daily_report_finished')]),
+        ),
+        migrations.RunSQL(FILL_ROLLUP_SQL, reverse_sql=migrations.RunSQL.noop),
+    ]
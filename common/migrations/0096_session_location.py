@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+FILL_LOCATION_SQL = """
+UPDATE {table} t
+SET cinema_id = c.id, chain_id = c.chain_id, city_id = c.city_id
+FROM common_cinemahall h
+JOIN common_cinema c ON c.id = h.cinema_id
+WHERE h.id = t.cinema_hall_id;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common', '0095_sessiondailyrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='cinema',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='sessions', to='common.Cinema', verbose_name='Кинотеатр'),
+        ),
+        migrations.AddField(
+            model_name='session',
+            name='chain',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='sessions', to='common.Chain', verbose_name='Сеть'),
+        ),
+        migrations.AddField(
+            model_name='session',
+            name='city',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='sessions', to='common.City', verbose_name='Город'),
+        ),
+        migrations.AddField(
+            model_name='sessiondailyrollup',
+            name='cinema',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='daily_rollups', to='common.Cinema', verbose_name='Кинотеатр'),
+        ),
+        migrations.AddField(
+            model_name='sessiondailyrollup',
+            name='chain',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='daily_rollups', to='common.Chain', verbose_name='Сеть'),
+        ),
+        migrations.AddField(
+            model_name='sessiondailyrollup',
+            name='city',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='daily_rollups', to='common.City', verbose_name='Город'),
+        ),
+        migrations.RunSQL(
+            FILL_LOCATION_SQL.format(table='common_session'), migrations.RunSQL.noop),
+        migrations.RunSQL(
+            FILL_LOCATION_SQL.format(table='common_sessiondailyrollup'), migrations.RunSQL.noop),
+        migrations.AlterIndexTogether(
+            name='session',
+            index_together=set([('cinema', 'date'), ('chain', 'date'), ('city', 'date')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='sessiondailyrollup',
+            index_together=set([('cinema', 'date'), ('chain', 'date'), ('city', 'date')]),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+FILL_STATUSES_SQL = """
+WITH days AS (
+    SELECT generate_series(
+        LEAST((SELECT MIN(lower(active_date_range)) FROM common_additionalagreement),
+              (SELECT MIN(date) FROM common_finishedcinemareportdate)),
+        current_date + %s, '1 day')::date AS day
+), active AS (
+    SELECT DISTINCT a.cinema_id, days.day
+    FROM days
+    JOIN common_additionalagreement a
+        ON a.active_date_range && daterange(days.day - 1, days.day + 1)
+    WHERE a.cinema_id IS NOT NULL
+), finished AS (
+    SELECT cinema_id, date AS day FROM common_finishedcinemareportdate
+)
+INSERT INTO common_cinemadaystatus (cinema_id, date, is_daily_report_finished)
+SELECT cinema_id, day, finished.cinema_id IS NOT NULL
+FROM active
+FULL JOIN finished USING (cinema_id, day);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common', '0096_session_location'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CinemaDayStatus',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='Дата')),
+                ('is_daily_report_finished', models.BooleanField(default=False, verbose_name='Отчёт сдан')),
+                ('cinema', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='day_statuses', to='common.Cinema', verbose_name='Кинотеатр')),
+            ],
+            options={
+                'verbose_name_plural': 'Статусы дневных отчётов',
+                'verbose_name': 'Статус дневного отчёта',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='cinemadaystatus',
+            unique_together=set([('cinema', 'date')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='cinemadaystatus',
+            index_together=set([('date', 'is_daily_report_finished')]),
+        ),
+        migrations.RunSQL([(FILL_STATUSES_SQL, [settings.CINEMA_DAY_STATUS_DAYS_AHEAD])],
+                         migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common', '0097_cinemadaystatus'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AgreementRelinkJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('relink', models.BooleanField(default=True, help_text='Привязать к соглашению сеансы его периода, иначе только пересчитать НДС уже привязанных сеансов', verbose_name='Привязать сеансы')),
+                ('status', models.CharField(choices=[('pending', 'В очереди'), ('running', 'Выполняется'), ('finished', 'Завершено'), ('failed', 'Ошибка')], db_index=True, default='pending', max_length=16, verbose_name='Статус')),
+                ('sessions_count', models.PositiveIntegerField(default=0, verbose_name='Сеансов')),
+                ('processed_count', models.PositiveIntegerField(default=0, verbose_name='Обработано')),
+                ('last_session_id', models.PositiveIntegerField(default=0)),
+                ('started', models.DateTimeField(blank=True, null=True, verbose_name='Начато')),
+                ('finished', models.DateTimeField(blank=True, null=True, verbose_name='Завершено')),
+                ('error', models.TextField(blank=True, verbose_name='Ошибка')),
+                ('agreement', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='relink_jobs', to='common.AdditionalAgreement', verbose_name='Доп. соглашение')),
+            ],
+            options={
+                'ordering': ('-created',),
+                'verbose_name_plural': 'Привязки сеансов к доп. соглашениям',
+                'verbose_name': 'Привязка сеансов к доп. соглашению',
+            },
+        ),
+    ]
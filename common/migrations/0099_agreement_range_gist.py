@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.contrib.postgres.operations import CreateExtension
+from django.db import migrations
+
+OVERLAPS_SQL = """
+SELECT a.id, b.id
+FROM common_additionalagreement a
+JOIN common_additionalagreement b
+    ON a.id < b.id
+    AND a.cinema_id = b.cinema_id
+    AND a.film_id = b.film_id
+    AND a.dimension_id = b.dimension_id
+    AND a.is_original_language = b.is_original_language
+    AND a.active_date_range && b.active_date_range
+"""
+
+
+def check_overlaps(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(OVERLAPS_SQL)
+        overlaps = cursor.fetchall()
+    if overlaps:
+        raise RuntimeError('Fix overlapping additional agreements before migrating: {}'.format(
+            ', '.join('{}/{}'.format(*pair) for pair in overlaps)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common', '0098_agreementrelinkjob'),
+    ]
+
+    operations = [
+        # btree_gist has no boolean operator class on older servers, hence the int cast
+        CreateExtension('btree_gist'),
+        migrations.RunPython(check_overlaps, migrations.RunPython.noop),
+        migrations.RunSQL(
+            'ALTER TABLE common_additionalagreement '
+            'ADD CONSTRAINT common_additionalagreement_no_overlap EXCLUDE USING gist ('
+            'cinema_id WITH =, film_id WITH =, dimension_id WITH =, '
+            '(is_original_language::int) WITH =, active_date_range WITH &&)',
+            'ALTER TABLE common_additionalagreement '
+            'DROP CONSTRAINT common_additionalagreement_no_overlap',
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX common_additionalagreement_active_date_range_gist '
+            'ON common_additionalagreement USING gist (active_date_range)',
+            'DROP INDEX common_additionalagreement_active_date_range_gist',
+        ),
+    ]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+FILL_DAYS_SQL = """
+INSERT INTO common_agreementday
+    (agreement_id, date, cinema_id, film_id, dimension_id, is_original_language)
+SELECT a.id, day::date, a.cinema_id, a.film_id, a.dimension_id, a.is_original_language
+FROM common_additionalagreement a
+JOIN common_film f ON f.id = a.film_id,
+    generate_series(COALESCE(lower(a.active_date_range), f.release_date),
+                    COALESCE(upper(a.active_date_range), current_date + %s),
+                    '1 day') AS day
+WHERE NOT isempty(a.active_date_range);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common', '0099_agreement_range_gist'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AgreementDay',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='Дата')),
+                ('is_original_language', models.BooleanField(default=False, verbose_name='Ориг. язык')),
+                ('agreement', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='days', to='common.AdditionalAgreement', verbose_name='Доп. соглашение')),
+                ('cinema', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='agreement_days', to='common.Cinema', verbose_name='Кинотеатр')),
+                ('dimension', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='agreement_days', to='common.Dimension', verbose_name='Формат')),
+                ('film', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='agreement_days', to='common.Film', verbose_name='Фильм')),
+            ],
+            options={
+                'verbose_name_plural': 'Дни доп. соглашений',
+                'verbose_name': 'День доп. соглашения',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='agreementday',
+            unique_together=set([('agreement', 'date')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='agreementday',
+            index_together=set([('date', 'cinema')]),
+        ),
+        migrations.RunSQL([(FILL_DAYS_SQL, [settings.CINEMA_DAY_STATUS_DAYS_AHEAD])],
+                         migrations.RunSQL.noop),
+    ]
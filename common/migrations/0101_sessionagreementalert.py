@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common', '0100_agreementday'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SessionAgreementAlert',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('reason', models.CharField(choices=[('missing', 'Для сеанса нет доп. соглашения'), ('multiple', 'Параметрам сеанса соответствуют нескольким доп. соглашениям')], max_length=16, verbose_name='Причина')),
+                ('date', models.DateField(verbose_name='Дата')),
+                ('is_original_language', models.BooleanField(default=False, verbose_name='Ориг. язык')),
+                ('is_notified', models.BooleanField(db_index=True, default=False, verbose_name='Отправлено')),
+                ('cinema', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='agreement_alerts', to='common.Cinema', verbose_name='Кинотеатр')),
+                ('dimension', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='agreement_alerts', to='common.Dimension', verbose_name='Формат')),
+                ('film', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='agreement_alerts', to='common.Film', verbose_name='Фильм')),
+                ('session', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='agreement_alert', to='common.Session', verbose_name='Сеанс')),
+            ],
+            options={
+                'ordering': ('-date',),
+                'verbose_name_plural': 'Сеансы без доп. соглашений',
+                'verbose_name': 'Сеанс без доп. соглашения',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='sessionagreementalert',
+            index_together=set([('cinema', 'date'), ('date', 'film')]),
+        ),
+    ]
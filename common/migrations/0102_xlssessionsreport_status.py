@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common', '0101_sessionagreementalert'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xlssessionsreport',
+            name='status',
+            field=models.CharField(choices=[('pending', 'В очереди'), ('processing', 'Обрабатывается'), ('finished', 'Обработан'), ('failed', 'Ошибка')], default='finished', max_length=16, verbose_name='Статус'),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='xlssessionsreport',
+            name='status',
+            field=models.CharField(choices=[('pending', 'В очереди'), ('processing', 'Обрабатывается'), ('finished', 'Обработан'), ('failed', 'Ошибка')], default='pending', max_length=16, verbose_name='Статус'),
+        ),
+    ]
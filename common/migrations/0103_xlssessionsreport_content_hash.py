@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def fill_content_hashes(apps, schema_editor):
+    """Hashes files of earlier imports, so re-uploaded copies of them are recognized"""
+    XlsSessionsReport = apps.get_model('common', 'XlsSessionsReport')
+    for report in XlsSessionsReport.objects.exclude(xls_file='').only('xls_file').iterator():
+        content_hash = hashlib.sha256()
+        try:
+            report.xls_file.open('rb')
+            try:
+                for chunk in report.xls_file.chunks():
+                    content_hash.update(chunk)
+            finally:
+                report.xls_file.close()
+        except OSError:  # the file was removed from the storage
+            continue
+        XlsSessionsReport.objects.filter(pk=report.pk).update(
+            content_hash=content_hash.hexdigest())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common', '0102_xlssessionsreport_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xlssessionsreport',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64, verbose_name='SHA-256 файла'),
+        ),
+        migrations.AddField(
+            model_name='xlssessionsreport',
+            name='imported_copy',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='skipped_copies', to='common.XlsSessionsReport', verbose_name='Загруженная копия'),
+        ),
+        migrations.RunPython(fill_content_hashes, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='xlssessionsreport',
+            name='status',
+            field=models.CharField(choices=[('pending', 'В очереди'), ('processing', 'Обрабатывается'), ('finished', 'Обработан'), ('failed', 'Ошибка'), ('skipped', 'Пропущен, файл уже загружен')], default='pending', max_length=16, verbose_name='Статус'),
+        ),
+    ]
@@ -1,3 +1,4 @@
+import hashlib
 import os
 from datetime import timedelta, date
 from decimal import Decimal
@@ -6,20 +7,20 @@ from dateutil.relativedelta import relativedelta
 from django.conf import settings
 from django.contrib.postgres.fields import JSONField, ArrayField, DateRangeField
 from django.core.exceptions import ValidationError, MultipleObjectsReturned
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 from django.db import models
 from django.db.models import Count
 from django.db.models import F
-from django.urls import reverse
 from django.utils.formats import date_format
 from django.utils.timezone import now, local
-from django.db.models.signals import post_delete
+from django.db.models.signals import post_delete, post_save
 from django.core.files.storage import FileSystemStorage
 from model_utils.models import TimeStampedModel
 
-from celery_tasks import async_mail_admins
-from common.managers import CinemaManager, AdditionalAgreementManager
-from kinomania.utils import validate_xls_extension, build_full_url, MONTHS
+from celery_tasks import parse_xls_report, relink_agreement_sessions
+from common.managers import CinemaManager, AdditionalAgreementManager, SessionDailyRollupManager, \
+    CinemaDayStatusManager, AgreementDayManager, SessionAgreementAlertManager
+from kinomania.utils import validate_xls_extension, MONTHS
 
 VAT_RATE = 0.166666666666666
 
@@ -113,14 +114,22 @@ class Cinema(TimeStampedModel):
                 for user in self.chain.responsible_for_daily_reports.all():
                     self.access_to_reports.add(user)
 
+        origin_location = None
+        if self.pk:
+            origin_location = Cinema.objects.filter(pk=self.pk).values_list('chain', 'city').first()
+
         super().save(*args, **kwargs)
 
+        if origin_location and origin_location != (self.chain_id, self.city_id):
+            Session.update_location(dict(cinema=self), chain=self.chain, city=self.city)
+
     def is_report_finished(self, date):
         return self.finished_on_dates.filter(date=date).exists()
 
     def set_report_finished(self, date):
         Session.objects.filter(
-            cinema_hall__cinema=self, date=date).update(is_daily_report_finished=True)
+            cinema=self, date=date).update(is_daily_report_finished=True)
+        SessionDailyRollup.objects.refresh(cinema=self, date=date)
 
         try:
             FinishedCinemaReportDate.objects.create(cinema=self, date=date)
@@ -154,6 +163,23 @@ class CinemaHall(TimeStampedModel):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        origin_cinema_id = origin_seats_count = None
+        if self.pk:
+            origin_cinema_id, origin_seats_count = CinemaHall.objects.filter(
+                    pk=self.pk).values_list('cinema', 'seats_count').first() or (None, None)
+
+        super().save(*args, **kwargs)
+
+        if origin_cinema_id and origin_cinema_id != self.cinema_id:
+            cinema = self.cinema
+            Session.update_location(dict(cinema_hall=self), cinema=cinema, chain=cinema.chain,
+                                    city=cinema.city)
+
+        # rollups keep the seats count of the hall as it was on refresh
+        if origin_seats_count is not None and origin_seats_count != self.seats_count:
+            SessionDailyRollup.objects.refresh(cinema_hall=self)
+
 
 class FinishedCinemaReportDate(TimeStampedModel):
     cinema = models.ForeignKey(Cinema, related_name='finished_on_dates')
@@ -168,6 +194,28 @@ class FinishedCinemaReportDate(TimeStampedModel):
         return '{} {}'.format(self.cinema.name, self.date)
 
 
+class CinemaDayStatus(models.Model):
+    """Daily report status of a cinema: finished (True) or missing (False).
+
+    There is no row when the report is not required, i.e. the cinema has no active agreement
+    on the date and has not finished the report anyway.
+    """
+    cinema = models.ForeignKey(Cinema, related_name='day_statuses', verbose_name='Кинотеатр')
+    date = models.DateField('Дата')
+    is_daily_report_finished = models.BooleanField('Отчёт сдан', default=False)
+
+    objects = CinemaDayStatusManager()
+
+    class Meta:
+        unique_together = ('cinema', 'date')
+        index_together = (('date', 'is_daily_report_finished'), )
+        verbose_name_plural = 'Статусы дневных отчётов'
+        verbose_name = 'Статус дневного отчёта'
+
+    def __str__(self):
+        return '{} {}'.format(self.cinema_id, self.date)
+
+
 class Film(TimeStampedModel):
     name = models.CharField(max_length=128, help_text='На украинском языке', unique=True,
                             db_index=True)
@@ -228,6 +276,14 @@ class AdditionalAgreement(TimeStampedModel):
         help_text='Показ фильма на языке оригинала?')
     one_c_number = models.CharField('номер 1С', max_length=64, unique=True, blank=True)
 
+    # exclusion constraint on overlapping ranges of the same cinema, film, dimension and language,
+    # agreements without a cinema never overlap, as NULLs are not equal for the constraint
+    OVERLAP_CONSTRAINT = 'common_additionalagreement_no_overlap'
+    OVERLAP_ERROR = 'На этот диапазон дат уже существует доп соглашение с указанными параметрами.'
+
+    # copied to AgreementDay rows
+    DAY_KEY_FIELDS = ('cinema_id', 'film_id', 'dimension_id', 'is_original_language')
+
     objects = AdditionalAgreementManager()
 
     class Meta:
@@ -262,7 +318,8 @@ class AdditionalAgreement(TimeStampedModel):
             raise ValidationError('Вы указали формат "{}". Форматы выбранного фильма: "{}"'.format(
                     self.dimension.name, ', '.join([d.name for d in self.film.dimensions.all()])))
 
-        if self.film_id and self.active_date_range and self.dimension_id:
+        # the same check as OVERLAP_CONSTRAINT, which can't give a form error itself
+        if self.cinema_id and self.film_id and self.active_date_range and self.dimension_id:
             qs = AdditionalAgreement.objects.filter(
                     cinema=self.cinema, film=self.film, dimension=self.dimension,
                     is_original_language=self.is_original_language,
@@ -271,8 +328,7 @@ class AdditionalAgreement(TimeStampedModel):
                 qs = qs.exclude(id=self.id)
 
             if qs.exists():
-                raise ValidationError(
-                    'На этот диапазон дат уже существует доп соглашение с указанными параметрами.')
+                raise ValidationError(self.OVERLAP_ERROR)
 
     def save(self, *args, **kwargs):
 
@@ -293,26 +349,39 @@ class AdditionalAgreement(TimeStampedModel):
             origin_active_date_range = origin.active_date_range
             origin_vat = origin.vat
 
+        # an agreement overlapping one saved concurrently, which clean() could not see yet,
+        # raises IntegrityError of OVERLAP_CONSTRAINT, see `AdditionalAgreementAdmin`
         super().save(*args, **kwargs)
 
+        if is_new or (self.active_date_range != origin_active_date_range) or any(
+                getattr(self, name) != getattr(origin, name) for name in self.DAY_KEY_FIELDS):
+            AgreementDay.objects.refresh_for_agreement(self)
+
         if is_new or (self.active_date_range != origin_active_date_range):
-            self.sessions = Session.objects.filter(
-                film=self.film,
-                is_original_language=self.is_original_language,
-                cinema_hall__cinema=self.cinema,
-                dimension=self.dimension,
-                date__range=[self.active_date_range.lower,
-                             self.active_date_range.upper])
-
-            self.sessions.update(additional_agreement=self, vat=self.vat)
-
-        if is_new or (self.vat != origin_vat):
-            if self.vat:
-                self.sessions.update(
-                    gross_yield_without_vat=F('gross_yield') - F('gross_yield') * VAT_RATE,
-                    vat=True)
-            else:
-                self.sessions.update(gross_yield_without_vat=F('gross_yield'), vat=False)
+            CinemaDayStatus.objects.refresh_for_agreement(self)
+            if not is_new:
+                CinemaDayStatus.objects.refresh_for_agreement(self, origin_active_date_range)
+
+        # sessions can't be linked to an agreement with an empty range
+        if self.get_period_lookups() is not None and (
+                is_new or (self.active_date_range != origin_active_date_range) or
+                (self.vat != origin_vat)):
+            AgreementRelinkJob.schedule(
+                self, relink=is_new or (self.active_date_range != origin_active_date_range))
+
+    def get_period_lookups(self):
+        """Lookups of sessions this agreement applies to, `None` for an empty range"""
+        date_range = self.active_date_range
+        if not date_range or date_range.isempty:
+            return None
+
+        lookups = dict(film=self.film_id, is_original_language=self.is_original_language,
+                       cinema=self.cinema_id, dimension=self.dimension_id)
+        if date_range.lower:
+            lookups['date__gte'] = date_range.lower
+        if date_range.upper:
+            lookups['date__lte'] = date_range.upper
+        return lookups
 
     def get_months(self):
         if not self.active_date_range:
@@ -340,6 +409,34 @@ class AdditionalAgreement(TimeStampedModel):
         return ''
 
 
+class AgreementDay(models.Model):
+    """A day an agreement is active on, as matched by `filter_by_date`.
+
+    Agreement-by-date lookups become equality joins on `date`. Rows are regenerated by
+    `AgreementDayManager` when an agreement is saved, open ranges are materialized up to
+    CINEMA_DAY_STATUS_DAYS_AHEAD days from today like `CinemaDayStatus`.
+    """
+    agreement = models.ForeignKey(AdditionalAgreement, related_name='days',
+                                  verbose_name='Доп. соглашение')
+    date = models.DateField('Дата')
+    cinema = models.ForeignKey(Cinema, related_name='agreement_days', verbose_name='Кинотеатр',
+                               blank=True, null=True)
+    film = models.ForeignKey(Film, related_name='agreement_days', verbose_name='Фильм')
+    dimension = models.ForeignKey(Dimension, related_name='agreement_days', verbose_name='Формат')
+    is_original_language = models.BooleanField('Ориг. язык', default=False)
+
+    objects = AgreementDayManager()
+
+    class Meta:
+        unique_together = ('agreement', 'date')
+        index_together = (('date', 'cinema'), )
+        verbose_name_plural = 'Дни доп. соглашений'
+        verbose_name = 'День доп. соглашения'
+
+    def __str__(self):
+        return '{} {}'.format(self.agreement_id, self.date)
+
+
 class ContactInformation(TimeStampedModel):
     title = models.CharField(max_length=64, default='администратор')
     cinema = models.ForeignKey(Cinema, related_name='contacts')
@@ -374,17 +471,40 @@ class XlsReportsUpload(TimeStampedModel):
     def is_successful(self):
         return not self.reports.filter(errors__isnull=False).exists()
 
+    @property
+    def is_processing(self):
+        return self.reports.filter(status__in=XlsSessionsReport.ACTIVE_STATUSES).exists()
+
     def all_reports(self):
-        return self.reports.annotate(sessions_count=Count('sessions'))
+        return self.reports.select_related('imported_copy').annotate(
+            sessions_count=Count('sessions'))
 
 
 class XlsSessionsReport(TimeStampedModel):
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+    STATUS_CHOICES = (
+        (PENDING, 'В очереди'),
+        (PROCESSING, 'Обрабатывается'),
+        (FINISHED, 'Обработан'),
+        (FAILED, 'Ошибка'),
+        (SKIPPED, 'Пропущен, файл уже загружен'),
+    )
+    ACTIVE_STATUSES = (PENDING, PROCESSING)
+
     xls_file = models.FileField(upload_to='xls_reports/%Y/%m/%d/',
                                 validators=[validate_xls_extension])
     xls_filename = models.CharField(max_length=256)
     report_upload = models.ForeignKey(XlsReportsUpload, related_name='reports')
     errors = ArrayField(base_field=models.CharField(max_length=256, blank=True),
                         blank=True, null=True)
+    status = models.CharField('Статус', max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    content_hash = models.CharField('SHA-256 файла', max_length=64, blank=True, db_index=True)
+    imported_copy = models.ForeignKey('self', models.SET_NULL, related_name='skipped_copies',
+                                      blank=True, null=True, verbose_name='Загруженная копия')
 
     class Meta:
         verbose_name_plural = 'XLS отчёты'
@@ -393,14 +513,64 @@ class XlsSessionsReport(TimeStampedModel):
     def __str__(self):
         return self.xls_filename
 
+    @property
+    def errors_count(self):
+        return len(self.errors or [])
+
+    @staticmethod
+    def get_content_hash(xls_file):
+        content_hash = hashlib.sha256()
+        for chunk in xls_file.chunks():
+            content_hash.update(chunk)
+        return content_hash.hexdigest()
+
+    @classmethod
+    def get_imported_copies(cls, content_hashes):
+        """Reports of the files imported without errors whose sessions still exist"""
+        return cls.objects.filter(
+            content_hash__in=content_hashes, status=cls.FINISHED, errors__isnull=True,
+            sessions__isnull=False).distinct()
+
+    def get_imported_copy(self):
+        """A byte-identical file imported without errors"""
+        if not self.content_hash:
+            return None
+        return self.get_imported_copies([self.content_hash]).exclude(
+            pk=self.pk).order_by('pk').first()
+
     def save(self, parse_file=True, *args, **kwargs):
+        if self._state.adding and not self.content_hash and self.xls_file:
+            self.content_hash = self.get_content_hash(self.xls_file)
+
+        if parse_file:
+            self.imported_copy = self.get_imported_copy()
+            if self.imported_copy:
+                self.status = self.SKIPPED
+                parse_file = False
         super().save(*args, **kwargs)
 
         if parse_file:
-            from common.xls_report_parsers import XlsReportParser
+            # files of an upload are parsed in parallel by the workers
+            transaction.on_commit(lambda: parse_xls_report.delay(self.pk))
+
+    def set_status(self, status):
+        self.status = status
+        self.save(parse_file=False, update_fields=('status', 'errors', 'modified'))
+
+    def parse(self):
+        """Imports sessions of the file, called by the `parse_xls_report` task"""
+        from common.xls_report_parsers import XlsReportParser
+
+        self.set_status(self.PROCESSING)
+        try:
             parser = XlsReportParser(path_to_xls=self.xls_file.path, xls_report=self,
                                      city=self.report_upload.city)
             parser.handle()
+        except Exception as e:
+            self.errors = (self.errors or []) + ['Ошибка обработки файла: {}'.format(e)[:256]]
+            self.set_status(self.FAILED)
+            raise
+        self.set_status(self.FINISHED)
 
 
 class Session(TimeStampedModel):
@@ -433,11 +603,19 @@ class Session(TimeStampedModel):
     is_original_language = models.BooleanField(
         'Ориг. язык', default=False,
         help_text='Указывает на то, был ли показ фильма на языке оригинала')
+    # denormalized from cinema_hall to filter reports without joins
+    cinema = models.ForeignKey(Cinema, related_name='sessions', verbose_name='Кинотеатр',
+                               blank=True, null=True, editable=False)
+    chain = models.ForeignKey(Chain, related_name='sessions', verbose_name='Сеть',
+                              blank=True, null=True, editable=False)
+    city = models.ForeignKey(City, related_name='sessions', verbose_name='Город',
+                             blank=True, null=True, editable=False)
 
     class Meta:
         verbose_name_plural = 'Сеансы'
         verbose_name = 'Сеанс'
         unique_together = (('cinema_hall', 'time', 'date', 'dimension'), )
+        index_together = (('cinema', 'date'), ('chain', 'date'), ('city', 'date'))
 
     def __str__(self):
         return 'ID: {}, зал "{}": фильм: "{}", дата: {} время: {}'.format(
@@ -448,25 +626,57 @@ class Session(TimeStampedModel):
             raise ValidationError('Вы указали формат "{}". Форматы выбранного фильма: "{}"'.format(
                     self.dimension.name, ', '.join([d.name for d in self.film.dimensions.all()])))
 
-    def save(self, *args, **kwargs):
+    def save(self, update_rollup=True, agreement_resolver=None, *args, **kwargs):
+        origin = None
+        is_new = self.pk is None
+        if update_rollup and self.pk:
+            origin = Session.objects.filter(pk=self.pk).only(
+                    'cinema_hall', 'date', 'film').first()
+
+        alert_reason = self.fill_derived_fields(agreement_resolver)
+
+        super().save(*args, **kwargs)
+
+        if update_rollup:
+            SessionDailyRollup.objects.refresh_for_session(self)
+            if origin and (origin.cinema_hall_id, origin.date, origin.film_id) != (
+                    self.cinema_hall_id, self.date, self.film_id):
+                SessionDailyRollup.objects.refresh_for_session(origin)
+
+        if alert_reason:
+            SessionAgreementAlert.objects.record([(self, alert_reason)])
+        elif not is_new:
+            SessionAgreementAlert.objects.resolve([self.pk])
+
+    def fill_derived_fields(self, agreement_resolver=None):
+        """Sets location, agreement, VAT, week and month of the session.
+
+        An `AgreementResolver` of the session's cinema can be passed to look the agreement up
+        in memory. Returns the `SessionAgreementAlert` reason if the agreement can't be selected.
+        """
         film = self.film
         if not film.name_original or (film.name == film.name_original):
             self.is_original_language = True
 
-        error_subject = None
+        cinema = self.cinema_hall.cinema
+        self.cinema = cinema
+        self.chain_id = cinema.chain_id
+        self.city_id = cinema.city_id
+
+        alert_reason = None
         try:
-            agreement_params = dict(
-                    cinema=self.cinema_hall.cinema,
-                    dimension=self.dimension,
-                    is_original_language=self.is_original_language,
-                    film=self.film)
-            additional_agreement = AdditionalAgreement.objects.filter_by_date(self.date).get(
-                    **agreement_params)
-            agreement_params['date'] = self.date
+            if agreement_resolver is not None:
+                additional_agreement = agreement_resolver.get(
+                        self.film, self.dimension, self.is_original_language, self.date)
+            else:
+                additional_agreement = AdditionalAgreement.objects.filter_by_date(
+                        self.date).get(cinema=cinema, dimension=self.dimension,
+                                       is_original_language=self.is_original_language,
+                                       film=self.film)
         except AdditionalAgreement.DoesNotExist:
-            error_subject = 'Для сеанса нет доп. соглашения'
+            alert_reason = SessionAgreementAlert.MISSING
         except MultipleObjectsReturned:
-            error_subject = 'Параметрам сеанса соответствуют нескольким доп. соглашениям'
+            alert_reason = SessionAgreementAlert.MULTIPLE
         else:
             self.additional_agreement = additional_agreement
             if additional_agreement.vat is not None:
@@ -477,31 +687,222 @@ class Session(TimeStampedModel):
         else:
             self.gross_yield_without_vat = self.gross_yield
 
-        # movie rental week is from Thursday to Wednesday
-        week_day = self.date.weekday()
-        if week_day > 2:
-            self.week = self.date - timedelta(days=week_day - 3)
-        else:
-            self.week = self.date - timedelta(days=week_day + 4)
+        self.week = self.get_week(self.date)
+        self.month = self.get_month(self.date)
 
-        self.month = self.date - timedelta(days=self.date.day - 1)
+        return alert_reason
 
-        super().save(*args, **kwargs)
+    @staticmethod
+    def get_week(date):
+        # movie rental week is from Thursday to Wednesday
+        week_day = date.weekday()
+        if week_day > 2:
+            return date - timedelta(days=week_day - 3)
+        return date - timedelta(days=week_day + 4)
 
-        if error_subject:
-            session_url = build_full_url(reverse('admin:common_session_change', args=(self.id, )))
-            async_mail_admins.delay(
-                subject=error_subject,
-                message='Невозможно автоматически выбрать доп. соглашение для сеанса {url}.\n'
-                        'Параметры поиска доп соглашения: {params}'.format(
-                            url=session_url,
-                            params=', '.join(['{}={}'.format(
-                                    k, v) for k, v in agreement_params.items()])))
+    @staticmethod
+    def get_month(date):
+        return date - timedelta(days=date.day - 1)
 
     @property
     def cinema_name(self):
         return self.cinema_hall.cinema.name
 
+    @staticmethod
+    @transaction.atomic
+    def update_location(lookups, **location):
+        """Keeps denormalized cinema, chain and city of sessions and their rollups
+        in sync when a hall moves to another cinema or a cinema changes chain or city"""
+        Session.objects.filter(**lookups).update(**location)
+        # reports of both the old and the new location are outdated
+        SessionDailyRollup.objects.invalidate(**lookups)
+        SessionDailyRollup.objects.filter(**lookups).update(**location)
+        SessionDailyRollup.objects.invalidate(**lookups)
+
+
+class SessionDailyRollup(models.Model):
+    """Sessions pre-aggregated per day, hall, film and the report flags.
+
+    Field names match `Session` fields, so report filters work on both tables.
+    Rows are rebuilt by `SessionDailyRollupManager.refresh` on every session write.
+    """
+    date = models.DateField('Дата', db_index=True)
+    week = models.DateField(blank=True, null=True)
+    month = models.DateField(blank=True, null=True)
+    cinema_hall = models.ForeignKey(CinemaHall, verbose_name='Зал', related_name='daily_rollups')
+    cinema = models.ForeignKey(Cinema, related_name='daily_rollups', verbose_name='Кинотеатр',
+                               blank=True, null=True)
+    chain = models.ForeignKey(Chain, related_name='daily_rollups',
+                              verbose_name='Сеть', blank=True, null=True)
+    city = models.ForeignKey(City, related_name='daily_rollups', verbose_name='Город',
+                             blank=True, null=True)
+    film = models.ForeignKey(Film, verbose_name='фильм', related_name='daily_rollups')
+    dimension = models.ForeignKey(Dimension, related_name='daily_rollups', verbose_name='Формат')
+    vat = models.BooleanField(verbose_name='НДС', default=False)
+    is_original_language = models.BooleanField('Ориг. язык', default=False)
+    is_daily_report_finished = models.BooleanField(default=False, verbose_name='Отчёт сдан')
+    sessions_count = models.PositiveIntegerField('Сеансов', default=0)
+    viewers_count = models.PositiveIntegerField('Зрители', default=0)
+    invitations_count = models.PositiveIntegerField('Пригл.', default=0)
+    seats_count = models.PositiveIntegerField('Мест в зале', default=0)
+    gross_yield = models.DecimalField(max_digits=14, decimal_places=2, verbose_name='Доход',
+                                      default=0)
+    gross_yield_without_vat = models.DecimalField(max_digits=14, decimal_places=2,
+                                                  verbose_name='Доход с вычетом НДС',
+                                                  blank=True, null=True)
+
+    objects = SessionDailyRollupManager()
+
+    class Meta:
+        verbose_name_plural = 'Сеансы по дням'
+        verbose_name = 'Сеансы за день'
+        unique_together = (('date', 'cinema_hall', 'film', 'dimension', 'vat',
+                            'is_original_language', 'is_daily_report_finished'), )
+        index_together = (('cinema', 'date'), ('chain', 'date'), ('city', 'date'))
+
+    def __str__(self):
+        return '{} {} {}'.format(self.date, self.cinema_hall_id, self.film_id)
+
+
+class AgreementRelinkJob(TimeStampedModel):
+    """Links sessions to an agreement and recomputes their VAT after the agreement is saved.
+
+    Runs in the `relink_agreement_sessions` task, sessions are updated in primary key
+    chunks and every chunk is committed together with `last_session_id`, so an interrupted
+    job continues where it stopped. Values are taken from the agreement as it is when the
+    job runs, so running a job again is harmless.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'В очереди'),
+        (RUNNING, 'Выполняется'),
+        (FINISHED, 'Завершено'),
+        (FAILED, 'Ошибка'),
+    )
+
+    agreement = models.ForeignKey(AdditionalAgreement, related_name='relink_jobs',
+                                  verbose_name='Доп. соглашение')
+    relink = models.BooleanField(
+        'Привязать сеансы', default=True,
+        help_text='Привязать к соглашению сеансы его периода, иначе только пересчитать НДС '
+                  'уже привязанных сеансов')
+    status = models.CharField('Статус', max_length=16, choices=STATUS_CHOICES, default=PENDING,
+                              db_index=True)
+    sessions_count = models.PositiveIntegerField('Сеансов', default=0)
+    processed_count = models.PositiveIntegerField('Обработано', default=0)
+    last_session_id = models.PositiveIntegerField(default=0)
+    started = models.DateTimeField('Начато', blank=True, null=True)
+    finished = models.DateTimeField('Завершено', blank=True, null=True)
+    error = models.TextField('Ошибка', blank=True)
+
+    class Meta:
+        ordering = ('-created', )
+        verbose_name_plural = 'Привязки сеансов к доп. соглашениям'
+        verbose_name = 'Привязка сеансов к доп. соглашению'
+
+    def __str__(self):
+        return '{} {}'.format(self.agreement_id, self.get_status_display())
+
+    @classmethod
+    def schedule(cls, agreement, relink=True):
+        job = cls.objects.create(agreement=agreement, relink=relink)
+        job.enqueue()
+        return job
+
+    def enqueue(self):
+        transaction.on_commit(lambda: relink_agreement_sessions.delay(self.pk))
+
+    def get_sessions(self):
+        if self.relink:
+            lookups = self.agreement.get_period_lookups()
+            if lookups is None:
+                return Session.objects.none()
+            return Session.objects.filter(**lookups)
+        return self.agreement.sessions.all()
+
+    def set_status(self, status, **fields):
+        self.status = status
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self.save(update_fields=['status', 'modified'] + list(fields))
+
+    def run(self, chunk_size=None):
+        if self.status == self.FINISHED:
+            return
+
+        agreement = self.agreement
+        chunk_size = chunk_size or settings.AGREEMENT_RELINK_CHUNK_SIZE
+        sessions = self.get_sessions().order_by('pk')
+        if agreement.vat:
+            gross_yield_without_vat = F('gross_yield') - F('gross_yield') * VAT_RATE
+        else:
+            gross_yield_without_vat = F('gross_yield')
+
+        self.set_status(self.RUNNING, started=self.started or now(), error='',
+                        sessions_count=self.processed_count + sessions.filter(
+                            pk__gt=self.last_session_id).count())
+        try:
+            while True:
+                with transaction.atomic():
+                    ids = list(sessions.filter(pk__gt=self.last_session_id).values_list(
+                            'pk', flat=True)[:chunk_size])
+                    if not ids:
+                        break
+                    Session.objects.filter(pk__in=ids).update(
+                        additional_agreement=agreement, vat=agreement.vat,
+                        gross_yield_without_vat=gross_yield_without_vat)
+                    SessionAgreementAlert.objects.resolve(ids)
+                    self.last_session_id = ids[-1]
+                    self.processed_count += len(ids)
+                    self.save(update_fields=('last_session_id', 'processed_count', 'modified'))
+
+            lookups = agreement.get_period_lookups()
+            if lookups is not None:
+                SessionDailyRollup.objects.refresh(**lookups)
+        except Exception as e:
+            self.set_status(self.FAILED, error=str(e))
+            raise
+        self.set_status(self.FINISHED, finished=now())
+
+
+class SessionAgreementAlert(TimeStampedModel):
+    """A session no agreement could be selected for.
+
+    Rows are kept while the problem lasts and removed once the session gets an agreement,
+    so the table is the admins' worklist. New rows are mailed in a periodic digest.
+    """
+    MISSING = 'missing'
+    MULTIPLE = 'multiple'
+    REASON_CHOICES = (
+        (MISSING, 'Для сеанса нет доп. соглашения'),
+        (MULTIPLE, 'Параметрам сеанса соответствуют нескольким доп. соглашениям'),
+    )
+
+    session = models.OneToOneField(Session, related_name='agreement_alert',
+                                   verbose_name='Сеанс')
+    reason = models.CharField('Причина', max_length=16, choices=REASON_CHOICES)
+    date = models.DateField('Дата')
+    cinema = models.ForeignKey(Cinema, related_name='agreement_alerts', verbose_name='Кинотеатр')
+    film = models.ForeignKey(Film, related_name='agreement_alerts', verbose_name='Фильм')
+    dimension = models.ForeignKey(Dimension, related_name='agreement_alerts',
+                                  verbose_name='Формат')
+    is_original_language = models.BooleanField('Ориг. язык', default=False)
+    is_notified = models.BooleanField('Отправлено', default=False, db_index=True)
+
+    objects = SessionAgreementAlertManager()
+
+    class Meta:
+        ordering = ('-date', )
+        index_together = (('cinema', 'date'), ('date', 'film'))
+        verbose_name_plural = 'Сеансы без доп. соглашений'
+        verbose_name = 'Сеанс без доп. соглашения'
+
+    def __str__(self):
+        return '{} {}'.format(self.session_id, self.get_reason_display())
+
 
 class SessionUpdateRequest(TimeStampedModel):
     session = models.ForeignKey(Session)
@@ -576,6 +977,39 @@ class BackupLoadTime(models.Model):
         return '{}-{}'.format(self.start.strftime("%Y-%m-%d %H:%M:%S"),
                               self.end.strftime("%Y-%m-%d %H:%M:%S"))
 
+def session_rollup_cleanup(sender, instance, **kwargs):
+    SessionDailyRollup.objects.refresh_for_session(instance)
+
+post_delete.connect(session_rollup_cleanup, sender=Session,
+                    dispatch_uid='session.daily_rollup_cleanup')
+
+
+def day_status_refresh(sender, instance, **kwargs):
+    CinemaDayStatus.objects.refresh(instance.date, instance.date, cinema_ids=[instance.cinema_id])
+
+for signal in (post_save, post_delete):
+    signal.connect(day_status_refresh, sender=FinishedCinemaReportDate,
+                   dispatch_uid='finishedcinemareportdate.day_status_refresh')
+
+
+def agreement_day_status_cleanup(sender, instance, **kwargs):
+    CinemaDayStatus.objects.refresh_for_agreement(instance)
+
+post_delete.connect(agreement_day_status_cleanup, sender=AdditionalAgreement,
+                    dispatch_uid='additionalagreement.day_status_cleanup')
+
+
+def filter_catalog_cleanup(sender, **kwargs):
+    """Report filter options are built from agreements and names of their relations"""
+    from common.filter_catalogs import bump_catalog_version
+    bump_catalog_version()
+
+for catalog_model in (AdditionalAgreement, Film, Dimension, Cinema, City, Chain):
+    for signal in (post_save, post_delete):
+        signal.connect(filter_catalog_cleanup, sender=catalog_model,
+                       dispatch_uid='{}.filter_catalog_cleanup'.format(catalog_model._meta.model_name))
+
+
 def file_cleanup(sender, **kwargs):
     """
     File cleanup callback used to emulate delete
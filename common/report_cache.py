@@ -0,0 +1,159 @@
+import hashlib
+import json
+import logging
+import time
+from datetime import date
+
+from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django import forms
+from django.core.cache import cache
+
+from kinomania.utils import StrEncoder
+
+logger = logging.getLogger('common.report_cache')
+
+VERSION_KEY_PREFIX = 'report_version'
+STATS_KEY_PREFIX = 'report_cache_stats'
+# bounded date ranges longer than that are versioned per cinema only
+MAX_VERSIONED_MONTHS = 24
+
+
+def cinema_version_key(cinema_id, month=None):
+    if month:
+        return '{}:{}:{}'.format(VERSION_KEY_PREFIX, cinema_id, month.strftime('%Y-%m'))
+    return '{}:{}'.format(VERSION_KEY_PREFIX, cinema_id)
+
+
+def all_cinemas_version_key(month=None):
+    """Version of reports over all cinemas, so they don't read a counter of every cinema"""
+    return cinema_version_key('all', month)
+
+
+def bump_report_versions(cinema_months):
+    """Invalidates cached reports built from sessions of the given (cinema_id, month) pairs"""
+    keys = set()
+    for cinema_id, month in cinema_months:
+        keys.add(cinema_version_key(cinema_id, month))
+        keys.add(cinema_version_key(cinema_id))
+        keys.add(all_cinemas_version_key(month))
+        keys.add(all_cinemas_version_key())
+
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:  # counter was never read or was evicted
+            cache.set(key, new_version(), None)
+
+
+def new_version():
+    """Counters start from the current time, so evicted counters never repeat old values"""
+    return int(time.time() * 1000)
+
+
+def get_versions(keys):
+    versions = cache.get_many(keys)
+    missing = {key: new_version() for key in keys if key not in versions}
+    if missing:
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return [versions[key] for key in keys]
+
+
+def get_months(date_from, date_to):
+    month = date(date_from.year, date_from.month, 1)
+    while month <= date_to:
+        yield month
+        month += relativedelta(months=1)
+
+
+def get_form_filter_data(form):
+    """Raw filter values of a bound form with multiple choices sorted, so equal filters
+    give equal keys without evaluating the choice querysets"""
+    filter_data = {}
+    for name, field in form.fields.items():
+        value = field.widget.value_from_datadict(form.data, form.files, form.add_prefix(name))
+        if isinstance(field, (forms.MultipleChoiceField, forms.ModelMultipleChoiceField)):
+            value = sorted(value or [])
+        filter_data[name] = value
+    return filter_data
+
+
+class ReportCache:
+    """Result cache of a report keyed by its filters and the versions of its sessions.
+
+    Every session write bumps the version of its cinema and month (see
+    `bump_report_versions`), so an entry is never read after its sessions changed.
+    `cinema_ids=None` means all cinemas, such reports use the versions of all cinemas.
+    """
+
+    def __init__(self, name, filter_data, group_by, cinema_ids, date_from=None, date_to=None):
+        self.name = name
+        self.filter_data = filter_data
+        self.group_by = group_by
+        self.cinema_ids = None if cinema_ids is None else sorted(cinema_ids)
+        self.date_from = date_from
+        self.date_to = date_to
+
+    def get_version_keys(self):
+        months = [None]
+        if self.date_from and self.date_to:
+            months = list(get_months(self.date_from, self.date_to))
+            if len(months) > MAX_VERSIONED_MONTHS:
+                months = [None]
+
+        if self.cinema_ids is None:
+            return [all_cinemas_version_key(month) for month in months]
+        return [cinema_version_key(cinema_id, month)
+                for cinema_id in self.cinema_ids for month in months]
+
+    def get_key(self):
+        key_data = json.dumps(dict(
+            filters=self.filter_data,
+            group_by=self.group_by,
+            cinemas=self.cinema_ids,
+            versions=get_versions(self.get_version_keys()),
+        ), sort_keys=True, cls=StrEncoder)
+        return 'report:{}:{}'.format(self.name, hashlib.md5(key_data.encode()).hexdigest())
+
+    def get_or_build(self, build):
+        key = self.get_key()
+        result = cache.get(key)
+        if result is not None:
+            self.incr_stat('hits')
+            return result
+
+        started = time.time()
+        result = build()
+        rebuild_time_ms = int((time.time() - started) * 1000)
+
+        cache.set(key, result, settings.REPORT_CACHE_TIMEOUT)
+        self.incr_stat('misses')
+        self.incr_stat('rebuild_time_ms', rebuild_time_ms)
+        logger.info('%s report rebuilt in %s ms', self.name, rebuild_time_ms)
+        return result
+
+    def incr_stat(self, stat_name, delta=1):
+        key = '{}:{}:{}'.format(STATS_KEY_PREFIX, self.name, stat_name)
+        if not cache.add(key, delta, None):
+            try:
+                cache.incr(key, delta)
+            except ValueError:
+                cache.set(key, delta, None)
+
+    @staticmethod
+    def get_stats(names):
+        stats = {}
+        for name in names:
+            keys = {stat_name: '{}:{}:{}'.format(STATS_KEY_PREFIX, name, stat_name)
+                    for stat_name in ('hits', 'misses', 'rebuild_time_ms')}
+            values = cache.get_many(keys.values())
+            hits, misses, rebuild_time_ms = [values.get(keys[stat_name], 0)
+                                             for stat_name in ('hits', 'misses', 'rebuild_time_ms')]
+            stats[name] = dict(
+                hits=hits,
+                misses=misses,
+                hit_rate=round(hits / (hits + misses), 4) if hits + misses else None,
+                average_rebuild_time_ms=round(rebuild_time_ms / misses) if misses else None,
+            )
+        return stats
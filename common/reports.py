@@ -0,0 +1,85 @@
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+from django.db.models.sql.datastructures import EmptyResultSet
+
+
+class GroupedReportQuery:
+    """Per-period rows of the main report together with its grand total.
+
+    Both are produced by a single `GROUPING SETS` statement on top of the filtered
+    `SessionDailyRollup` queryset, so the summary footer costs no extra scans.
+    """
+
+    SQL = """
+        SELECT
+            report_period,
+            GROUPING(report_period) AS is_total,
+            SUM(sessions_count) AS session_count,
+            COUNT(DISTINCT cinema_id) AS cinema_count,
+            COUNT(DISTINCT cinema_hall_id) AS cinema_hall_count,
+            SUM(seats_count) AS sum_seats_count,
+            SUM(viewers_count) AS sum_viewers_count,
+            CASE WHEN SUM(seats_count) = 0 THEN 0
+                 ELSE SUM(viewers_count) * 100 / SUM(seats_count) END AS average_attendance,
+            SUM(gross_yield) AS sum_gross_yield,
+            CASE WHEN SUM(viewers_count) = 0 THEN 0
+                 ELSE SUM(gross_yield) / SUM(viewers_count) END AS gross_yield_per_viewer,
+            SUM(gross_yield_without_vat) AS sum_gross_yield_without_vat,
+            SUM(gross_yield_without_vat) * %s AS income
+        FROM ({subquery}) AS report
+        GROUP BY GROUPING SETS ((report_period), ())
+        ORDER BY is_total, report_period
+    """
+
+    def __init__(self, queryset, group_by):
+        self.queryset = queryset
+        self.group_by = group_by
+
+    def get_subquery(self):
+        qs = self.queryset.annotate(
+            report_period=F(self.group_by),
+        ).values(
+            'report_period',
+            'cinema',
+            'cinema_hall',
+            'sessions_count',
+            'seats_count',
+            'viewers_count',
+            'gross_yield',
+            'gross_yield_without_vat',
+        ).order_by()
+        return qs.query.sql_with_params()
+
+    def execute(self):
+        """Returns (rows, totals). Totals use the same keys as rows."""
+        try:
+            subquery, params = self.get_subquery()
+        except EmptyResultSet:  # e.g. filtered by an empty list of cinemas
+            return [], {}
+        sql = self.SQL.format(subquery=subquery)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, (Decimal(str(settings.KINOMANIA_INCOME_FEE)), ) + tuple(params))
+            columns = [col[0] for col in cursor.description]
+            records = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+        rows = []
+        totals = {}
+        for record in records:
+            if record.pop('is_total'):
+                totals = record
+                continue
+            period = record.pop('report_period')
+            record['period'] = period
+            record[self.group_by] = period
+            rows.append(record)
+
+        totals.pop('report_period', None)
+        if rows:
+            # keep footer semantics: averages are averaged over the displayed periods
+            for field_name in ('average_attendance', 'gross_yield_per_viewer'):
+                totals[field_name] = sum(row[field_name] for row in rows) / len(rows)
+        return rows, totals
@@ -0,0 +1,179 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import connection, transaction
+
+from common.agreement_resolver import AgreementResolver
+from common.models import Session, CinemaHall, Film, Dimension, SessionDailyRollup, \
+    CinemaDayStatus, FinishedCinemaReportDate, SessionAgreementAlert, VAT_RATE
+
+
+class BulkSessionWriter:
+    """Creates many sessions at once.
+
+    Derived fields (agreement, VAT, week, month, location) are filled in one pass with
+    in-memory agreement lookups, sessions are inserted with `bulk_create` in one
+    transaction and rollups and daily report statuses are refreshed once per cinema.
+    Sessions without an agreement are recorded as `SessionAgreementAlert` rows.
+    """
+
+    batch_size = 1000
+    # the rest is either reset for the new date or derived again
+    COPIED_FIELDS = ('time', 'cinema_hall', 'film', 'dimension', 'min_price', 'max_price', 'vat',
+                     'is_original_language', 'creator_id')
+
+    MOVE_SQL = """
+        WITH matches AS (
+            SELECT
+                s.id AS session_id,
+                COUNT(a.id) AS agreements_count,
+                MIN(a.id) AS agreement_id,
+                (array_agg(a.vat))[1] AS agreement_vat
+            FROM common_session s
+            LEFT JOIN common_additionalagreement a
+                ON a.cinema_id = s.cinema_id
+                AND a.film_id = s.film_id
+                AND a.dimension_id = s.dimension_id
+                AND a.is_original_language = s.is_original_language
+                AND a.active_date_range && daterange(%(date_to)s::date - 1, %(date_to)s::date + 1)
+            WHERE s.cinema_id = %(cinema_id)s AND s.date = %(date_from)s
+            GROUP BY s.id
+        ), resolved AS (
+            SELECT
+                m.session_id,
+                m.agreements_count,
+                CASE WHEN m.agreements_count = 1 THEN m.agreement_id END AS agreement_id,
+                CASE WHEN m.agreements_count = 1 THEN m.agreement_vat END AS agreement_vat
+            FROM matches m
+        )
+        UPDATE common_session s
+        SET
+            date = %(date_to)s,
+            week = %(week)s,
+            month = %(month)s,
+            additional_agreement_id = COALESCE(r.agreement_id, s.additional_agreement_id),
+            vat = COALESCE(r.agreement_vat, s.vat),
+            gross_yield_without_vat = CASE WHEN COALESCE(r.agreement_vat, s.vat)
+                THEN s.gross_yield - s.gross_yield * %(vat_rate)s
+                ELSE s.gross_yield END,
+            modified = now()
+        FROM resolved r
+        WHERE s.id = r.session_id
+        RETURNING s.id, r.agreements_count
+    """
+
+    def __init__(self):
+        # (session, reason) pairs of sessions without an agreement
+        self.alerts = []
+
+    def prepare(self, sessions):
+        """Turns session params into instances with cached relations"""
+        sessions = [s if isinstance(s, Session) else Session(**s) for s in sessions]
+
+        for field_name, model, related in (('cinema_hall', CinemaHall, ('cinema', )),
+                                           ('film', Film, ()),
+                                           ('dimension', Dimension, ())):
+            attname = '{}_id'.format(field_name)
+            cache_name = Session._meta.get_field(field_name).get_cache_name()
+            missing_ids = {getattr(s, attname) for s in sessions if not hasattr(s, cache_name)}
+            if missing_ids:
+                objects = model.objects.select_related(*related).in_bulk(missing_ids)
+                for session in sessions:
+                    if not hasattr(session, cache_name):
+                        setattr(session, field_name, objects[getattr(session, attname)])
+        return sessions
+
+    def get_resolvers(self, sessions):
+        cinema_dates = defaultdict(list)
+        for session in sessions:
+            cinema_dates[session.cinema_hall.cinema].append(session.date)
+
+        return {cinema.pk: AgreementResolver(cinema, min(dates), max(dates))
+                for cinema, dates in cinema_dates.items()}
+
+    def write(self, sessions):
+        """Saves sessions given as instances or field dicts, returns the saved instances"""
+        sessions = self.prepare(sessions)
+        if not sessions:
+            return sessions
+
+        resolvers = self.get_resolvers(sessions)
+        alerts = []
+        for session in sessions:
+            alert_reason = session.fill_derived_fields(resolvers[session.cinema_hall.cinema_id])
+            if alert_reason:
+                alerts.append((session, alert_reason))
+
+        cinema_dates = defaultdict(set)
+        for session in sessions:
+            cinema_dates[session.cinema_id].add(session.date)
+
+        with transaction.atomic():
+            Session.objects.bulk_create(sessions, batch_size=self.batch_size)
+            # in the same order in every transaction, rollup refreshes lock halls of cinemas
+            for cinema_id, dates in sorted(cinema_dates.items()):
+                SessionDailyRollup.objects.refresh(cinema_id=cinema_id, date__in=dates)
+                CinemaDayStatus.objects.refresh(min(dates), max(dates), cinema_ids=[cinema_id])
+            SessionAgreementAlert.objects.record(alerts)
+
+        self.alerts.extend(alerts)
+        return sessions
+
+    def copy(self, cinema, source_date_from, source_date_to, target_date_from):
+        """Copies sessions of the source dates to the same number of days starting from
+        `target_date_from` with no viewers and yield, agreements are selected for new dates.
+
+        Sessions which already exist and dates with finished reports are skipped.
+        """
+        offset = target_date_from - source_date_from
+        target_range = [source_date_from + offset, source_date_to + offset]
+
+        finished_dates = set(FinishedCinemaReportDate.objects.filter(
+                cinema=cinema, date__range=target_range).values_list('date', flat=True))
+        existing_sessions = set(Session.objects.filter(
+                cinema=cinema, date__range=target_range).values_list(
+                'cinema_hall', 'time', 'date', 'dimension'))
+
+        sessions = []
+        source_sessions = Session.objects.filter(
+                cinema=cinema, date__range=[source_date_from, source_date_to]).select_related(
+                'cinema_hall__cinema', 'film', 'dimension')
+        for source in source_sessions:
+            date = source.date + offset
+            if date in finished_dates or (
+                    source.cinema_hall_id, source.time, date, source.dimension_id) in \
+                    existing_sessions:
+                continue
+
+            copied_values = {name: getattr(source, name) for name in self.COPIED_FIELDS}
+            sessions.append(Session(date=date, viewers_count=0, invitations_count=0,
+                                    gross_yield=0, is_daily_report_finished=False, **copied_values))
+
+        return self.write(sessions)
+
+    def move(self, cinema, date_from, date_to):
+        """Moves all sessions of the cinema from one date to another with a single update,
+        which selects agreements for the new date the same way `Session.save` does.
+        Returns the number of moved sessions.
+        """
+        params = dict(cinema_id=cinema.pk, date_from=date_from, date_to=date_to,
+                      week=Session.get_week(date_to), month=Session.get_month(date_to),
+                      vat_rate=Decimal(VAT_RATE))
+
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(self.MOVE_SQL, params)
+                moved = cursor.fetchall()
+            SessionDailyRollup.objects.refresh(cinema=cinema, date__in=[date_from, date_to])
+
+            alert_reasons = {session_id: SessionAgreementAlert.MULTIPLE if count else
+                             SessionAgreementAlert.MISSING
+                             for session_id, count in moved if count != 1}
+            SessionAgreementAlert.objects.resolve(
+                [session_id for session_id, count in moved if count == 1])
+            alerts = [(session, alert_reasons[session.pk])
+                      for session in Session.objects.filter(pk__in=alert_reasons)]
+            SessionAgreementAlert.objects.record(alerts)
+
+        self.alerts.extend(alerts)
+        return len(moved)
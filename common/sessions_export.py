@@ -267,10 +267,17 @@ class SessionCsvExporter:
 
         yield dict_writer.writerow(table_header)
 
-        for chunk in chunks(queryset, 50000):
-            for session in chunk:
-                yield dict_writer.writerow(
-                        self.prepare_session_row(session, columns_names, group_by))
+        for session in self.iterate_rows(queryset, group_by):
+            yield dict_writer.writerow(self.prepare_session_row(session, columns_names, group_by))
+
+    @staticmethod
+    def iterate_rows(queryset, group_by):
+        """Grouped reports are already fetched rows, sessions are read in chunks"""
+        if group_by:
+            yield from queryset
+        else:
+            for chunk in chunks(queryset, 50000):
+                yield from chunk
 
     def export_to_response(self):
         export_params = self.export_params
@@ -319,9 +326,8 @@ class SessionCsvExporter:
     def dbf_to_response(self, queryset, columns_names, group_by):
         sessions_table, table_name = self.create_dbf_table(columns_names, group_by)
         sessions_table.open()
-        for chunk in chunks(queryset, 50000):
-            for session in chunk:
-                sessions_table.append(self.prepare_session_row(session, columns_names, group_by))
+        for session in self.iterate_rows(queryset, group_by):
+            sessions_table.append(self.prepare_session_row(session, columns_names, group_by))
 
         file_name = table_name + '.dbf'
 
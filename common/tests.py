@@ -1,3 +1,696 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+import threading
+from io import BytesIO
+from unittest import mock
+from datetime import date, time, timedelta
+from importlib import import_module
+from decimal import Decimal
 
-# Create your tests here.
+import openpyxl
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Avg, Case, Count, F, IntegerField, Sum, When
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django_celery_beat.models import CrontabSchedule, PeriodicTask
+from psycopg2._range import DateRange
+
+from common.models import City, Chain, Cinema, CinemaHall, Film, Dimension, GeneralContract, \
+    AdditionalAgreement, AgreementRelinkJob, CinemaDayStatus, Session, SessionAgreementAlert, \
+    SessionDailyRollup, XlsReportsUpload, XlsSessionsReport
+from common.agreement_resolver import AgreementResolver
+from common.managers import get_materialized_horizon
+from common.reports import GroupedReportQuery
+from common.report_cache import ReportCache, bump_report_versions
+from common.session_writer import BulkSessionWriter
+from common.xls_report_parsers import XlsReportParser
+from users.models import User
+
+
+def create_backup_task():
+    """Read by the backup notice of every page, created by `CommonConfig.ready`"""
+    schedule = CrontabSchedule.objects.create(minute=settings.BACKUP_DEFAULT_MINUTE,
+                                              hour=settings.BACKUP_DEFAULT_HOUR)
+    PeriodicTask.objects.create(name='make_backup_at', crontab=schedule)
+
+
+class CinemaDataMixin:
+    """A cinema with a hall, a film in one dimension and a contract of the cinema"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.city = City.objects.create(name='Київ')
+        cls.chain = Chain.objects.create(name='Multiplex')
+        cls.cinema = Cinema.objects.create(name='Проспект', city=cls.city, chain=cls.chain)
+        cls.cinema_hall = CinemaHall.objects.create(name='Зал 1', seats_count=100,
+                                                    cinema=cls.cinema)
+        cls.dimension = Dimension.objects.create(name='2D')
+        cls.film = Film.objects.create(name='Фільм', name_original='Film', code='film',
+                                       release_date=date(2017, 1, 1))
+        cls.film.dimensions.add(cls.dimension)
+        cls.contract = GeneralContract.objects.create(
+            contractor_full_name='Контрагент', SBR_code=12345678, number='1',
+            active_from=date(2017, 1, 1))
+        cls.contract.cinemas.add(cls.cinema)
+
+    @classmethod
+    def create_agreement(cls, date_from, date_to, **kwargs):
+        params = dict(cinema=cls.cinema, contract=cls.contract, film=cls.film,
+                      dimension=cls.dimension, vat=False,
+                      active_date_range=DateRange(date_from, date_to))
+        params.update(kwargs)
+        return AdditionalAgreement.objects.create(**params)
+
+    @classmethod
+    def create_session(cls, session_date, session_time=time(10), **kwargs):
+        params = dict(date=session_date, time=session_time, cinema_hall=cls.cinema_hall,
+                      film=cls.film, dimension=cls.dimension, viewers_count=10,
+                      min_price=Decimal(50), max_price=Decimal(100), gross_yield=Decimal(600))
+        params.update(kwargs)
+        session = Session(**params)
+        session.save()
+        return session
+
+
+# pages are rendered without collected static files
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class CreateSessionPageTest(CinemaDataMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        create_backup_task()
+
+        cls.date = date(2017, 3, 1)
+        cls.create_agreement(date(2017, 2, 1), date(2017, 4, 1))
+        cls.user = User.objects.create_user(username='admin', email='admin@example.com',
+                                            password='password', is_superuser=True)
+        for hour in (10, 12):
+            cls.create_session(cls.date, time(hour), creator=cls.user)
+
+    def test_get_query_count(self):
+        """The page reads everything once: the request session and user, the cinema with its
+        city and chain, the day's sessions, the finished flag, the last created session, four
+        queries for the options shared by both forms and three for the backup notice"""
+        self.client.force_login(self.user)
+        url = reverse('create_session', kwargs=dict(pk=self.cinema.pk,
+                                                    date=self.date.strftime('%d-%m-%Y')))
+        with self.assertNumQueries(13):
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['sessions']), 2)
+        self.assertIsNotNone(response.context['last_form'])
+
+    def test_user_is_allowed(self):
+        """Sessions can be edited by users responsible for the cinema, not by users who
+        only view all reports"""
+        responsible = User.objects.create_user(username='responsible', email='responsible@example.com',
+                                                password='password')
+        self.cinema.responsible_for_daily_reports.add(responsible)
+        viewer = User.objects.create_user(username='viewer', email='viewer@example.com',
+                                          password='password', view_all_reports=True)
+        url = reverse('create_session', kwargs=dict(pk=self.cinema.pk,
+                                                    date=self.date.strftime('%d-%m-%Y')))
+        for user, is_allowed in ((responsible, True), (viewer, False)):
+            self.client.force_login(user)
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIs(response.context['user_is_allowed'], is_allowed)
+
+
+class AgreementResolverTest(CinemaDataMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.february = cls.create_agreement(date(2017, 2, 1), date(2017, 3, 1),
+                                            one_c_number='1/february')
+        cls.march = cls.create_agreement(date(2017, 3, 1), date(2017, 4, 1),
+                                         one_c_number='1/march')
+        cls.open_ended = cls.create_agreement(date(2017, 4, 10), None, one_c_number='1/april')
+        cls.original = cls.create_agreement(None, date(2017, 2, 10), is_original_language=True,
+                                            one_c_number='1/original')
+
+    def assert_same_as_queryset(self, resolver, day):
+        for is_original_language in (False, True):
+            expected = AdditionalAgreement.objects.filter_by_date(day).filter(
+                cinema=self.cinema, film=self.film, dimension=self.dimension,
+                is_original_language=is_original_language)
+            self.assertEqual(
+                {agreement.pk for agreement in resolver.filter(
+                    self.film, self.dimension, is_original_language, day)},
+                {agreement.pk for agreement in expected}, (day, is_original_language))
+
+    def test_same_as_filter_by_date(self):
+        resolver = AgreementResolver(self.cinema)
+        day = date(2017, 1, 1)
+        while day <= date(2017, 5, 1):
+            self.assert_same_as_queryset(resolver, day)
+            day += timedelta(days=1)
+
+    def test_bounds(self):
+        """Upper bounds are inclusive, so adjacent agreements both match their common day"""
+        resolver = AgreementResolver(self.cinema, date(2017, 2, 28), date(2017, 2, 28))
+        self.assertEqual(resolver.filter(self.film, self.dimension, False, date(2017, 2, 28)),
+                         [self.february])
+        resolver = AgreementResolver(self.cinema)
+        self.assertEqual(resolver.filter(self.film, self.dimension, False, date(2017, 3, 1)),
+                         [self.february, self.march])
+        self.assertEqual(resolver.filter(self.film, self.dimension, False, date(2017, 4, 1)),
+                         [self.march])
+        self.assertEqual(resolver.filter(self.film, self.dimension, False, date(2017, 4, 9)), [])
+        self.assertEqual(resolver.get(self.film, self.dimension, False, date(2030, 1, 1)),
+                         self.open_ended)
+        self.assertEqual(resolver.get(self.film, self.dimension, True, date(2017, 2, 10)),
+                         self.original)
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class AgreementOverlapTest(CinemaDataMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.agreement = cls.create_agreement(date(2017, 2, 1), date(2017, 3, 1))
+
+    def test_constraint(self):
+        with self.assertRaisesMessage(IntegrityError, AdditionalAgreement.OVERLAP_CONSTRAINT):
+            with transaction.atomic():
+                self.create_agreement(date(2017, 2, 20), date(2017, 3, 10), one_c_number='1/2')
+
+        self.create_agreement(date(2017, 3, 1), date(2017, 3, 10), one_c_number='1/3')
+        self.create_agreement(date(2017, 2, 20), date(2017, 3, 10), one_c_number='1/4',
+                              is_original_language=True)
+
+    def test_clean(self):
+        agreement = AdditionalAgreement(
+            cinema=self.cinema, contract=self.contract, film=self.film, dimension=self.dimension,
+            active_date_range=DateRange(date(2017, 2, 20), date(2017, 3, 10)))
+        with self.assertRaisesMessage(ValidationError, AdditionalAgreement.OVERLAP_ERROR):
+            agreement.clean()
+
+    def test_without_cinema(self):
+        """Agreements without a cinema don't overlap, the same as for the constraint"""
+        self.create_agreement(date(2017, 2, 1), date(2017, 3, 1), cinema=None,
+                              one_c_number='1/2')
+        agreement = self.create_agreement(date(2017, 2, 1), date(2017, 3, 1), cinema=None,
+                                          one_c_number='1/3')
+        agreement.clean()
+
+    def test_concurrent_admin_save(self):
+        """An overlap the form could not see when validating is reported as a form error"""
+        create_backup_task()
+        user = User.objects.create_user(username='admin', email='admin@example.com',
+                                        password='password', is_superuser=True, is_staff=True)
+        self.client.force_login(user)
+        data = dict(cinema=self.cinema.pk, contract=self.contract.pk, film=self.film.pk,
+                    dimension=self.dimension.pk, active_date_range_0='20/02/2017',
+                    active_date_range_1='10/03/2017', vat='1', one_c_number='1/2')
+        clean = AdditionalAgreement.clean
+        calls = []
+
+        def clean_once_unaware(agreement):
+            calls.append(agreement)
+            if len(calls) > 1:
+                clean(agreement)
+
+        with mock.patch.object(AdditionalAgreement, 'clean', clean_once_unaware):
+            response = self.client.post(reverse('admin:common_additionalagreement_add'), data)
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, AdditionalAgreement.OVERLAP_ERROR)
+        self.assertEqual(AdditionalAgreement.objects.count(), 1)
+
+
+class AgreementDayTest(CinemaDataMixin, TestCase):
+
+    def test_filter_by_day_beyond_horizon(self):
+        """Days after the materialized horizon are looked up in agreement ranges"""
+        agreement = self.create_agreement(date(2017, 1, 1), None)
+        horizon = get_materialized_horizon()
+        self.assertFalse(agreement.days.filter(date__gt=horizon).exists())
+        for day in (date(2017, 1, 1), horizon - timedelta(days=1), horizon,
+                    horizon + timedelta(days=365)):
+            self.assertEqual(list(AdditionalAgreement.objects.filter_by_day(day)), [agreement])
+        self.assertEqual(list(AdditionalAgreement.objects.filter_by_day(date(2016, 12, 30))), [])
+
+
+class SetDailyReportFinishedTest(CinemaDataMixin, TestCase):
+
+    def test_every_agreement_beyond_horizon(self):
+        """Open-ended agreements require sessions on days which are not materialized yet"""
+        other_film = Film.objects.create(name='Інший', name_original='Other', code='other',
+                                         release_date=date(2017, 1, 1))
+        other_film.dimensions.add(self.dimension)
+        self.create_agreement(date(2017, 1, 1), None)
+        self.create_agreement(date(2017, 1, 1), None, film=other_film)
+        day = get_materialized_horizon() + timedelta(days=10)
+        self.create_session(day, film=other_film)
+        user = User.objects.create_user(username='admin', email='admin@example.com',
+                                        password='password', is_superuser=True)
+        self.client.force_login(user)
+        url = reverse('set_daily_report_finished', kwargs=dict(
+            pk=self.cinema.pk, date=day.strftime(settings.DATE_URL_INPUT_FORMAT)))
+
+        self.client.post(url)
+        self.assertFalse(self.cinema.finished_on_dates.exists())
+
+        self.create_session(day, time(12))
+        self.client.post(url)
+        self.assertTrue(self.cinema.finished_on_dates.filter(date=day).exists())
+
+
+class AgreementRelinkJobTest(CinemaDataMixin, TestCase):
+
+    def test_empty_range(self):
+        session = self.create_session(date(2017, 3, 1))
+        agreement = self.create_agreement(None, None, active_date_range=DateRange(empty=True))
+        self.assertIsNone(agreement.get_period_lookups())
+        self.assertFalse(agreement.relink_jobs.exists())
+
+        agreement.vat = True
+        agreement.save()
+        self.assertFalse(agreement.relink_jobs.exists())
+
+        job = AgreementRelinkJob.objects.create(agreement=agreement)
+        job.run()
+        job.refresh_from_db()
+        self.assertEqual(job.status, AgreementRelinkJob.FINISHED)
+        self.assertEqual(job.processed_count, 0)
+        session.refresh_from_db()
+        self.assertIsNone(session.additional_agreement_id)
+
+
+class CinemaDayStatusTest(CinemaDataMixin, TestCase):
+
+    def test_lower_open_agreement(self):
+        """Days of an agreement without a start date are counted from the release of the film"""
+        agreement = self.create_agreement(None, date(2017, 1, 10))
+        self.assertEqual(
+            list(CinemaDayStatus.objects.filter(cinema=self.cinema).values_list(
+                'date', 'is_daily_report_finished').order_by('date')[:2]),
+            [(date(2017, 1, 1), False), (date(2017, 1, 2), False)])
+
+        agreement.delete()
+        self.assertFalse(CinemaDayStatus.objects.filter(cinema=self.cinema).exists())
+
+    def test_agreement_without_cinema(self):
+        self.create_agreement(date(2017, 1, 1), date(2017, 1, 10), cinema=None)
+        self.create_agreement(date(2017, 1, 1), date(2017, 1, 10), one_c_number='1/cinema')
+        CinemaDayStatus.objects.refresh(date(2017, 1, 1), date(2017, 1, 31))
+        self.assertEqual(CinemaDayStatus.objects.filter(date=date(2017, 1, 5)).count(), 1)
+
+
+class BulkSessionWriterMoveTest(CinemaDataMixin, TestCase):
+    """Moved sessions get the same derived fields as sessions saved on the new date"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.february = cls.create_agreement(date(2017, 2, 1), date(2017, 3, 1),
+                                            one_c_number='1/february')
+        cls.march = cls.create_agreement(date(2017, 3, 6), date(2017, 4, 1), vat=True,
+                                         one_c_number='1/march')
+        cls.april = cls.create_agreement(date(2017, 4, 1), date(2017, 5, 1), vat=True,
+                                         one_c_number='1/april')
+
+    def move(self, session, date_to):
+        expected = Session.objects.get(pk=session.pk)
+        expected.date = date_to
+        alert_reason = expected.fill_derived_fields()
+
+        self.assertEqual(BulkSessionWriter().move(self.cinema, session.date, date_to), 1)
+
+        session.refresh_from_db()
+        self.assertEqual(
+            (session.date, session.week, session.month, session.additional_agreement_id,
+             session.vat, session.gross_yield_without_vat),
+            (expected.date, expected.week, expected.month, expected.additional_agreement_id,
+             expected.vat, expected.gross_yield_without_vat.quantize(Decimal('0.01'))))
+        self.assertEqual(SessionAgreementAlert.objects.filter(session=session).values_list(
+            'reason', flat=True).first(), alert_reason)
+        return alert_reason
+
+    def test_new_agreement(self):
+        session = self.create_session(date(2017, 2, 15))
+        self.assertEqual(session.additional_agreement, self.february)
+
+        self.assertIsNone(self.move(session, date(2017, 3, 15)))
+        self.assertEqual(session.additional_agreement, self.march)
+        self.assertTrue(session.vat)
+        self.assertEqual((session.week, session.month), (date(2017, 3, 9), date(2017, 3, 1)))
+
+    def test_keeps_agreement(self):
+        """Without a single agreement on the new date the old agreement and VAT are kept"""
+        session = self.create_session(date(2017, 2, 15))
+
+        self.assertEqual(self.move(session, date(2017, 6, 15)), SessionAgreementAlert.MISSING)
+        self.assertEqual(session.additional_agreement, self.february)
+        self.assertFalse(session.vat)
+        self.assertEqual(session.month, date(2017, 6, 1))
+
+        self.assertEqual(self.move(session, date(2017, 4, 1)), SessionAgreementAlert.MULTIPLE)
+        self.assertEqual(session.additional_agreement, self.february)
+        self.assertFalse(session.vat)
+
+
+class GroupedReportQueryTest(CinemaDataMixin, TestCase):
+    """Rows and the grand total are the same as of the separate aggregate queries"""
+
+    FIELDS = ('period', 'session_count', 'cinema_count', 'cinema_hall_count', 'sum_seats_count',
+              'sum_viewers_count', 'average_attendance', 'sum_gross_yield',
+              'gross_yield_per_viewer', 'sum_gross_yield_without_vat')
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        small_hall = CinemaHall.objects.create(name='Зал 2', seats_count=50, cinema=cls.cinema)
+        other_cinema = Cinema.objects.create(name='Глобус', city=cls.city, chain=cls.chain)
+        other_hall = CinemaHall.objects.create(name='Зал 1', seats_count=200, cinema=other_cinema)
+        cls.create_agreement(date(2017, 3, 1), date(2017, 3, 20), vat=True)
+
+        for day, cinema_hall, viewers_count in (
+                (date(2017, 2, 27), cls.cinema_hall, 10), (date(2017, 3, 1), cls.cinema_hall, 30),
+                (date(2017, 3, 1), small_hall, 0), (date(2017, 3, 2), other_hall, 120),
+                (date(2017, 3, 15), cls.cinema_hall, 7), (date(2017, 3, 15), other_hall, 55)):
+            cls.create_session(day, cinema_hall=cinema_hall, viewers_count=viewers_count,
+                               gross_yield=Decimal(viewers_count * 65))
+            cls.create_session(day, time(20), cinema_hall=cinema_hall, viewers_count=0,
+                               gross_yield=Decimal(0))
+
+    @staticmethod
+    def aggregate_report(queryset, group_by):
+        """Rows and totals the way the main report built them before GROUPING SETS"""
+        rows = queryset.values(group_by).annotate(
+            sum_gross_yield=Sum('gross_yield'),
+            sum_seats_count=Sum('seats_count'),
+            sum_viewers_count=Sum('viewers_count'),
+            sum_gross_yield_without_vat=Sum('gross_yield_without_vat'),
+            cinema_hall_count=Count('cinema_hall', distinct=True),
+            cinema_count=Count('cinema_hall__cinema', distinct=True),
+            session_count=Sum('sessions_count'),
+            period=F(group_by),
+        ).annotate(
+            average_attendance=Case(
+                When(sum_seats_count=0, then=0),
+                default=F('sum_viewers_count') * 100 / F('sum_seats_count'),
+                output_field=IntegerField()),
+            gross_yield_per_viewer=Case(
+                When(sum_viewers_count=0, then=0),
+                default=F('sum_gross_yield') / F('sum_viewers_count'),
+                output_field=IntegerField()),
+            income=F('sum_gross_yield_without_vat') * settings.KINOMANIA_INCOME_FEE,
+        ).order_by(group_by)
+
+        totals = rows.aggregate(
+            total_session_count=Sum('session_count'),
+            total_sum_seats_count=Sum('sum_seats_count'),
+            total_sum_viewers_count=Sum('sum_viewers_count'),
+            total_sum_gross_yield=Sum('sum_gross_yield'),
+            total_sum_gross_yield_without_vat=Sum('sum_gross_yield_without_vat'),
+            total_income=Sum('income'),
+            total_average_attendance=Avg('average_attendance'),
+            total_gross_yield_per_viewer=Avg('gross_yield_per_viewer'))
+        totals.update(queryset.aggregate(
+            total_cinema_count=Count('cinema_hall__cinema', distinct=True),
+            total_cinema_hall_count=Count('cinema_hall', distinct=True)))
+        return list(rows), {name.replace('total_', '', 1): value for name, value in totals.items()}
+
+    def assert_same_values(self, values, expected_values):
+        for field_name, expected in expected_values.items():
+            if field_name in ('income', 'average_attendance', 'gross_yield_per_viewer'):
+                self.assertAlmostEqual(float(values[field_name]), float(expected), places=6,
+                                       msg=field_name)
+            else:
+                self.assertEqual(values[field_name], expected, field_name)
+
+    def test_same_as_aggregate(self):
+        for group_by, periods_count in (('date', 4), ('week', 3), ('month', 2)):
+            queryset = SessionDailyRollup.objects.all()
+            rows, totals = GroupedReportQuery(queryset, group_by).execute()
+            expected_rows, expected_totals = self.aggregate_report(queryset, group_by)
+
+            self.assertEqual(len(rows), periods_count)
+            self.assertEqual([row['period'] for row in rows],
+                             [row['period'] for row in expected_rows])
+            for row, expected_row in zip(rows, expected_rows):
+                self.assert_same_values(row, {field_name: expected_row[field_name]
+                                              for field_name in self.FIELDS + ('income', )})
+            self.assertNotIn('period', totals)
+            self.assert_same_values(totals, expected_totals)
+
+    def test_empty(self):
+        """Users without cinemas filter reports by an empty list"""
+        queryset = SessionDailyRollup.objects.filter(cinema__in=[])
+        self.assertEqual(GroupedReportQuery(queryset, 'date').execute(), ([], {}))
+
+
+class SessionDailyRollupTest(CinemaDataMixin, TestCase):
+
+    def test_hall_seats_count_change(self):
+        for session_date in (date(2017, 3, 1), date(2017, 4, 1)):
+            self.create_session(session_date)
+        self.assertEqual(set(SessionDailyRollup.objects.values_list('seats_count', flat=True)),
+                         {100})
+
+        self.cinema_hall.seats_count = 120
+        self.cinema_hall.save()
+        self.assertEqual(set(SessionDailyRollup.objects.values_list('seats_count', flat=True)),
+                         {120})
+
+
+class SessionDailyRollupRefreshTest(CinemaDataMixin, TransactionTestCase):
+
+    def setUp(self):
+        self.setUpTestData()
+
+    def test_concurrent_refresh(self):
+        """The second transaction waits for the first one instead of inserting the same row"""
+        first_saved = threading.Event()
+        errors = []
+
+        def create_session(session_time, saved=None):
+            try:
+                with transaction.atomic():
+                    self.create_session(date(2017, 3, 1), session_time)
+                    if saved:
+                        saved.set()
+                        # the second transaction refreshes the partition meanwhile
+                        threading.Event().wait(0.5)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        first = threading.Thread(target=create_session, args=(time(10), first_saved))
+        first.start()
+        first_saved.wait(5)
+        second = threading.Thread(target=create_session, args=(time(12), ))
+        second.start()
+        first.join()
+        second.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(SessionDailyRollup.objects.get().sessions_count, 2)
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ReportCacheTest(TestCase):
+
+    def get_report_cache(self, cinema_ids, date_from, date_to):
+        return ReportCache('main_report', {}, 'date', cinema_ids, date_from, date_to)
+
+    def test_all_cinemas_versions(self):
+        """Reports over all cinemas read one version per month whatever the number of cinemas"""
+        report_cache = self.get_report_cache(None, date(2017, 1, 1), date(2017, 3, 31))
+        self.assertEqual(len(report_cache.get_version_keys()), 3)
+        other_month_cache = self.get_report_cache(None, date(2017, 4, 1), date(2017, 4, 30))
+        cinema_cache = self.get_report_cache([1], date(2017, 1, 1), date(2017, 3, 31))
+        key, other_month_key, cinema_key = [
+            cache.get_key() for cache in (report_cache, other_month_cache, cinema_cache)]
+
+        bump_report_versions({(2, date(2017, 2, 1))})
+        self.assertNotEqual(report_cache.get_key(), key)
+        self.assertEqual(other_month_cache.get_key(), other_month_key)
+        self.assertEqual(cinema_cache.get_key(), cinema_key)
+
+        bump_report_versions({(1, date(2017, 3, 1))})
+        self.assertNotEqual(cinema_cache.get_key(), cinema_key)
+
+
+def build_xls_report(cinema_name, sessions):
+    """Content of a daily report file with a block per session, `sessions` are
+    (date, time, hall, film, dimension) tuples"""
+    book = openpyxl.Workbook()
+    sheet = book.active
+    for session_date, session_time, hall_name, film_name, dimension_name in sessions:
+        for row in (
+                ['', XlsReportParser.BLOCK_BEGIN_TEXT],
+                ['', '{}, вул. Хрещатик, 1'.format(cinema_name), '', '', '', '', '', '',
+                 session_date],
+                ['', '{} {}'.format(film_name, dimension_name)],
+                ['', '{} {}, Зал {}'.format(session_date, session_time, hall_name)],
+                ['', 'Повний', '', '', '100'],
+                ['', 'Дитячий', '', '', '50'],
+                ['', XlsReportParser.SESSION_END_TEXT, '', '10', '', '1', '', '', '900'],
+                ['', XlsReportParser.BLOCK_END_TEXT]):
+            sheet.append(row)
+
+    content = BytesIO()
+    book.save(content)
+    return content.getvalue()
+
+
+class XlsReportMixin(CinemaDataMixin):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media_settings = override_settings(MEDIA_ROOT=media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        # xlsx files contain the time they were written at, so files of the same sessions are
+        # built once to be uploaded again byte for byte
+        self.xls_files = {}
+
+    def import_report(self, sessions):
+        """Uploads a report file, parsing it the way the `parse_xls_report` task does"""
+        key = tuple(sessions)
+        if key not in self.xls_files:
+            self.xls_files[key] = build_xls_report(self.cinema.name, sessions)
+        report = XlsSessionsReport(
+            xls_file=ContentFile(self.xls_files[key], 'report.xlsx'),
+            xls_filename='report.xlsx', report_upload=XlsReportsUpload.objects.create())
+        report.save()
+        if report.status != XlsSessionsReport.SKIPPED:
+            report.parse()
+        report.refresh_from_db()
+        return report
+
+
+class XlsReportParserTest(XlsReportMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.halls = {name: CinemaHall.objects.create(name=name, seats_count=100, cinema=cls.cinema)
+                     for name in ('1', '№2', '3a', '3A')}
+        cls.twin = Film.objects.create(name='Двійник', name_original='Twin', code='twin',
+                                       release_date=date(2017, 1, 1))
+        cls.original_twin = Film.objects.create(name='ДВІЙНИК', name_original='Двійник',
+                                                code='original_twin',
+                                                release_date=date(2017, 1, 1))
+
+    def test_import(self):
+        report = self.import_report([
+            ('01.03.2017', '10:00', '1', 'Фільм', '2D'),
+            # halls are matched with and without the number sign
+            ('01.03.2017', '11:00', '2', 'Фільм', '2D'),
+            # the first one of halls with the same name
+            ('01.03.2017', '12:00', '3A', 'Фільм', '2D'),
+            ('01.03.2017', '13:00', '1', 'Film', '2D'),
+            # a name of several films is looked up among original names
+            ('01.03.2017', '14:00', '1', 'Двійник', '2D'),
+            ('01.03.2017', '10:00', '1', 'Фільм', '2D'),
+            ('01.03.2017', '15:00', '9', 'Фільм', '2D'),
+            ('01.03.2017', '16:00', '1', 'Невідомий', '2D'),
+            ('01.03.2017', '17:00', '1', 'Фільм', '3D'),
+        ])
+
+        self.assertEqual(report.status, XlsSessionsReport.FINISHED)
+        self.assertEqual(
+            set(report.sessions.values_list('cinema_hall', 'time', 'film', 'is_original_language',
+                                            'viewers_count', 'min_price', 'max_price')),
+            {(self.halls['1'].pk, time(10), self.film.pk, False, 10, 50, 100),
+             (self.halls['№2'].pk, time(11), self.film.pk, False, 10, 50, 100),
+             (self.halls['3a'].pk, time(12), self.film.pk, False, 10, 50, 100),
+             (self.halls['1'].pk, time(13), self.film.pk, True, 10, 50, 100),
+             (self.halls['1'].pk, time(14), self.original_twin.pk, True, 10, 50, 100)})
+        self.assertTrue(self.cinema.finished_on_dates.filter(date=date(2017, 3, 1)).exists())
+
+        errors = set(report.errors)
+        duplicate_errors = {error for error in errors if error.startswith('Сеанс ')}
+        self.assertEqual(len(duplicate_errors), 1)
+        self.assertEqual(errors - duplicate_errors, {
+            'У кинотеатра "Проспект" нет зала с названием "№9"',
+            'В базе данных нет фильма с названием "Невідомий"',
+            'В базе данных нет формата с названием "3D"',
+        })
+
+    def test_unknown_cinema(self):
+        self.cinema.name = 'Глобус'
+        report = self.import_report([('01.03.2017', '10:00', '1', 'Фільм', '2D')])
+        self.assertEqual(report.errors, ['В базі даних немає кінотеатру з такою  назвою: "Глобус"'])
+        self.assertFalse(report.sessions.exists())
+
+
+class XlsReportCopyTest(XlsReportMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.hall = CinemaHall.objects.create(name='1', seats_count=100, cinema=cls.cinema)
+
+    def test_identical_file_skipped(self):
+        sessions = [('01.03.2017', '10:00', '1', 'Фільм', '2D'),
+                    ('01.03.2017', '12:00', '1', 'Фільм', '2D')]
+        report = self.import_report(sessions)
+        self.assertIsNone(report.errors)
+        self.assertEqual(report.sessions.count(), 2)
+
+        copy = self.import_report(sessions)
+        self.assertEqual(copy.status, XlsSessionsReport.SKIPPED)
+        self.assertEqual(copy.imported_copy, report)
+        self.assertEqual(copy.content_hash, report.content_hash)
+        self.assertIsNone(copy.errors)
+        self.assertEqual(Session.objects.count(), 2)
+
+        # a changed file is imported and reports the existing sessions
+        other = self.import_report(sessions + [('01.03.2017', '14:00', '1', 'Фільм', '2D')])
+        self.assertEqual(other.status, XlsSessionsReport.FINISHED)
+        self.assertEqual(other.sessions.count(), 1)
+        self.assertEqual(len(other.errors), 2)
+
+    def test_failed_file_reimported(self):
+        """A file imported with errors is imported again, only its failed sessions are added"""
+        sessions = [('01.03.2017', '10:00', '1', 'Фільм', '2D'),
+                    ('01.03.2017', '12:00', '1', 'Новий', '2D')]
+        report = self.import_report(sessions)
+        self.assertEqual(report.errors, ['В базе данных нет фильма с названием "Новий"'])
+        self.assertFalse(XlsSessionsReport.get_imported_copies([report.content_hash]).exists())
+
+        film = Film.objects.create(name='Новий', name_original='New', code='new',
+                                   release_date=date(2017, 1, 1))
+        film.dimensions.add(self.dimension)
+        retry = self.import_report(sessions)
+        self.assertEqual(retry.status, XlsSessionsReport.FINISHED)
+        self.assertIsNone(retry.errors)
+        self.assertEqual(list(retry.sessions.values_list('film', flat=True)), [film.pk])
+        self.assertEqual(Session.objects.count(), 2)
+        self.assertEqual(list(XlsSessionsReport.get_imported_copies([report.content_hash])),
+                         [retry])
+
+    def test_content_hashes_backfill(self):
+        """Files imported before hashing are recognized once the migration hashes them"""
+        migration = import_module('common.migrations.0103_xlssessionsreport_content_hash')
+        sessions = [('01.03.2017', '10:00', '1', 'Фільм', '2D')]
+        report = self.import_report(sessions)
+        removed = self.import_report([('02.03.2017', '10:00', '1', 'Фільм', '2D')])
+        content_hash = report.content_hash
+        os.remove(removed.xls_file.path)
+        XlsSessionsReport.objects.update(content_hash='')
+
+        migration.fill_content_hashes(apps, None)
+        report.refresh_from_db()
+        removed.refresh_from_db()
+        self.assertEqual(report.content_hash, content_hash)
+        self.assertEqual(removed.content_hash, '')
+        self.assertEqual(self.import_report(sessions).imported_copy, report)
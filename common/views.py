@@ -6,13 +6,12 @@ from braces.views import FormValidMessageMixin
 from braces.views import LoginRequiredMixin
 from braces.views._access import SuperuserRequiredMixin
 from dateutil.relativedelta import relativedelta
-from django import forms
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.core.mail import mail_admins, send_mail
 from django.db import transaction, IntegrityError
-from django.db.models import Case, IntegerField, Avg, CharField, BooleanField, Value, Prefetch
+from django.db.models import Case, IntegerField, CharField, BooleanField, Value, Prefetch
 from django.db.models import Count
 from django.db.models import F
 from django.db.models import Sum
@@ -35,9 +34,13 @@ from django.views.generic.edit import FormMixin, ProcessFormView
 
 from common.forms import FilterReportForm, ExportReportForm, CreateFeedbackForm, \
     ChangeSessionsDateForm, FilterMonthlyReportForm, FilterByMonthForm, \
-    SendMonthlyReportEmailForm
-from common.models import Session, Cinema, SessionUpdateRequest, CinemaHall, AdditionalAgreement, \
-    FinishedCinemaReportDate, ConfirmedMonthlyReport  #, TimeBackup
+    SendMonthlyReportEmailForm, CopySessionsForm
+from common.models import Session, Cinema, SessionUpdateRequest, AdditionalAgreement, \
+    FinishedCinemaReportDate, ConfirmedMonthlyReport, SessionDailyRollup, \
+    CinemaDayStatus  #, TimeBackup
+from common.report_cache import ReportCache, get_form_filter_data
+from common.reports import GroupedReportQuery
+from common.session_writer import BulkSessionWriter
 from common.sessions_export import SessionCsvExporter, MonthlyReportXlsExporter, \
     MonthlyReportPdfExporter
 from common.tables import CinemaTable, ReportTable, MonthlyReportTable, \
@@ -58,6 +61,7 @@ class MonthlyReportView(LoginRequiredMixin, AccessToReportMixin, TableMixin, Lis
     group_by = 'date'
     session_xls_exporter_class = MonthlyReportXlsExporter
     session_pdf_exporter_class = MonthlyReportPdfExporter
+    report_cache_name = 'monthly_report'
     filter_params = None
 
     def get(self, request, *args, **kwargs):
@@ -80,13 +84,14 @@ class MonthlyReportView(LoginRequiredMixin, AccessToReportMixin, TableMixin, Lis
 
         if export_format:
             summary_data = self.get_summary_data(queryset)
+            first_session = self.get_first_session()
             if export_format == 'xls':
                 exporter = self.session_xls_exporter_class(
-                        queryset, self.first_session,
+                        queryset, first_session,
                         summary_data=summary_data)
             elif export_format == 'pdf':
                 exporter = self.session_pdf_exporter_class(
-                        queryset, self.first_session,
+                        queryset, first_session,
                         summary_data=summary_data,
                         full_static_path=self.request.build_absolute_uri(settings.STATIC_URL))
             else:
@@ -105,14 +110,7 @@ class MonthlyReportView(LoginRequiredMixin, AccessToReportMixin, TableMixin, Lis
         queryset = queryset.filter(is_daily_report_finished=True)
         filter_params = self.filter_form.cleaned_data
 
-        if not self.request.user.is_superuser:
-            if not self.request.user.view_all_reports:
-                user_cinemas = set(list(chain_tools(
-                    self.request.user.report_cinemas.all(), self.request.user.cinemas.all()
-                )))
-
-                list_cinemas = [cinema.id for cinema in user_cinemas]
-                queryset = queryset.filter(cinema_hall__cinema__id__in=list_cinemas)
+        queryset = self.request.user.cinema_access.filter_reports(queryset)
 
         date_range = filter_params.get('date_range')
         if date_range:
@@ -124,7 +122,7 @@ class MonthlyReportView(LoginRequiredMixin, AccessToReportMixin, TableMixin, Lis
 
         cinemas = filter_params.get('cinemas')
         if cinemas:
-            queryset = queryset.filter(cinema_hall__cinema=cinemas)
+            queryset = queryset.filter(cinema=cinemas)
 
         dimensions = filter_params.get('dimensions')
         if dimensions:
@@ -132,15 +130,52 @@ class MonthlyReportView(LoginRequiredMixin, AccessToReportMixin, TableMixin, Lis
 
         return queryset
 
+    def get_user_cinema_ids(self):
+        """IDs of cinemas available to the user in reports, None means all cinemas"""
+        return self.request.user.cinema_access.report_cinema_ids
+
+    def get_report_date_range(self):
+        date_range = self.filter_form.cleaned_data.get('date_range')
+        return (date_range[0], date_range[1]) if date_range else (None, None)
+
+    def get_report_cache(self):
+        if not self.filter_form.is_valid():
+            return None
+
+        date_from, date_to = self.get_report_date_range()
+        return ReportCache(self.report_cache_name, get_form_filter_data(self.filter_form),
+                           self.group_by, self.get_user_cinema_ids(),
+                           date_from=date_from, date_to=date_to)
+
+    def get_cached_report(self, build_report):
+        report_cache = self.get_report_cache()
+        if report_cache is None:
+            return build_report()
+        return report_cache.get_or_build(build_report)
+
     def get_queryset(self):
 
         qs = self.model.objects.all()
 
         qs = self.filter_queryset(qs)
 
-        self.first_session = qs.first()
+        report = self.get_cached_report(lambda: self.build_report(qs))
+        self.first_session_id = report['first_session_id']
+        self.summary_data = report['summary_data']
+
+        return report['rows']
+
+    def get_first_session(self):
+        """The session the header of exported reports is filled from"""
+        return self.model.objects.select_related(
+            'film', 'dimension', 'cinema_hall__cinema__city', 'additional_agreement__contract',
+        ).filter(pk=self.first_session_id).first()
 
-        qs = qs.values('date').annotate(
+    def build_report(self, queryset):
+        # only the id is cached, names of the session's relations are read on export
+        first_session_id = queryset.values_list('pk', flat=True).first()
+
+        qs = queryset.values('date').annotate(
             sum_gross_yield=Sum('gross_yield'),
             sum_viewers_count=Sum('viewers_count'),
             sum_gross_yield_without_vat=Sum('gross_yield_without_vat'),
@@ -149,7 +184,14 @@ class MonthlyReportView(LoginRequiredMixin, AccessToReportMixin, TableMixin, Lis
 
         qs = qs.annotate(income=F('sum_gross_yield_without_vat') * settings.KINOMANIA_INCOME_FEE)
 
-        return qs
+        summary_data = qs.aggregate(
+                total_sum_gross_yield=Sum('sum_gross_yield'),
+                total_sum_viewers_count=Sum('sum_viewers_count'),
+                total_sum_gross_yield_without_vat=Sum('sum_gross_yield_without_vat'),
+                total_session_count=Sum('session_count'),
+                total_income=Sum('income'))
+
+        return dict(rows=list(qs), first_session_id=first_session_id, summary_data=summary_data)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -165,18 +207,11 @@ class MonthlyReportView(LoginRequiredMixin, AccessToReportMixin, TableMixin, Lis
                 dimension=filter_data['dimensions'],
             ).exists()
 
-        if not self.request.GET.get('export_group_by'):
-            self.summary_data = self.get_summary_data(self.object_list)
-
         return context
 
     def get_summary_data(self, queryset):
-        return queryset.aggregate(
-                total_sum_gross_yield=Sum('sum_gross_yield'),
-                total_sum_viewers_count=Sum('sum_viewers_count'),
-                total_sum_gross_yield_without_vat=Sum('sum_gross_yield_without_vat'),
-                total_session_count=Sum('session_count'),
-                total_income=Sum('income'))
+        """Summary is built and cached together with the report rows"""
+        return self.summary_data
 
 
 class MainReportView(MonthlyReportView):
@@ -184,6 +219,9 @@ class MainReportView(MonthlyReportView):
     template_name_ajax = 'dashboard/main_report_table.html'
 
     table_class = ReportTable
+    rollup_model = SessionDailyRollup
+    report_query_class = GroupedReportQuery
+    report_cache_name = 'main_report'
     filter_form_class = FilterReportForm
     session_csv_exporter_class = SessionCsvExporter
     export_report_form_class = ExportReportForm
@@ -224,18 +262,9 @@ class MainReportView(MonthlyReportView):
 
     def filter_queryset(self, queryset):
 
-        user = self.request.user
-
         queryset = queryset.filter(is_daily_report_finished=True)
 
-        if not user.is_superuser:
-            if not user.view_all_reports:
-                user_cinemas = set(list(chain_tools(
-                    self.request.user.report_cinemas.all(), self.request.user.cinemas.all()
-                )))
-
-                list_cinemas = [cinema.id for cinema in user_cinemas]
-                queryset = queryset.filter(cinema_hall__cinema__id__in=list_cinemas)
+        queryset = self.request.user.cinema_access.filter_reports(queryset)
 
         filter_params = self.filter_form.cleaned_data
         date_range = filter_params.get('date_range')
@@ -252,11 +281,11 @@ class MainReportView(MonthlyReportView):
 
         cities = filter_params.get('cities')
         if cities:
-            queryset = queryset.filter(cinema_hall__cinema__city__in=cities)
+            queryset = queryset.filter(city__in=cities)
 
         cinemas = filter_params.get('cinemas')
         if cinemas:
-            queryset = queryset.filter(cinema_hall__cinema__in=cinemas)
+            queryset = queryset.filter(cinema__in=cinemas)
 
         dimensions = filter_params.get('dimensions')
         if dimensions:
@@ -264,7 +293,7 @@ class MainReportView(MonthlyReportView):
 
         chains = filter_params.get('chains')
         if chains:
-            queryset = queryset.filter(cinema_hall__cinema__chain__in=chains)
+            queryset = queryset.filter(chain__in=chains)
 
         group_by = self.request.GET.get('export_group_by') or self.request.GET.get('group_by')
         self.group_by = group_by if group_by else self.group_by
@@ -273,33 +302,18 @@ class MainReportView(MonthlyReportView):
 
     def get_queryset(self):
 
-        qs = self.model.objects.all()
+        qs = self.rollup_model.objects.all()
 
         self.ungrouped_qs = self.filter_queryset(qs)
 
-        qs = self.ungrouped_qs.values(self.group_by).annotate(
-            sum_gross_yield=Sum('gross_yield'),
-            sum_seats_count=Sum('cinema_hall__seats_count'),
-            sum_viewers_count=Sum('viewers_count'),
-            sum_gross_yield_without_vat=Sum('gross_yield_without_vat'),
-            cinema_hall_count=Count('cinema_hall', distinct=True),
-            cinema_count=Count('cinema_hall__cinema', distinct=True),
-            session_count=Count('id'),
-            period=F(self.group_by),
-        )
+        rows, self.summary_data = self.get_cached_report(
+                lambda: self.report_query_class(self.ungrouped_qs, self.group_by).execute())
 
-        qs = qs.annotate(
-            average_attendance=Case(
-                When(sum_seats_count=0, then=0),
-                default=F(
-                    'sum_viewers_count') * 100 / F('sum_seats_count'), output_field=IntegerField()),
-            gross_yield_per_viewer=Case(
-                When(sum_viewers_count=0, then=0),
-                default=F('sum_gross_yield') / F('sum_viewers_count'), output_field=IntegerField()),
-            income=F('sum_gross_yield_without_vat') * settings.KINOMANIA_INCOME_FEE,
-        )
+        return rows
 
-        return qs.order_by(self.group_by)
+    def get_report_date_range(self):
+        date_range = self.filter_form.cleaned_data.get('date_range')
+        return (date_range.lower, date_range.upper) if date_range else (None, None)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -309,19 +323,6 @@ class MainReportView(MonthlyReportView):
 
         return context
 
-    def get_summary_data(self, queryset):
-        summary_data = super().get_summary_data(queryset)
-        summary_data.update(**queryset.aggregate(
-                    total_sum_seats_count=Sum('sum_seats_count'),
-                    total_average_attendance=Avg('average_attendance'),
-                    total_gross_yield_per_viewer=Avg('gross_yield_per_viewer')))
-
-        summary_data['total_cinema_count'] = Cinema.objects.filter(
-                halls__sessions__in=self.ungrouped_qs).distinct().count()
-        summary_data['total_cinema_hall_count'] = CinemaHall.objects.filter(
-                sessions__in=self.ungrouped_qs).distinct().count()
-        return summary_data
-
     def render_to_response(self, context, **response_kwargs):
         """Set location header to update windows.location.href after AJAX calls"""
         response = super().render_to_response(context, **response_kwargs)
@@ -404,7 +405,7 @@ class CinemaListView(DateViewMixin, LoginRequiredMixin, TableMixin, ListView):
     template_name = 'dashboard/cinema_list.html'
     context_object_name = 'cinemas'
     table_class = CinemaTable
-    max_days_ago = 90
+    max_days_ago = settings.REPORT_STATUS_CALENDAR_DAYS
 
     def dispatch(self, request, *args, **kwargs):
         if not request.user.is_superuser and request.user.cinemas.count() == 1:
@@ -430,25 +431,22 @@ class CinemaListView(DateViewMixin, LoginRequiredMixin, TableMixin, ListView):
 
         today = now().date()
 
-        users_cinemas = self.request.user.all_cinemas
+        date_from = today - timedelta(self.max_days_ago)
+        unfinished_counts = CinemaDayStatus.objects.get_calendar(
+                self.request.user.cinema_access.cinema_ids, date_from, today)
+
         unfinished_reports_dates = []
         finished_reports_dates = []
         no_agreements_dates = []
         for days in range(self.max_days_ago + 1):
             date = today - timedelta(days)
 
-            cinemas_filtered_by_date_count = len(set(AdditionalAgreement.objects.filter(
-                cinema__in=users_cinemas).filter_by_date(date).values_list('cinema', flat=True)))
-
-            if not cinemas_filtered_by_date_count:
+            if date not in unfinished_counts:
                 no_agreements_dates.append(date)
+            elif unfinished_counts[date]:
+                unfinished_reports_dates.append(date)
             else:
-                finished_reports_count = users_cinemas.filter(finished_on_dates__date=date).count()
-
-                if finished_reports_count != cinemas_filtered_by_date_count:
-                    unfinished_reports_dates.append(date)
-                else:
-                    finished_reports_dates.append(date)
+                finished_reports_dates.append(date)
 
         context['unfinished_reports_dates'] = unfinished_reports_dates
         context['finished_reports_dates'] = finished_reports_dates
@@ -468,19 +466,14 @@ class CreateSessionView(SessionMixin, CreateView):
         self.object = form.save(commit=False)
         self.object.date = self.date
         self.object.creator = self.request.user
-        self.object.save()
+        self.object.save(agreement_resolver=form.get_agreement_resolver())
         return super().form_valid(form)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        cinema_sessions = Session.objects.filter(cinema_hall__cinema__id=self.kwargs['pk'])
-        today_sessions_exists = cinema_sessions.filter(date=self.date).exists()
-        yesterday_sessions_exists = cinema_sessions.filter(
-                date=self.date - timedelta(days=1)).exists()
-
-        if not today_sessions_exists and yesterday_sessions_exists:
-            context['copy_yesterday_sessions_form'] = forms.Form()
+        if not self.page_data.sessions:
+            context['copy_yesterday_sessions_form'] = CopySessionsForm(date=self.date)
         return context
 
 
@@ -524,8 +517,8 @@ class SendUpdateSessionRequestView(SessionMixin, UpdateView):
     def session_table_title(self):
         return 'Вы хотите запросить изменение следующего сеанса:'
 
-    def get_queryset(self):
-        return super().get_queryset().filter(id=self.object.id)
+    def get_table_data(self):
+        return [session for session in self.page_data.sessions if session.pk == self.object.pk]
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -583,7 +576,7 @@ def delete_session(request, session_pk):
     if not user.is_superuser and session.is_daily_report_finished:
         return HttpResponse(status=403)
 
-    if session.cinema_hall.cinema not in user.all_cinemas:
+    if session.cinema_id not in user.cinema_access:
         return HttpResponse(status=403)
 
     session.delete()
@@ -596,7 +589,7 @@ def delete_session(request, session_pk):
 class BaseCinemaActionView(LoginRequiredMixin, DateViewMixin, CinemaPkMixin, View):
 
     def post(self, request, *args, **kwargs):
-        if self.cinema not in request.user.all_cinemas:
+        if self.cinema not in request.user.cinema_access:
             return HttpResponse(status=403)
 
 
@@ -610,18 +603,18 @@ class SetDailyReportFinishedView(BaseCinemaActionView):
         super().post(request, *args, **kwargs)
         cinema = self.cinema
 
-        if not Session.objects.filter(cinema_hall__cinema=cinema, date=self.date).exists():
+        if not Session.objects.filter(cinema=cinema, date=self.date).exists():
             messages.error(request, self.error_message)
             return HttpResponseRedirect(get_create_session_ulr(cinema, self.date))
 
-        current_cinema_agreements = AdditionalAgreement.objects.filter_by_date(
-            self.date).filter(cinema=cinema)
+        current_agreement_ids = set(AdditionalAgreement.objects.filter(
+            cinema=cinema).filter_by_day(self.date).values_list('pk', flat=True))
 
         agreements_with_sessions_count = len(set(
-            Session.objects.filter(additional_agreement__in=current_cinema_agreements,
+            Session.objects.filter(additional_agreement__in=current_agreement_ids,
                                    date=self.date).values_list('additional_agreement', flat=True)))
 
-        if agreements_with_sessions_count < current_cinema_agreements.count():
+        if agreements_with_sessions_count < len(current_agreement_ids):
             messages.error(request, 'Заполнены сеансы не по всем доп соглашениям')
             return HttpResponseRedirect(get_create_session_ulr(cinema, self.date))
 
@@ -663,7 +656,7 @@ class CreateConfirmedMonthlyReportView(LoginRequiredMixin, FormMixin, ProcessFor
         month_date = form.cleaned_data['date_range'][0]
 
         sessions = Session.objects.filter(
-                cinema_hall__cinema=cinema,
+                cinema=cinema,
                 date__year=month_date.year,
                 date__month=month_date.month,
                 film=film,
@@ -702,26 +695,25 @@ class CreateConfirmedMonthlyReportView(LoginRequiredMixin, FormMixin, ProcessFor
         return HttpResponseRedirect(previous_url)
 
 
-class CopyYesterdaysSessionsView(DateViewMixin, LoginRequiredMixin, View):
+class CopyYesterdaysSessionsView(DateViewMixin, LoginRequiredMixin, CinemaPkMixin, View):
+    """Copies yesterday's sessions, or sessions of the posted date range, to the
+    same number of days starting from the date"""
 
-    @transaction.atomic
     def post(self, request, pk, date):
-        cinema_pk = self.kwargs['pk']
-
-        yesterday_sessions = Session.objects.filter(
-                cinema_hall__cinema__id=cinema_pk, date=self.date-timedelta(days=1))
-
-        for session in yesterday_sessions:
-            session.pk = None
-            session.date = self.date
-            session.viewers_count = 0
-            session.invitations_count = 0
-            session.gross_yield = 0
-            session.is_daily_report_finished = False
-            session.save()
+        form = CopySessionsForm(request.POST, date=self.date)
+        if form.is_valid():
+            sessions = BulkSessionWriter().copy(
+                    self.cinema, form.cleaned_data['source_date_from'],
+                    form.cleaned_data['source_date_to'], self.date)
+            if sessions:
+                messages.success(request, 'Скопировано сеансов: {}'.format(len(sessions)))
+            else:
+                messages.warning(request, 'Нет сеансов для копирования.')
+        else:
+            put_forms_errors_to_messages(request, form)
 
         create_session_url = reverse('create_session', kwargs={
-            'pk': cinema_pk,
+            'pk': self.cinema.pk,
             'date': self.date_str})
 
         return HttpResponseRedirect(create_session_url)
@@ -762,7 +754,7 @@ class SendDailyReportEmailView(SuperuserRequiredMixin, DateViewMixin, View):
             messages.error(self.request, 'Нет кинотеатра с указанным pk.')
             return HttpResponseRedirect(self.get_success_url())
 
-        if cinema not in self.request.user.all_cinemas:
+        if cinema not in self.request.user.cinema_access:
             messages.error(self.request, 'Вы не можете послать письмо по этому кинотеатру.')
             return HttpResponseRedirect(self.get_success_url())
 
@@ -863,10 +855,7 @@ class ChangeSessionsDateView(LoginRequiredMixin, FormMixin, CinemaPkMixin,
     def form_valid(self, form):
         self.change_date_to = form.cleaned_data['change_date_to']
 
-        """Method save() must be called to mail admin if additional agreement doesn't exists"""
-        for session in Session.objects.filter(cinema_hall__cinema=self.cinema, date=self.date):
-            session.date = self.change_date_to
-            session.save()
+        BulkSessionWriter().move(self.cinema, self.date, self.change_date_to)
 
         messages.success(self.request, self.form_valid_message)
         return HttpResponseRedirect(self.get_success_url())
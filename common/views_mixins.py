@@ -4,10 +4,10 @@ from braces.views import FormValidMessageMixin
 from braces.views._access import LoginRequiredMixin
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db.models import Sum
 from django.http import HttpResponseRedirect, Http404
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
+from django.utils.functional import cached_property
 from django.utils.timezone import now
 from django_tables2 import RequestConfig
 
@@ -30,8 +30,9 @@ class AccessToReportMixin:
 class CinemaPkMixin:
     def dispatch(self, request, *args, **kwargs):
 
-        self.cinema = get_object_or_404(Cinema, pk=self.kwargs['pk'])
-        if self.cinema not in request.user.all_cinemas:
+        self.cinema = get_object_or_404(Cinema.objects.select_related('city', 'chain'),
+                                        pk=self.kwargs['pk'])
+        if self.cinema not in request.user.cinema_access:
             raise Http404('Нет такого кинотеатра')
 
         return super().dispatch(request, *args, **kwargs)
@@ -39,9 +40,12 @@ class CinemaPkMixin:
 
 class TableMixin:
 
+    def get_table_data(self):
+        return self.object_list if hasattr(self, 'object_list') else self.get_queryset()
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        table = self.table_class(data=self.get_queryset(), request=self.request)
+        table = self.table_class(data=self.get_table_data(), request=self.request)
         RequestConfig(self.request, paginate={'per_page': self.paginate_by}).configure(table)
         context['table'] = table
         return context
@@ -59,6 +63,63 @@ class DateViewMixin:
         return super().dispatch(request, *args, **kwargs)
 
 
+class SessionPageData:
+    """Everything the session page of a cinema and date reads from the database.
+
+    The sessions table, its footer, both session forms and the access check share one
+    instance per request, so each piece is loaded at most once.
+    """
+
+    SUMMARY_FIELDS = ('invitations_count', 'viewers_count', 'gross_yield')
+
+    def __init__(self, cinema, date, user, order_by_time=False):
+        self.cinema = cinema
+        self.date = date
+        self.user = user
+        self.order_by_time = order_by_time
+
+    def get_queryset(self):
+        qs = Session.objects.filter(date=self.date, cinema=self.cinema).select_related(
+                'cinema_hall__cinema', 'film', 'dimension')
+
+        if self.order_by_time:
+            return qs.order_by('time')
+
+        return qs.order_by('film', 'dimension', 'time')
+
+    @cached_property
+    def sessions(self):
+        return list(self.get_queryset())
+
+    @cached_property
+    def summary_data(self):
+        """Same values as the `Sum` aggregates, `None` when there are no sessions"""
+        return {'total_{}'.format(name): sum(getattr(session, name) for session in self.sessions)
+                if self.sessions else None for name in self.SUMMARY_FIELDS}
+
+    @cached_property
+    def agreement_options(self):
+        return SessionForm.get_agreement_options(self.cinema, self.date)
+
+    @cached_property
+    def user_is_allowed(self):
+        if self.user.is_superuser:
+            return True
+        # cinemas the user is responsible for or has access to reports of, viewing all reports
+        # doesn't allow to edit sessions
+        report_cinema_ids = self.user.cinema_access.report_cinema_ids
+        return report_cinema_ids is not None and self.cinema.pk in report_cinema_ids
+
+    @cached_property
+    def is_daily_report_finished(self):
+        return self.cinema.is_report_finished(self.date)
+
+    @cached_property
+    def last_created_session(self):
+        return Session.objects.filter(cinema=self.cinema, creator=self.user).select_related(
+                'film', 'dimension').order_by('created').last()
+
+
 class SessionMixin(LoginRequiredMixin, DateViewMixin, CinemaPkMixin,
                    FormValidMessageMixin, TableMixin):
     template_name = 'dashboard/create_or_update_session.html'
@@ -68,6 +129,11 @@ class SessionMixin(LoginRequiredMixin, DateViewMixin, CinemaPkMixin,
     paginate_by = 20
     context_object_name = 'sessions'
 
+    @cached_property
+    def page_data(self):
+        return SessionPageData(self.cinema, self.date, self.request.user,
+                               order_by_time='order-by-time' in self.request.GET)
+
     def get_form_kwargs(self):
         kwargs = super().get_form_kwargs()
         kwargs['cinema'] = self.cinema
@@ -77,40 +143,29 @@ class SessionMixin(LoginRequiredMixin, DateViewMixin, CinemaPkMixin,
         kwargs['form_action'] = self.get_form_action()
         kwargs['create_session_url'] = self.get_create_session_url()
         kwargs['view_name'] = self.request.resolver_match.url_name
+        kwargs['agreement_options'] = self.page_data.agreement_options
         return kwargs
 
     def get_success_url(self):
         return self.get_create_session_url()
 
     def get_queryset(self):
-        qs = Session.objects.filter(date=self.date)
-        qs = qs.filter(cinema_hall__cinema__id=self.kwargs['pk'])
-
-        self.summary_data = qs.aggregate(
-                total_invitations_count=Sum('invitations_count'),
-                total_viewers_count=Sum('viewers_count'),
-                total_gross_yield=Sum('gross_yield'))
+        return self.page_data.get_queryset()
 
-        qs = qs.select_related('cinema_hall__cinema', 'film', 'dimension')
+    def get_table_data(self):
+        return self.page_data.sessions
 
-        if 'order-by-time' in self.request.GET:
-            return qs.order_by('time')
-
-        return qs.order_by('film', 'dimension', 'time')
+    @property
+    def summary_data(self):
+        return self.page_data.summary_data
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['cinema'] = self.cinema
-        context['sessions'] = self.get_queryset()
-        context['user_is_allowed'] = False
-        if self.request.user in self.cinema.access_to_reports.all():
-            context['user_is_allowed'] = True
-        if self.request.user in self.cinema.responsible_for_daily_reports.all():
-            context['user_is_allowed'] = True
-        if self.request.user.is_superuser:
-            context['user_is_allowed'] = True
+        context['sessions'] = self.page_data.sessions
+        context['user_is_allowed'] = self.page_data.user_is_allowed
         context['table'].exclude = ('date', )
-        context['is_daily_report_finished'] = self.cinema.is_report_finished(self.date)
+        context['is_daily_report_finished'] = self.page_data.is_daily_report_finished
         if not context['is_daily_report_finished']:
             context['last_form'] = self.get_last_form()
             context['change_session_form'] = ChangeSessionsDateForm(
@@ -126,9 +181,7 @@ class SessionMixin(LoginRequiredMixin, DateViewMixin, CinemaPkMixin,
         from common.views import CreateSessionView
 
         if isinstance(self, CreateSessionView):
-            last_created_session = Session.objects.filter(
-                cinema_hall__cinema=self.cinema, creator=self.request.user).order_by(
-                    'created').last()
+            last_created_session = self.page_data.last_created_session
 
             if last_created_session:
                 last_created_session.time = None
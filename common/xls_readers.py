@@ -0,0 +1,88 @@
+import os
+from datetime import datetime, time
+from zipfile import BadZipFile
+
+import openpyxl
+import xlrd
+from openpyxl.utils.exceptions import InvalidFileException
+from xlrd import XLRDError
+
+
+class InvalidReportFile(Exception):
+    pass
+
+
+class XlsReader:
+    """Rows of the first sheet of a `.xls` file.
+
+    Cell formatting is not read and the workbook is opened on demand, so only the first
+    sheet is loaded and its resources are released once the rows are read.
+    """
+
+    def __init__(self, path, xls_file=None):
+        file_contents = None
+        if xls_file:
+            xls_file.seek(0)
+            file_contents = xls_file.read()
+        try:
+            self.book = xlrd.open_workbook(path, file_contents=file_contents, on_demand=True)
+        except XLRDError as e:
+            raise InvalidReportFile(e)
+
+    def iter_rows(self):
+        try:
+            sheet = self.book.sheet_by_index(0)
+            for row_num in range(sheet.nrows):
+                yield sheet.row_values(row_num)
+        finally:
+            self.book.release_resources()
+
+
+class XlsxReader:
+    """Rows of the first sheet of a `.xlsx` file read as a stream of cell values.
+
+    Rows are padded to the sheet width, like rows of `xlrd`, and empty cells are `''`.
+    """
+
+    def __init__(self, path, xls_file=None):
+        try:
+            self.book = openpyxl.load_workbook(xls_file or path, read_only=True, data_only=True)
+        except (InvalidFileException, BadZipFile, KeyError) as e:
+            raise InvalidReportFile(e)
+
+    @staticmethod
+    def get_value(value):
+        if value is None:
+            return ''
+        if isinstance(value, datetime):
+            # dates are compared with texts of `.xls` reports
+            return value.strftime('%d.%m.%Y' if value.time() == time.min else '%d.%m.%Y %H:%M:%S')
+        return value
+
+    def iter_rows(self):
+        try:
+            sheet = self.book.worksheets[0]
+            width = sheet.max_column or 0
+            for row in sheet.iter_rows():
+                values = [self.get_value(cell.value) for cell in row]
+                yield values + [''] * (width - len(values))
+        finally:
+            self.book.close()
+
+
+READERS = {
+    '.xls': XlsReader,
+    '.xlsx': XlsxReader,
+}
+
+
+def open_report(path, xls_file=None):
+    """Reader of the report file chosen by its extension.
+
+    The content is read from `xls_file` when it is given, e.g. for files which were
+    uploaded but not saved, `path` is then only used for the extension.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in READERS:
+        raise InvalidReportFile('Unsupported file format: {}'.format(ext))
+    return READERS[ext](path, xls_file)
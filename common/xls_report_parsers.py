@@ -1,18 +1,21 @@
 import copy
 import json
+import os
 import re
+from collections import defaultdict
 from datetime import datetime
 from decimal import Decimal
 
-import xlrd
 from dateutil import parser
-from django.core.exceptions import MultipleObjectsReturned
-from django.db import IntegrityError
+from django.core.files import File
+from django.db import transaction
+from django.db.models import Q
 from prettytable import PrettyTable
-from xlrd import XLRDError
 
 from common.models import Session, CinemaHall, Film, Cinema, Chain, Dimension, \
-    FinishedCinemaReportDate
+    FinishedCinemaReportDate, XlsSessionsReport
+from common.session_writer import BulkSessionWriter
+from common.xls_readers import InvalidReportFile, open_report
 from kinomania.utils import StrEncoder
 
 
@@ -23,25 +26,25 @@ class XlsReportParser:
     SESSION_END_TEXT = 'Всього за Сеанс'
     CHAIN_NAME = 'Multiplex'
 
-    def __init__(self, path_to_xls, xls_report, city=None):
+    def __init__(self, path_to_xls, xls_report=None, city=None, xls_file=None):
         self.xls_report = xls_report
+        self.content_hash = xls_report.content_hash if xls_report else ''
         self.all_sessions_data = []
         self.errors = set()
         self.city = city
         try:
-            rb = xlrd.open_workbook(path_to_xls, formatting_info=True)
-        except XLRDError:
+            self.reader = open_report(path_to_xls, xls_file)
+        except InvalidReportFile:
             self.is_file_invalid = True
         else:
             self.is_file_invalid = False
-            self.sheet = rb.sheet_by_index(0)
 
     def parse_xls_file(self):
         """First stage"""
         save_rows = None
         film_block = []
-        for row_num in range(self.sheet.nrows):
-            row_values = [str(val).strip() for val in self.sheet.row_values(row_num)]
+        for row in self.reader.iter_rows():
+            row_values = [str(val).strip() for val in row]
             if any(row_values):
                 for col_num, cell_value in enumerate(row_values):
                     if cell_value == self.BLOCK_BEGIN_TEXT:
@@ -105,6 +108,34 @@ class XlsReportParser:
             if data_rows:
                 session_data['prices'].append(row[4])
 
+    def find_cinema(self, cinema_name, cinemas):
+        """The only cinema of the found ones, an error is added for none or several"""
+        if not cinemas:
+            error_text = 'В базі даних немає кінотеатру з такою  назвою: "{}"'.format(cinema_name)
+            if self.city:
+                error_text += ', в місті "{}"'.format(self.city.name)
+
+            self.errors.add(error_text)
+            return None
+
+        if len(cinemas) > 1:
+            self.errors.add('В базі даних  декілька кінотеатрів з такою  назвою: "{}". '
+                            'Попробуйте вказати місто перед загрузкою файлу.'.format(cinema_name))
+            return None
+        return cinemas[0]
+
+    @staticmethod
+    def get_session_dates(all_sessions_data):
+        return [datetime.strptime(session_data['raw_date'], '%d.%m.%Y').date()
+                for session_data in all_sessions_data]
+
+    @staticmethod
+    def get_existing_keys(halls, dates):
+        """Content hashes of the files existing sessions were imported from by session keys"""
+        return {row[:4]: row[4] for row in Session.objects.filter(
+                cinema_hall__in=halls, date__in=set(dates)).values_list(
+                'cinema_hall', 'time', 'date', 'dimension', 'xls_session_report__content_hash')}
+
     def create_sessions(self, all_sessions_data, chain):
         """Third stage"""
 
@@ -115,48 +146,63 @@ class XlsReportParser:
         if self.city:
             cinema_params['city'] = self.city
 
-        try:
-            cinema = Cinema.objects.get(**cinema_params)
-        except Cinema.DoesNotExist:
-            error_text = 'В базі даних немає кінотеатру з такою  назвою: "{}"'.format(
-                    cinema_params['name__iexact'])
-            if self.city:
-                error_text += ', в місті "{}"'.format(self.city.name)
-
-            self.errors.add(error_text)
+        cinema = self.find_cinema(cinema_name, list(Cinema.objects.filter(**cinema_params)[:2]))
+        if not cinema:
             return
 
-        except MultipleObjectsReturned:
-            self.errors.add('В базі даних  декілька кінотеатрів з такою  назвою: "{}". '
-                            'Попробуйте вказати місто перед загрузкою файлу.'.format(
-                                    cinema_params['name__iexact']))
-            return
-
-        for session_data in all_sessions_data:
+        # files of the same cinema are imported one after another, so the duplicate
+        # checks below see sessions of the concurrently processed files
+        with transaction.atomic():
+            cinema = Cinema.objects.select_for_update().get(pk=cinema.pk)
+
+            session_dates = self.get_session_dates(all_sessions_data)
+            halls = self.get_halls(cinema)
+            films, original_films = self.get_films(
+                    {session_data['film_name'] for session_data in all_sessions_data})
+            sessions = self.build_sessions(
+                    all_sessions_data, session_dates, cinema, halls, self.get_dimensions(),
+                    films, original_films, self.get_existing_keys(halls.values(), session_dates))
+
+            # finished dates go first, the writer refreshes report statuses of these dates
+            report_dates = {session.date for session in sessions}
+            finished_dates = set(FinishedCinemaReportDate.objects.filter(
+                    cinema=cinema, date__in=report_dates).values_list('date', flat=True))
+            FinishedCinemaReportDate.objects.bulk_create([
+                FinishedCinemaReportDate(cinema=cinema, date=report_date)
+                for report_date in report_dates - finished_dates])
+
+            BulkSessionWriter().write(sessions)
+
+    def build_sessions(self, all_sessions_data, session_dates, cinema, halls, dimensions, films,
+                       original_films, existing_keys):
+        """Unsaved sessions of the parsed data, data which does not match the database is
+        added to errors"""
+        # sessions of earlier imports of the same file are skipped without errors,
+        # so a re-uploaded file only adds the sessions which failed before
+        content_hash = self.content_hash
+
+        sessions = []
+        for session_data, session_date in zip(all_sessions_data, session_dates):
 
             hall_name = session_data.get('hall_name', '')
-            cinema_hall = CinemaHall.objects.filter(cinema=cinema, name__iexact=hall_name).first()
+            cinema_hall = halls.get(hall_name.lower())
             if not cinema_hall:
                 if '№' in hall_name:
                     hall_name = hall_name.replace('№', '')
                 else:
                     hall_name = '№' + hall_name
-                cinema_hall = CinemaHall.objects.filter(
-                        cinema=cinema, name__iexact=hall_name).first()
+                cinema_hall = halls.get(hall_name.lower())
                 if not cinema_hall:
                     self.errors.add('У кинотеатра "{}" нет зала с названием "{}"'.format(
                             cinema.name, hall_name))
                     continue
 
-            try:
-                dimension = Dimension.objects.get(name__iexact=session_data['dimension_name'])
-            except Dimension.DoesNotExist:
+            dimension = dimensions.get(session_data['dimension_name'].lower())
+            if not dimension:
                 self.errors.add('В базе данных нет формата с названием "{}"'.format(
                         session_data['dimension_name']))
                 continue
 
-            session_date = datetime.strptime(session_data['raw_date'], '%d.%m.%Y').date()
-
             params = dict(
                 dimension=dimension,
                 cinema_hall=cinema_hall,
@@ -164,18 +210,19 @@ class XlsReportParser:
                 time=parser.parse(session_data['raw_time']).time(),
             )
 
-            if Session.objects.filter(**params).exists():
-                self.errors.add('Сеанс {} уже существует'.format(
-                      json.dumps(params, cls=StrEncoder)))
+            session_key = (cinema_hall.pk, params['time'], session_date, dimension.pk)
+            if session_key in existing_keys:
+                if not content_hash or existing_keys[session_key] != content_hash:
+                    self.errors.add('Сеанс {} уже существует'.format(
+                          json.dumps(params, cls=StrEncoder)))
                 continue
+            existing_keys[session_key] = None
 
-            try:
-                film = Film.objects.get(
-                    name__iexact=session_data['film_name'])
-                is_original_language = False
-            except (Film.DoesNotExist, MultipleObjectsReturned):
-                film = Film.objects.filter(
-                    name_original__iexact=session_data['film_name']).first()
+            film_name = session_data['film_name'].lower()
+            film = films.get(film_name)
+            is_original_language = False
+            if not film:
+                film = original_films.get(film_name)
                 is_original_language = True
 
             if not film:
@@ -196,12 +243,65 @@ class XlsReportParser:
             params['xls_session_report'] = self.xls_report
             params['is_original_language'] = is_original_language
 
-            Session.objects.create(**params)
+            sessions.append(Session(**params))
+        return sessions
 
-            try:
-                FinishedCinemaReportDate.objects.create(date=session_date, cinema=cinema)
-            except IntegrityError:
-                pass
+    def dry_run(self, reference, existing_keys):
+        """Resolves the parsed sessions against reference data without writing anything,
+        returns the number of sessions which would be imported"""
+        if not self.all_sessions_data:
+            return 0
+
+        cinema_name = self.all_sessions_data[0]['cinema_name']
+        cinema = self.find_cinema(cinema_name, reference.cinemas.get(cinema_name.lower(), []))
+        if not cinema:
+            return 0
+
+        sessions = self.build_sessions(
+                self.all_sessions_data, self.get_session_dates(self.all_sessions_data), cinema,
+                reference.halls[cinema.pk], reference.dimensions, reference.films,
+                reference.original_films, existing_keys)
+        return len(sessions)
+
+    @staticmethod
+    def get_halls(cinema):
+        """Halls of the cinema by lowercased name, the first one for duplicate names"""
+        halls = {}
+        for hall in CinemaHall.objects.filter(cinema=cinema).select_related(
+                'cinema').order_by('pk'):
+            halls.setdefault(hall.name.lower(), hall)
+        return halls
+
+    @staticmethod
+    def get_dimensions():
+        return {dimension.name.lower(): dimension for dimension in Dimension.objects.all()}
+
+    @staticmethod
+    def get_films(film_names):
+        """Films by lowercased name and by lowercased original name.
+
+        A name shared by several films is looked up among original names, like
+        `Film.objects.get(name__iexact=...)` failing with `MultipleObjectsReturned` did.
+        """
+        if not film_names:
+            return {}, {}
+
+        # names are compared by the database like `iexact` does, so a database locale
+        # that doesn't lowercase non-ASCII letters gives the same result
+        lookups = Q()
+        for name in film_names:
+            lookups |= Q(name__iexact=name) | Q(name_original__iexact=name)
+        film_names = {name.lower() for name in film_names}
+
+        by_name = defaultdict(list)
+        by_original_name = {}
+        for film in Film.objects.filter(lookups).order_by('pk'):
+            by_name[film.name.lower()].append(film)
+            if film.name_original:
+                by_original_name.setdefault(film.name_original.lower(), film)
+        return ({name: found[0] for name, found in by_name.items()
+                 if name in film_names and len(found) == 1},
+                {name: film for name, film in by_original_name.items() if name in film_names})
 
     def handle(self):
 
@@ -219,3 +319,120 @@ class XlsReportParser:
             if self.errors:
                 self.xls_report.errors = list(self.errors)
                 self.xls_report.save(parse_file=False)
+
+
+class XlsReferenceData:
+    """Cinemas of the chain with their halls, dimensions and films loaded once for
+    checking many files"""
+
+    def __init__(self, city=None, film_names=()):
+        self.chain = Chain.objects.filter(name__iexact=XlsReportParser.CHAIN_NAME).first()
+        self.cinemas = defaultdict(list)
+        self.halls = defaultdict(dict)
+        if self.chain:
+            cinemas = Cinema.objects.filter(chain=self.chain)
+            if city:
+                cinemas = cinemas.filter(city=city)
+            for cinema in cinemas:
+                self.cinemas[cinema.name.lower()].append(cinema)
+            for hall in CinemaHall.objects.filter(cinema__in=cinemas).order_by('pk'):
+                self.halls[hall.cinema_id].setdefault(hall.name.lower(), hall)
+
+        self.dimensions = XlsReportParser.get_dimensions()
+        self.films, self.original_films = XlsReportParser.get_films(film_names)
+
+    def get_halls(self, cinema_name):
+        """Halls of all cinemas with the name"""
+        return [hall for cinema in self.cinemas.get(cinema_name.lower(), [])
+                for hall in self.halls[cinema.pk].values()]
+
+
+class XlsDryRun:
+    """Checks report files against the database without importing them.
+
+    All files are parsed first, then their sessions are resolved against reference data
+    and existing sessions loaded with a few queries for all files. Errors are grouped by
+    their text with the names of the files they were found in.
+    """
+
+    def __init__(self, xls_files, city=None):
+        # paths or file objects, e.g. uploaded files
+        self.xls_files = xls_files
+        self.city = city
+
+    def get_parser(self, xls_file):
+        if isinstance(xls_file, str):
+            name = os.path.basename(xls_file)
+            with open(xls_file, 'rb') as f:
+                content_hash = XlsSessionsReport.get_content_hash(File(f))
+            xls_parser = XlsReportParser(path_to_xls=xls_file, city=self.city)
+        else:
+            name = xls_file.name
+            content_hash = XlsSessionsReport.get_content_hash(xls_file)
+            xls_parser = XlsReportParser(path_to_xls=name, city=self.city, xls_file=xls_file)
+        xls_parser.content_hash = content_hash
+        return name, xls_parser
+
+    def run(self):
+        """Returns files with the numbers of sessions they would import and grouped errors"""
+        parsers = []
+        for xls_file in self.xls_files:
+            name, xls_parser = self.get_parser(xls_file)
+            parsers.append(dict(name=name, parser=xls_parser, sessions_count=0, skipped=''))
+
+        imported_copies = dict(XlsSessionsReport.get_imported_copies(
+            {item['parser'].content_hash for item in parsers}).values_list(
+            'content_hash', 'xls_filename'))
+        names = {}
+        for item in parsers:
+            xls_parser = item['parser']
+            if xls_parser.is_file_invalid:
+                xls_parser.errors.add('Файл повреждён.')
+            elif xls_parser.content_hash in imported_copies:
+                item['skipped'] = 'Файл уже загружен: {}'.format(
+                        imported_copies[xls_parser.content_hash])
+            elif xls_parser.content_hash in names:
+                item['skipped'] = 'Копия файла {}'.format(names[xls_parser.content_hash])
+            else:
+                names[xls_parser.content_hash] = item['name']
+                try:
+                    item['session_dates'] = xls_parser.get_session_dates(
+                            xls_parser.parse_xls_file())
+                except Exception as e:
+                    xls_parser.errors.add('Ошибка обработки файла: {}'.format(e))
+
+        checked = [item for item in parsers if 'session_dates' in item]
+        reference = XlsReferenceData(city=self.city, film_names={
+            session_data['film_name']
+            for item in checked for session_data in item['parser'].all_sessions_data})
+        if not reference.chain:
+            for item in checked:
+                item['parser'].errors.add('В базе данных нет сети с названием "{}"'.format(
+                        XlsReportParser.CHAIN_NAME))
+            checked = []
+
+        halls = set()
+        for item in checked:
+            if item['parser'].all_sessions_data:
+                halls.update(reference.get_halls(
+                        item['parser'].all_sessions_data[0]['cinema_name']))
+        existing_keys = XlsReportParser.get_existing_keys(
+                halls, {date for item in checked for date in item['session_dates']})
+
+        for item in checked:
+            try:
+                item['sessions_count'] = item['parser'].dry_run(reference, existing_keys)
+            except Exception as e:
+                item['parser'].errors.add('Ошибка обработки файла: {}'.format(e))
+
+        errors = defaultdict(list)
+        for item in parsers:
+            for error in item['parser'].errors:
+                errors[error].append(item['name'])
+
+        return dict(
+            files=[dict(name=item['name'], sessions_count=item['sessions_count'],
+                        errors_count=len(item['parser'].errors), skipped=item['skipped'])
+                   for item in parsers],
+            errors=sorted(errors.items(), key=lambda error: (-len(error[1]), error[0])),
+        )
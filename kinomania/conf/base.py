@@ -133,6 +133,17 @@ REPORT_DATE_LIMITATION_MONTHS = 3
 
 KINOMANIA_INCOME_FEE = 0.5   # 50%
 
+REPORT_CACHE_TIMEOUT = 60 * 60 * 24  # seconds
+CINEMA_ACCESS_CACHE_TIMEOUT = 60 * 5  # seconds
+FILTER_CATALOG_CACHE_TIMEOUT = 60 * 60 * 24  # seconds
+# how many days back the cinema list calendar shows report statuses
+REPORT_STATUS_CALENDAR_DAYS = 90
+# open-ended agreements get agreement days and daily report statuses that many days ahead
+CINEMA_DAY_STATUS_DAYS_AHEAD = 31
+DAILY_REPORTS_EMAILS_BATCH_SIZE = 100
+# sessions updated per transaction when an agreement is re-linked
+AGREEMENT_RELINK_CHUNK_SIZE = 5000
+
 ADMIN_REORDER = (
     'sites',
 
@@ -155,6 +166,7 @@ ADMIN_REORDER = (
         'label': 'Сеансы',
         'models': (
             'common.Session',
+            'common.SessionAgreementAlert',
         )
     },
     {
@@ -174,6 +186,7 @@ ADMIN_REORDER = (
             'common.GeneralContract',
             'common.CinemaHall',
             'common.AdditionalAgreement',
+            'common.AgreementRelinkJob',
             'common.ContactInformation',
             'common.FinishedCinemaReportDate',
             'common.ConfirmedMonthlyReport',
@@ -248,6 +261,10 @@ LOGGING = {
         'celery_tasks': {
             'handlers': ['console', 'mail_admins'],
             'level': 'INFO'
+        },
+        'common': {
+            'handlers': ['console'],
+            'level': 'INFO'
         }
     }
 }
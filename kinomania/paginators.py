@@ -0,0 +1,89 @@
+import hashlib
+
+from django.core.cache import cache
+from django.core.paginator import Paginator, Page
+from django.db import connection
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+
+def get_seek_q(key_fields, values):
+    """Condition selecting rows after `values` in the order of `key_fields`.
+    For ('-date', '-pk') it is: date < d OR (date = d AND pk < p)"""
+    q = Q()
+    equal = {}
+    for field, value in zip(key_fields, values):
+        name = field.lstrip('-')
+        lookup = '{}__{}'.format(name, 'lt' if field.startswith('-') else 'gt')
+        q |= Q(**dict(equal, **{lookup: value}))
+        equal[name] = value
+    return q
+
+
+def get_key_values(obj, key_fields):
+    return tuple(getattr(obj, field.lstrip('-')) for field in key_fields)
+
+
+class KeysetPaginator(Paginator):
+    """Seeks pages by the ordering key instead of OFFSET.
+
+    The last key of every served page is cached as the start of the next one, so
+    browsing page by page always seeks through the index. Jumping to a page whose
+    start is unknown looks the key up once with a narrow index-only query.
+    """
+
+    key_fields = ('-date', '-pk')
+    boundary_cache_timeout = 60 * 10
+    # tables with fewer estimated rows are counted exactly
+    min_estimated_count = 100000
+
+    def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True,
+                 key_fields=None):
+        if key_fields:
+            self.key_fields = key_fields
+        super().__init__(object_list.order_by(*self.key_fields), per_page, 0,
+                         allow_empty_first_page)
+
+    @cached_property
+    def count(self):
+        if not self.object_list.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE relname = %s',
+                               [self.object_list.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] >= self.min_estimated_count:
+                return row[0]
+        return super().count
+
+    def get_boundary_cache_key(self, number):
+        query_hash = hashlib.md5(str(self.object_list.query).encode()).hexdigest()
+        return 'keyset_page:{}:{}:{}'.format(query_hash, self.per_page, number)
+
+    def get_page_start(self, number):
+        """Key of the last row of the previous page"""
+        if number == 1:
+            return None
+
+        cache_key = self.get_boundary_cache_key(number)
+        start = cache.get(cache_key)
+        if start is None:
+            field_names = [field.lstrip('-') for field in self.key_fields]
+            start = self.object_list.values_list(*field_names)[(number - 1) * self.per_page - 1]
+            cache.set(cache_key, start, self.boundary_cache_timeout)
+        return start
+
+    def page(self, number):
+        number = self.validate_number(number)
+
+        queryset = self.object_list
+        start = self.get_page_start(number)
+        if start is not None:
+            queryset = queryset.filter(get_seek_q(self.key_fields, start))
+
+        object_list = list(queryset[:self.per_page])
+        if object_list:
+            cache.set(self.get_boundary_cache_key(number + 1),
+                      get_key_values(object_list[-1], self.key_fields),
+                      self.boundary_cache_timeout)
+
+        return Page(object_list, number, self)
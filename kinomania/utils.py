@@ -3,7 +3,6 @@ import os
 import random
 import sys
 
-import math
 from datetime import timedelta
 
 from django.conf import settings
@@ -63,7 +62,7 @@ class StrEncoder(json.JSONEncoder):
 
 def validate_xls_extension(value):
     ext = os.path.splitext(value.name)[1]
-    valid_formats = ['.xls']
+    valid_formats = ['.xls', '.xlsx']
     if ext.lower() not in valid_formats:
         raise ValidationError('Only {} files.'.format(', '.join(valid_formats)))
 
@@ -113,10 +112,20 @@ def add_dimension(objects_list):
 
 
 def chunks(qs, chunk_size=10000):
-    chunks_count = math.ceil(qs.count() / chunk_size)
-    for i in range(chunks_count):
-        offset, limit = i * chunk_size, (i + 1) * chunk_size
-        yield qs[offset:limit]
+    """Yields lists of objects ordered by primary key.
+    Every chunk seeks past the last pk of the previous one, so there is no
+    count() or OFFSET and rows inserted meanwhile never shift the chunks."""
+    qs = qs.order_by('pk')
+    last_pk = None
+    while True:
+        chunk_qs = qs if last_pk is None else qs.filter(pk__gt=last_pk)
+        chunk = list(chunk_qs[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last_pk = chunk[-1].pk
 
 
 def build_full_url(url):
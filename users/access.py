@@ -0,0 +1,102 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from common.models import Cinema
+
+VERSION_KEY_PREFIX = 'cinema_access_version'
+# longer id lists are passed to the database as a subquery
+MAX_INLINE_IDS = 500
+
+
+def access_version_key(user_id):
+    return '{}:{}'.format(VERSION_KEY_PREFIX, user_id)
+
+
+def bump_access_versions(user_ids):
+    """Invalidates cached cinema sets of the given users"""
+    for user_id in user_ids:
+        try:
+            cache.incr(access_version_key(user_id))
+        except ValueError:  # counter was never read or was evicted
+            pass
+
+
+def get_access_version(user_id):
+    key = access_version_key(user_id)
+    cache.add(key, 0, None)
+    return cache.get(key, 0)
+
+
+class CinemaAccess:
+    """Cinemas available to a user.
+
+    Built once per request (see `User.cinema_access`) from a short-lived cache, which is
+    keyed by the user and the version bumped on every change of the user's cinemas.
+    `None` ids mean the user has access to all cinemas.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.is_unrestricted = user.is_superuser or user.view_all_reports
+        self._ids = None
+
+    def load(self):
+        if self._ids is None:
+            key = 'cinema_access:{}:{}'.format(self.user.pk, get_access_version(self.user.pk))
+            ids = cache.get(key)
+            if ids is None:
+                ids = dict(
+                    cinemas=list(Cinema.responsible_for_daily_reports.through.objects.filter(
+                        user=self.user).values_list('cinema_id', flat=True)),
+                    report_cinemas=list(Cinema.access_to_reports.through.objects.filter(
+                        user=self.user).values_list('cinema_id', flat=True)),
+                )
+                cache.set(key, ids, settings.CINEMA_ACCESS_CACHE_TIMEOUT)
+            self._ids = dict(cinemas=frozenset(ids['cinemas']),
+                             access_to_reports=frozenset(ids['report_cinemas']),
+                             report_cinemas=frozenset(ids['cinemas'] + ids['report_cinemas']))
+        return self._ids
+
+    @property
+    def cinema_ids(self):
+        """Cinemas the user fills daily reports for"""
+        return None if self.is_unrestricted else self.load()['cinemas']
+
+    @property
+    def access_to_reports_ids(self):
+        """Cinemas the user was explicitly given access to reports of"""
+        return None if self.is_unrestricted else self.load()['access_to_reports']
+
+    @property
+    def report_cinema_ids(self):
+        """Cinemas the user can see in reports"""
+        return None if self.is_unrestricted else self.load()['report_cinemas']
+
+    def __contains__(self, cinema):
+        if self.is_unrestricted:
+            return True
+        cinema_id = cinema.pk if isinstance(cinema, Cinema) else cinema
+        return cinema_id in self.cinema_ids
+
+    def can_view_reports(self, cinema):
+        if self.is_unrestricted:
+            return True
+        cinema_id = cinema.pk if isinstance(cinema, Cinema) else cinema
+        return cinema_id in self.report_cinema_ids
+
+    def get_report_cinemas_subquery(self):
+        return Cinema.objects.filter(
+            pk__in=Cinema.responsible_for_daily_reports.through.objects.filter(
+                user=self.user).values('cinema_id')) | Cinema.objects.filter(
+            pk__in=Cinema.access_to_reports.through.objects.filter(
+                user=self.user).values('cinema_id'))
+
+    def filter_reports(self, queryset, field_name='cinema'):
+        """Restricts a report queryset to cinemas the user can see"""
+        if self.is_unrestricted:
+            return queryset
+
+        cinema_ids = self.report_cinema_ids
+        if len(cinema_ids) > MAX_INLINE_IDS:
+            cinema_ids = self.get_report_cinemas_subquery().values('pk')
+        return queryset.filter(**{'{}__in'.format(field_name): cinema_ids})
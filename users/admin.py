@@ -14,8 +14,7 @@ from django.urls import reverse
 from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 
-from common.models import Cinema, FinishedCinemaReportDate, Chain, ContactInformation, \
-    AdditionalAgreement
+from common.models import Cinema, Chain, ContactInformation, CinemaDayStatus
 from kinomania.admin_utils import ChangeLinkMixin
 from users.admin_forms import UserTypeChoices, CustomUserCreationForm, CustomUserChangeForm, \
     USER_ACCESS_TYPE_CHOICES
@@ -126,8 +125,8 @@ class CustomUserAdmin(ChangeLinkMixin, UserAdmin):
         date = date - timedelta(days=1)
         self.date = date
 
-        finished_cinemas_ids = FinishedCinemaReportDate.objects.filter(
-                date=date).values_list('cinema_id', flat=True)
+        finished_cinemas_ids = CinemaDayStatus.objects.filter(
+                date=date, is_daily_report_finished=True).values_list('cinema_id', flat=True)
         users_with_finished_reports_ids = qs.filter(
                 cinemas__id__in=finished_cinemas_ids).values_list('id', flat=True)
 
@@ -181,8 +180,7 @@ class CustomUserAdmin(ChangeLinkMixin, UserAdmin):
         if obj.is_daily_report_finished:
             return 'Да'
 
-        if AdditionalAgreement.objects.filter(
-                cinema__in=obj.cinemas.all()).filter_by_date(self.date).exists():
+        if any(cinema.is_daily_report_finished is False for cinema in obj.annotated_cinemas):
             return 'Нет'
 
         return '-'  # no active AdditionalAgreement
@@ -213,8 +211,7 @@ class CustomUserAdmin(ChangeLinkMixin, UserAdmin):
 
             if cinema.is_daily_report_finished:
                 icon_value = 'yes'
-            elif AdditionalAgreement.objects.filter(
-                    cinema=cinema).filter_by_date(self.date).exists():
+            elif cinema.is_daily_report_finished is False:
                 icon_value = 'no'
             else:
                 continue
@@ -1,50 +1,104 @@
+import time
+from collections import defaultdict, OrderedDict
+
 from django.conf import settings
 from django.contrib.auth.base_user import AbstractBaseUser
 from django.contrib.auth.models import UserManager, PermissionsMixin
-from django.core.mail import send_mail
+from django.core.mail import send_mail, get_connection
 from django.db import models
+from django.db.models import F
+from django.db.models.signals import m2m_changed
 from django.template.loader import render_to_string
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.crypto import get_random_string
+from django.utils.functional import cached_property
 from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 
-from celery_tasks import async_send_email
-from common.models import Cinema, AdditionalAgreement, Chain
+from celery_tasks import async_send_email, async_send_html_emails, send_html_emails
+from common.models import Cinema, AdditionalAgreement, Chain, CinemaDayStatus
 from kinomania.utils import build_full_url, get_previous_dates
+from users.access import CinemaAccess, bump_access_versions
 
 
-class UserQueryset(models.QuerySet):
-    def send_daily_reports_emails(self, is_email_async):
+DAILY_REPORTS_EMAIL_SUBJECT = 'КиноМания: незаполненные отчёты по кинотеатрам'
 
-        today = now().date()
-        previous_dates = get_previous_dates(today)
 
-        for user in self:
-            missing_report_dates = []
-            for previous_date in previous_dates:
+def get_missing_report_links(missing_report_dates):
+    missing_report_links = {}
+    for date in missing_report_dates:
+        date_str = date.strftime(settings.DATE_URL_INPUT_FORMAT)
+        url = reverse('cinema_list', kwargs=dict(date=date_str))
+        missing_report_links[date_str] = build_full_url(url)
+    return missing_report_links
 
-                if not AdditionalAgreement.objects.filter(
-                        cinema__in=user.cinemas.all()).filter_by_date(previous_date).exists():
-                    continue
 
-                if Cinema.objects.filter(responsible_for_daily_reports=user,
-                                         created__date__lte=previous_date).exclude(
-                        finished_on_dates__date=previous_date).exists():
-                    missing_report_dates.append(previous_date)
+def render_daily_reports_email(missing_report_links):
+    return render_to_string('emails/daily_report_notification.html',
+                            dict(missing_report_links=missing_report_links))
 
-            if not missing_report_dates:
-                continue
 
-            missing_report_links = {}
-            for date in missing_report_dates:
-                date_str = date.strftime(settings.DATE_URL_INPUT_FORMAT)
-                url = reverse('cinema_list', kwargs=dict(date=date_str))
-                missing_report_links[date_str] = build_full_url(url)
+class UserQueryset(models.QuerySet):
+    def get_missing_report_dates(self, dates):
+        """Returns {user email: dates of missing reports of the user's cinemas}"""
+        rows = CinemaDayStatus.objects.filter(
+            cinema__responsible_for_daily_reports__in=self.values('id'),
+            cinema__created__date__lte=F('date'),
+            date__in=dates,
+            is_daily_report_finished=False,
+        ).values_list('cinema__responsible_for_daily_reports__email', 'date').distinct()
+
+        missing_report_dates = defaultdict(set)
+        for email, date in rows:
+            missing_report_dates[email].add(date)
+        return missing_report_dates
 
-            user.send_daily_reports_email(missing_report_dates=missing_report_dates,
-                                          is_email_async=is_email_async)
+    def send_daily_reports_emails(self, is_email_async):
+        """Sends reminders about missing daily reports of the previous dates.
+
+        Users with the same missing dates share one rendered message. Messages are sent
+        through one connection in batches, or by Celery subtasks, one per batch.
+        Returns the number of reminders and the duration of every phase in seconds.
+        """
+        timings = OrderedDict()
+        started = time.time()
+
+        previous_dates = get_previous_dates(now().date())
+        recipients = defaultdict(list)
+        for email, dates in self.get_missing_report_dates(previous_dates).items():
+            recipients[tuple(sorted(dates))].append(email)
+        timings['query'] = time.time() - started
+
+        started = time.time()
+        messages = [(render_daily_reports_email(get_missing_report_links(dates)), emails)
+                    for dates, emails in recipients.items()]
+        timings['render'] = time.time() - started
+
+        started = time.time()
+        batch_size = settings.DAILY_REPORTS_EMAILS_BATCH_SIZE
+        connection = None
+        if not is_email_async and messages:
+            connection = get_connection()
+            connection.open()
+        try:
+            for html_message, emails in messages:
+                for i in range(0, len(emails), batch_size):
+                    batch = emails[i:i + batch_size]
+                    if is_email_async:
+                        async_send_html_emails.delay(subject=DAILY_REPORTS_EMAIL_SUBJECT,
+                                                     html_message=html_message,
+                                                     recipient_list=batch)
+                    else:
+                        send_html_emails(DAILY_REPORTS_EMAIL_SUBJECT, html_message, batch,
+                                         connection=connection)
+        finally:
+            if connection:
+                connection.close()
+        timings['send'] = time.time() - started
+
+        return dict(emails_count=sum(len(emails) for emails in recipients.values()),
+                    timings=timings)
 
 
 class CustomUserManager(UserManager):
@@ -126,6 +180,10 @@ class User(AbstractBaseUser, PermissionsMixin):
     def email_user(self, subject, message, from_email=settings.DEFAULT_FROM_EMAIL, **kwargs):
         send_mail(subject, message, from_email, [self.email], **kwargs)
 
+    @cached_property
+    def cinema_access(self):
+        return CinemaAccess(self)
+
     @property
     def all_cinemas(self):
         if self.is_superuser or self.view_all_reports:
@@ -176,19 +234,35 @@ class User(AbstractBaseUser, PermissionsMixin):
     def send_daily_reports_email(self, missing_report_links, is_email_async):
         if not is_email_async:
             send_mail(
-                subject='КиноМания: незаполненные отчёты по кинотеатрам',
+                subject=DAILY_REPORTS_EMAIL_SUBJECT,
                 from_email=settings.DEFAULT_FROM_EMAIL,
                 message='',
                 recipient_list=[self.email],
-                html_message=render_to_string('emails/daily_report_notification.html',
-                                              dict(missing_report_links=missing_report_links))
+                html_message=render_daily_reports_email(missing_report_links)
             )
         else:
             async_send_email.delay(
-                    subject='КиноМания: незаполненные отчёты по кинотеатрам',
+                    subject=DAILY_REPORTS_EMAIL_SUBJECT,
                     from_email=settings.DEFAULT_FROM_EMAIL,
                     message='',
                     recipient_list=[self.email],
-                    html_message=render_to_string('emails/daily_report_notification.html',
-                                                  dict(missing_report_links=missing_report_links))
+                    html_message=render_daily_reports_email(missing_report_links)
                 )
+
+
+def cinema_access_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if reverse:  # user.cinemas / user.report_cinemas changed
+        user_ids = [instance.pk]
+    elif action == 'pre_clear':
+        user_ids = list(sender.objects.filter(cinema=instance).values_list('user_id', flat=True))
+    else:
+        user_ids = pk_set
+    bump_access_versions(user_ids)
+
+m2m_changed.connect(cinema_access_changed, sender=Cinema.responsible_for_daily_reports.through,
+                    dispatch_uid='cinema.responsible_for_daily_reports.access_changed')
+m2m_changed.connect(cinema_access_changed, sender=Cinema.access_to_reports.through,
+                    dispatch_uid='cinema.access_to_reports.access_changed')